@@ -6,3 +6,7 @@ from .datacontainer import DataContainer
 from .senderprotocol import SenderProtocol
 from .sampleprobe import SampleProbe
 from .zabbixagentconfig import ZabbixAgentConfig
+from .metrics import SenderMetrics
+from .tracing import SenderTracer
+from .routing import RoutingTable, RoutedSender
+from .response import SenderResponse, ZabbixProtocolError, ZabbixResponseError
@@ -0,0 +1,255 @@
+"""
+Client-side aggregation of items values over time windows
+
+Samples are collapsed into a compact accumulator per (host, key, window),
+percentiles use a log-bucketed sketch instead of keeping every sample
+"""
+import math
+import re
+
+AGGREGATION_FUNCTIONS = ('last', 'min', 'max', 'avg', 'sum', 'count')
+# Percentiles relative error
+SKETCH_ACCURACY = 0.01
+
+def derived_key(key, function):
+    """
+    Returns key with function appended to item name,
+    before parameters if any: net.if.in[eth0] gives net.if.in.p99[eth0]
+
+    :key: Zabbix item key
+    :function: aggregation function
+    """
+    if '[' in key:
+        name, params = key.split('[', 1)
+        return '%s.%s[%s' % (name, function, params)
+    return '%s.%s' % (key, function)
+
+def _key_pattern(pattern):
+    """
+    Returns compiled pattern where only * is a wildcard,
+    since brackets are part of Zabbix keys
+    """
+    return re.compile(
+        '^' + '.*'.join(re.escape(part) for part in pattern.split('*')) + '$'
+    )
+
+def _percentile(function):
+    """
+    Returns percentile as a float between 0 & 1 for p<N> functions,
+    None for other functions
+    """
+    if not function.startswith('p'):
+        return None
+    try:
+        percentile = float(function[1:])
+    except ValueError:
+        return None
+    if 0 <= percentile <= 100:
+        return percentile / 100
+    return None
+
+class QuantileSketch(object):
+    """
+    Log-bucketed histogram giving quantiles with a bounded relative error
+
+    :accuracy: relative error on quantiles
+    """
+
+    def __init__(self, accuracy=SKETCH_ACCURACY):
+        self._gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._positive = {}
+        self._negative = {}
+        self._zero = 0
+        self.count = 0
+
+    def add(self, value):
+        if value > 0:
+            index = int(math.ceil(math.log(value) / self._log_gamma))
+            self._positive[index] = self._positive.get(index, 0) + 1
+        elif value < 0:
+            index = int(math.ceil(math.log(-value) / self._log_gamma))
+            self._negative[index] = self._negative.get(index, 0) + 1
+        else:
+            self._zero += 1
+        self.count += 1
+
+    def _bucket_value(self, index):
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def quantile(self, quantile):
+        """
+        Returns approximate quantile, None if sketch is empty
+
+        :quantile: float between 0 & 1
+        """
+        if not self.count:
+            return None
+        rank = quantile * (self.count - 1)
+        seen = 0
+        # Greatest negative index is the lowest value
+        for index in sorted(self._negative, reverse=True):
+            seen += self._negative[index]
+            if seen > rank:
+                return -self._bucket_value(index)
+        seen += self._zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self._positive):
+            seen += self._positive[index]
+            if seen > rank:
+                return self._bucket_value(index)
+        return self._bucket_value(max(self._positive))
+
+class Accumulator(object):
+    """
+    Running aggregates of a single (host, key) over a window
+
+    :percentiles: True to feed a QuantileSketch
+    :numeric: False to only keep last value, which can be a string
+    """
+    __slots__ = ('count', 'sum', 'min', 'max', 'last', 'clock', 'sketch', 'numeric')
+
+    def __init__(self, percentiles=False, numeric=True):
+        self.numeric = numeric
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.clock = None
+        self.sketch = QuantileSketch() if percentiles else None
+
+    def add(self, value, clock):
+        self.count += 1
+        if self.clock is None or clock >= self.clock:
+            self.last = value
+            self.clock = clock
+        if not self.numeric:
+            return
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.sketch is not None:
+            self.sketch.add(value)
+
+    def result(self, function):
+        """
+        Returns aggregated value for function
+        """
+        if function == 'avg':
+            return float(self.sum) / self.count
+        if function in AGGREGATION_FUNCTIONS:
+            return getattr(self, function)
+        # Keep percentiles within observed values
+        quantile = self.sketch.quantile(_percentile(function))
+        return min(max(quantile, self.min), self.max)
+
+class AggregationRule(object):
+    """
+    Aggregation applied to keys matching a pattern
+
+    :pattern: item key, * matches any characters
+    :functions: list among last, min, max, avg, sum, count & p<N> like p99
+    :window: window length in seconds, windows are aligned on clock
+    :derived_keys: send each function as key.<function>,
+                   mandatory with more than one function
+    """
+
+    def __init__(self, pattern, functions=('avg',), window=60, derived_keys=False):
+        if isinstance(functions, str):
+            functions = (functions,)
+        for function in functions:
+            if function not in AGGREGATION_FUNCTIONS and _percentile(function) is None:
+                raise ValueError('Unknown aggregation function %s' % function)
+        if not functions or (len(functions) > 1 and not derived_keys):
+            raise ValueError('derived_keys is required to aggregate with several functions')
+        if not isinstance(window, int) or window <= 0:
+            raise ValueError('window must be a number of seconds greater than 0')
+        self.pattern = pattern
+        self._regex = _key_pattern(pattern)
+        self.functions = tuple(functions)
+        self.window = window
+        self.derived_keys = derived_keys
+        self.percentiles = any(_percentile(function) is not None for function in functions)
+        self.numeric = self.functions != ('last',)
+
+    def match(self, key):
+        return self._regex.match(key) is not None
+
+class Aggregator(object):
+    """
+    Collapse samples per (host, key) & window according to rules
+    """
+
+    def __init__(self):
+        self._rules = []
+        # Rule per key, None when no rule matches
+        self._rule_cache = {}
+        # {(host, key, window_start): Accumulator}
+        self._accumulators = {}
+
+    def __len__(self):
+        return len(self._accumulators)
+
+    def add_rule(self, rule):
+        """
+        Add an AggregationRule, first matching rule wins
+        """
+        self._rules.append(rule)
+        self._rule_cache = {}
+
+    def rule_for(self, key):
+        try:
+            return self._rule_cache[key]
+        except KeyError:
+            pass
+        rule = None
+        for candidate in self._rules:
+            if candidate.match(key):
+                rule = candidate
+                break
+        self._rule_cache[key] = rule
+        return rule
+
+    def add(self, host, key, value, clock):
+        """
+        Add a sample if a rule matches key
+        Returns False if key isn't aggregated
+        """
+        rule = self.rule_for(key)
+        if rule is None:
+            return False
+        if rule.numeric and not isinstance(value, (int, float)):
+            value = float(value)
+        window_start = clock - clock % rule.window
+        accumulator = self._accumulators.get((host, key, window_start))
+        if accumulator is None:
+            accumulator = self._accumulators[(host, key, window_start)] = \
+                Accumulator(rule.percentiles, rule.numeric)
+        accumulator.add(value, clock)
+        return True
+
+    def flush(self, now, force=False):
+        """
+        Returns aggregated values of closed windows
+        as a list of (host, key, value, clock)
+
+        :now: current clock
+        :force: also flush windows still open
+        """
+        results = []
+        for cache_key in sorted(self._accumulators):
+            host, key, window_start = cache_key
+            rule = self.rule_for(key)
+            if not force and window_start + rule.window > now:
+                continue
+            accumulator = self._accumulators.pop(cache_key)
+            for function in rule.functions:
+                result_key = derived_key(key, function) if rule.derived_keys else key
+                results.append(
+                    (host, result_key, accumulator.result(function), accumulator.clock)
+                )
+        return results
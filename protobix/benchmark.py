@@ -0,0 +1,279 @@
+"""
+Throughput benchmarks for DataContainer against a local fake trapper
+Each scenario runs in its own process so that peak RSS is meaningful
+
+    python -m protobix.benchmark --sizes 1000,100000 --rtt 0.001
+    python -m protobix.benchmark --save-baseline baseline.json
+    python -m protobix.benchmark --baseline baseline.json
+
+Exit code is 1 when a scenario is slower than baseline beyond tolerance
+"""
+import argparse
+import logging
+import os
+import resource
+import subprocess
+import sys
+from timeit import default_timer
+try: import simplejson as json
+except ImportError: import json # pragma: no cover
+
+from .datacontainer import DataContainer
+from .faketrapper import FakeTrapper, ZBX_RESP_INFO
+from .response import parse_response
+from .tracing import SenderTracer
+from .zabbixagentconfig import ZabbixAgentConfig
+
+SCENARIOS = (
+    'add_item', 'add', 'send_items', 'send_items_logging', 'send_lld',
+    'parse_response',
+)
+TLS_SCENARIOS = ('send_items_tls', 'send_lld_tls')
+# Items per host in generated data
+ITEMS_PER_HOST = 100
+
+class _ChunkTracer(SenderTracer):
+    """
+    Record each chunk latency, from serialization to parsed answer
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self._start = None
+
+    def before(self, phase, **info):
+        if phase == 'serialize':
+            self._start = default_timer()
+
+    def after(self, phase, duration, **info):
+        if phase == 'handle_response':
+            self.latencies.append(default_timer() - self._start)
+
+def percentile(values, percent):
+    """
+    Returns percentile using nearest rank, 0 if values is empty
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+def generate_data(data_type, size):
+    """
+    Returns size items as {host: {key: value}}
+    """
+    data = {}
+    for index in range(size):
+        host = data.setdefault('protobix.host%d' % (index // ITEMS_PER_HOST), {})
+        if data_type == 'lld':
+            host['protobix.lld%d' % index] = [
+                {'{#PBX_LLD_KEY}': index, '{#PBX_LLD_NAME}': 'lld string'},
+                {'{#PBX_LLD_KEY}': index + 1, '{#PBX_LLD_NAME}': 'another lld string'},
+            ]
+        else:
+            host['protobix.item%d' % index] = index
+    return data
+
+def _config(options, port=None):
+    # os.devnull avoids reading local zabbix_agentd.conf
+    zbx_config = ZabbixAgentConfig(config_file=os.devnull)
+    if port is not None:
+        zbx_config.server_port = port
+    if getattr(options, 'tls', False):
+        zbx_config.tls_ca_file = options.tls_ca_file
+        zbx_config.tls_cert_file = options.tls_cert_file
+        zbx_config.tls_key_file = options.tls_key_file
+        zbx_config.tls_connect = 'cert'
+    return zbx_config
+
+def _logger():
+    """
+    Returns an INFO logger writing to os.devnull, so that log records
+    are built & formatted like with a real handler
+    """
+    logger = logging.getLogger('ProtobixBenchmark')
+    logger.handlers = []
+    logger.addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+    logger.setLevel(logging.INFO)
+    return logger
+
+def _server_ssl_context(options):
+    import ssl
+    ssl_context = ssl.SSLContext(
+        getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23)
+    )
+    ssl_context.load_cert_chain(
+        options.tls_server_cert_file,
+        options.tls_server_key_file
+    )
+    ssl_context.verify_mode = ssl.CERT_REQUIRED
+    ssl_context.load_verify_locations(cafile=options.tls_ca_file)
+    return ssl_context
+
+def run_scenario(name, size, options):
+    """
+    Run a single scenario in current process
+    Returns a dict of results
+
+    :name: scenario name
+    :size: number of items
+    :options: parsed command line options, see main
+    """
+    result = {}
+    if name in ('add_item', 'add'):
+        data = generate_data('items', size)
+        zbx_container = DataContainer(config=_config(options))
+        zbx_container.data_type = 'items'
+        start = default_timer()
+        if name == 'add':
+            zbx_container.add(data)
+        else:
+            for host in data:
+                for key in data[host]:
+                    zbx_container.add_item(host, key, data[host][key])
+        duration = default_timer() - start
+    elif name == 'parse_response':
+        # Each item is a Zabbix Server answer
+        body = json.dumps({
+            'response': 'success',
+            'info': ZBX_RESP_INFO % (250, 0, 250, 0.001)
+        })
+        start = default_timer()
+        for index in range(size):
+            parse_response(body)
+        duration = default_timer() - start
+    else:
+        data_type = 'lld' if name.startswith('send_lld') else 'items'
+        options.tls = name.endswith('_tls')
+        ssl_context = _server_ssl_context(options) if options.tls else None
+        data = generate_data(data_type, size)
+        with FakeTrapper(latency=options.rtt, ssl_context=ssl_context) as trapper:
+            logger = _logger() if name.endswith('_logging') else None
+            zbx_container = DataContainer(
+                config=_config(options, trapper.port), logger=logger
+            )
+            tracer = _ChunkTracer()
+            zbx_container.tracer = tracer
+            zbx_container.data_type = data_type
+            zbx_container.add(data)
+            start = default_timer()
+            zbx_container.send()
+            duration = default_timer() - start
+        snapshot = zbx_container.metrics.snapshot()
+        result['bytes_per_second'] = snapshot['bytes_sent'] / duration
+        result['chunks'] = snapshot['chunks']
+        result['p50_latency'] = percentile(tracer.latencies, 50)
+        result['p99_latency'] = percentile(tracer.latencies, 99)
+    result['duration'] = duration
+    result['items_per_second'] = size / duration
+    # ru_maxrss is in kilobytes on Linux
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Protobix DataContainer throughput benchmarks'
+    )
+    parser.add_argument(
+        '--sizes', default='1000,100000',
+        help="Comma separated numbers of items. Default is 1000,100000"
+    )
+    parser.add_argument(
+        '--scenarios',
+        help="Comma separated scenarios among %s.\n"
+             "Default is all, TLS ones only if TLS files are provided" %
+             ','.join(SCENARIOS + TLS_SCENARIOS)
+    )
+    parser.add_argument(
+        '--rtt', type=float, default=0.001,
+        help="Fake trapper latency in seconds. Default is 0.001"
+    )
+    parser.add_argument('--baseline', help="Compare results with baseline file")
+    parser.add_argument('--save-baseline', help="Save results as baseline file")
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help="Accepted items/s decrease ratio against baseline. Default is 0.2"
+    )
+    parser.add_argument('--tls-ca-file')
+    parser.add_argument('--tls-cert-file')
+    parser.add_argument('--tls-key-file')
+    parser.add_argument('--tls-server-cert-file')
+    parser.add_argument('--tls-server-key-file')
+    # Used internally to run a single scenario in a child process
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(args)
+
+def _run_child(name, size, args):
+    """
+    Run a single scenario in a child process & returns its results
+    """
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_dir] + [path for path in [env.get('PYTHONPATH')] if path]
+    )
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'protobix.benchmark',
+         '--scenario', name, '--size', str(size)] + args,
+        env=env
+    )
+    return json.loads(output.decode())
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    options = _parse_args(args)
+    if options.scenario:
+        print(json.dumps(run_scenario(options.scenario, options.size, options)))
+        return 0
+
+    child_args = ['--rtt', str(options.rtt)]
+    for name in ['tls_ca_file', 'tls_cert_file', 'tls_key_file',
+                 'tls_server_cert_file', 'tls_server_key_file']:
+        if getattr(options, name):
+            child_args += ['--' + name.replace('_', '-'), getattr(options, name)]
+    if options.scenarios:
+        scenarios = options.scenarios.split(',')
+    elif options.tls_server_cert_file:
+        scenarios = SCENARIOS + TLS_SCENARIOS
+    else:
+        scenarios = SCENARIOS
+
+    results = {}
+    for name in scenarios:
+        for size in [int(size) for size in options.sizes.split(',')]:
+            result = _run_child(name, size, child_args)
+            results['%s/%d' % (name, size)] = result
+            print('%-18s %9d items %12.0f items/s %14.0f bytes/s '
+                  'p50 %8.4fs p99 %8.4fs peak rss %8d KB' % (
+                      name, size, result['items_per_second'],
+                      result.get('bytes_per_second', 0),
+                      result.get('p50_latency', 0),
+                      result.get('p99_latency', 0),
+                      result['peak_rss_kb']
+                  ))
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+    ret = 0
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        for key in sorted(results):
+            if key not in baseline:
+                continue
+            expected = baseline[key]['items_per_second'] * (1 - options.tolerance)
+            if results[key]['items_per_second'] < expected:
+                print('REGRESSION %s: %.0f items/s, baseline is %.0f items/s' % (
+                    key, results[key]['items_per_second'],
+                    baseline[key]['items_per_second']
+                ))
+                ret = 1
+    return ret
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,14 @@
 import logging
+from timeit import default_timer
 try: import simplejson as json
 except ImportError: import json # pragma: no cover
 
 from .zabbixagentconfig import ZabbixAgentConfig
 from .senderprotocol import SenderProtocol
+from .metrics import SenderMetrics
+from .valuecache import ValueCache, sha1_fingerprint
+from .aggregation import Aggregator, AggregationRule
+from .itemfilter import RejectedKeys
 
 # For both 2.0 & >2.2 Zabbix version
 # ? 1.8: Processed 0 Failed 1 Total 1 Seconds spent 0.000057
@@ -16,9 +21,15 @@ ZBX_TRAPPER_MAX_VALUE = 250
 class DataContainer(SenderProtocol):
 
     _items_list = []
+    _lld_list = []
     _result = []
     _logger = None
     _config = None
+    _metrics = None
+    _value_caches = None
+    _aggregator = None
+    _failed_items = None
+    _rejected_keys = None
     socket = None
 
     def __init__(self,
@@ -33,8 +44,33 @@ class DataContainer(SenderProtocol):
         if logger:
             self.logger = logger
         self._items_list = []
+        # LLD are kept apart until sent, so that they can be sent first
+        self._lld_list = []
+        self._metrics = SenderMetrics()
+        # ValueCache per data_type
+        self._value_caches = {}
+        self._aggregator = None
+        # Items Zabbix rejected during last send, when diagnose is enabled
+        self._failed_items = []
+        self._rejected_keys = None
 
-    def add_item(self, host, key, value, clock=None, state=0):
+    def aggregate(self, key, functions=('avg',), window=60, derived_keys=False):
+        """
+        Aggregate items values added for matching keys over time windows
+        Only aggregated values are sent, once their window is over
+
+        :key: item key, * matches any characters like in 'app.latency[*]'
+        :functions: list among last, min, max, avg, sum, count & p<N> like p99
+        :window: window length in seconds
+        :derived_keys: send each function as key.<function>,
+                       mandatory with more than one function
+        """
+        rule = AggregationRule(key, functions, window, derived_keys)
+        if self._aggregator is None:
+            self._aggregator = Aggregator()
+        self._aggregator.add_rule(rule)
+
+    def add_item(self, host, key, value, clock=None, state=0, data_type=None):
         """
         Add a single item into DataContainer
 
@@ -42,53 +78,145 @@ class DataContainer(SenderProtocol):
         :key: item key as defined in Zabbix
         :value: item value
         :clock: timestemp as integer. If not provided self.clock()) will be used
+        :data_type: "items" or "lld", overrides container's data_type
+                    so that items & LLD can be sent together
         """
         if clock is None:
             clock = self.clock
-        if self._config.data_type == "items":
+        if data_type is None:
+            data_type = self._config.data_type
+        if self._aggregator is not None and data_type == "items" and \
+           self._aggregator.add(host, key, value, clock):
+            self._metrics.inc('items_aggregated')
+            return
+        if data_type == "items":
             item = {"host": host, "key": key,
                     "value": value, "clock": clock, "state": state}
-        elif self._config.data_type == "lld":
+            self._items_list.append(item)
+        elif data_type == "lld":
+            if self._config.lld_refresh is None:
+                payload = json.dumps({"data": value})
+            elif isinstance(value, list):
+                # Canonical form: same discovery always gives same payload,
+                # whatever its entries & macros order
+                payload = '{"data": [%s]}' % ', '.join(sorted(
+                    json.dumps(entry, sort_keys=True) for entry in value
+                ))
+            else:
+                # Entries order is only known for lists of entries
+                payload = json.dumps({"data": value}, sort_keys=True)
             item = {"host": host, "key": key, "clock": clock, "state": state,
-                    "value": json.dumps({"data": value})}
+                    "value": payload}
+            self._lld_list.append(item)
         else:
             if self.logger: # pragma: no cover
                 self.logger.error("Setup data_type before adding data")
             raise ValueError('Setup data_type before adding data')
-        self._items_list.append(item)
+        self._metrics.inc('items_queued')
 
-    def add(self, data):
+    def add(self, data, data_type=None):
         """
         Add a list of item into the container
 
         :data: dict of items & value per hostname
+        :data_type: "items" or "lld", overrides container's data_type
         """
         for host in data:
             for key in data[host]:
                 if not data[host][key] == []:
-                    self.add_item(host, key, data[host][key])
+                    self.add_item(host, key, data[host][key], data_type=data_type)
+
+    @property
+    def items_list(self):
+        """
+        Returns items & LLD waiting to be sent, in sending order
+        """
+        if not self._lld_list:
+            return self._items_list
+        if self._config.lld_first:
+            return self._lld_list + self._items_list
+        return self._items_list + self._lld_list
+
+    def flush_aggregates(self, force=False):
+        """
+        Add aggregated values of closed windows as items
+        send calls it, force is useful to flush open windows before exiting
+
+        :force: also flush windows still open
+        """
+        if self._aggregator is None:
+            return
+        for host, key, value, clock in self._aggregator.flush(self.clock, force):
+            self._items_list.append({
+                "host": host, "key": key, "value": value,
+                "clock": clock, "state": 0
+            })
+            self._metrics.inc('items_queued')
 
     def send(self):
         """
         Entrypoint to send data to Zabbix
-        If debug is enabled, items are sent one by one
-        If debug isn't enable, we send items in bulk
-        Returns a list of results (1 if no debug, as many as items in other case)
+        Items are sent in bulk. With diagnose enabled, chunks with
+        failed items are bisected to find out which items Zabbix rejected,
+        see failed_items. With item_filter_ttl, rejected items aren't sent
+        again during item_filter_ttl seconds
+        Returns a tuple of results for all chunks
         """
+        self._failed_items = []
+        # Self-monitoring items can only be sent along with items
+        if self._config.self_monitoring and \
+           (self._config.data_type == 'items' or self._items_list):
+            self._add_self_monitoring_items()
+        self.flush_aggregates()
+        rejected_keys = self._init_rejected_keys()
+        # Items & LLD share chunks & connections
+        # Each part of the list has its own value cache
+        parts = []
+        for data_type, entries in (('lld', self._lld_list), ('items', self._items_list)):
+            if rejected_keys is not None:
+                kept = rejected_keys.filter(entries)
+                self._metrics.inc('items_filtered', len(entries) - len(kept))
+                if self.logger: # pragma: no cover
+                    self.logger.info(
+                        "Filtered %d %s Zabbix Server rejected recently",
+                        len(entries) - len(kept), data_type
+                    )
+                entries = kept
+            value_cache = self._init_value_cache(data_type)
+            if value_cache is not None:
+                filtered = value_cache.filter(entries)
+                self._metrics.inc('items_discarded', len(entries) - len(filtered))
+                if self.logger: # pragma: no cover
+                    self.logger.info(
+                        "Discarded %d unchanged %s",
+                        len(entries) - len(filtered), data_type
+                    )
+                entries = filtered
+            parts.append((entries, value_cache))
+        if not self._config.lld_first:
+            parts.reverse()
+        self._items_list = parts[0][0] + parts[1][0]
+        self._lld_list = []
+        # [(start_offset, stop_offset, value_cache)]
+        segments = []
+        offset = 0
+        for entries, value_cache in parts:
+            if value_cache is not None:
+                segments.append((offset, offset + len(entries), value_cache))
+            offset += len(entries)
         if self.logger: # pragma: no cover
-            self.logger.info("Starting to send %d items" % len(self._items_list))
+            self.logger.info("Starting to send %d items", len(self._items_list))
+        if self._tracer is not None:
+            self._tracer.before('send', items=len(self._items_list))
+            send_start = default_timer()
+        start_offset = 0
         try:
             # Zabbix trapper send a maximum of 250 items in bulk
             # We have to respect that, in case of enforcement on zabbix server side
-            # Special case if debug is enabled: we need to send items one by one
             max_value = ZBX_TRAPPER_MAX_VALUE
-            if self.debug_level >= 4:
-                max_value = 1
-                if self.logger: # pragma: no cover
-                    self.logger.debug("Bulk limit is %d items" % max_value)
-            else:
-                if self.logger: # pragma: no cover
-                    self.logger.info("Bulk limit is %d items" % max_value)
+            diagnose = self._config.diagnose
+            if self.logger: # pragma: no cover
+                self.logger.info("Bulk limit is %d items", max_value)
             # Initialize offsets & counters
             max_offset = len(self._items_list)
             run = 0
@@ -99,8 +227,8 @@ class DataContainer(SenderProtocol):
                 run += 1
                 if self.logger: # pragma: no cover
                     self.logger.debug(
-                        'run %d: start_offset is %d, stop_offset is %d' %
-                        (run, start_offset, stop_offset)
+                        'run %d: start_offset is %d, stop_offset is %d',
+                        run, start_offset, stop_offset
                     )
 
                 # Extract items to be send from global item's list'
@@ -109,7 +237,31 @@ class DataContainer(SenderProtocol):
                 # Send extracted items
                 run_response, run_processed, run_failed, run_total, run_time = self._send_common(_items_to_send)
 
+                run_failed_items = []
+                run_errors = self._last_response_errors()
+                # Per item errors are used without sending anything again
+                if run_failed and (diagnose or run_errors):
+                    self._socket_reset()
+                    run_failed_items = self._find_failed_items(
+                        _items_to_send, run_failed, run_errors
+                    )
+                    self._failed_items.extend(run_failed_items)
+                    if rejected_keys is not None:
+                        rejected_keys.add(run_failed_items)
+
+                # Only values Zabbix accepted are considered as sent
+                # Zabbix answers success even when it rejected some items,
+                # so chunks with unknown failed items aren't cached at all
+                if run_response == 'success' and \
+                   len(run_failed_items) == run_failed:
+                    self._update_value_caches(
+                        segments, start_offset, stop_offset, run_failed_items
+                    )
+
                 # Update counters
+                self._metrics.inc('chunks')
+                self._metrics.inc('items_sent', run_processed)
+                self._metrics.inc('items_failed', run_failed)
                 if run_response == 'success':
                     server_success += 1
                 elif run_response == 'failed':
@@ -119,10 +271,10 @@ class DataContainer(SenderProtocol):
                 total += run_total
                 time += run_time
                 if self.logger: # pragma: no cover
-                    self.logger.info("%d items sent during run %d" % (run_total, run))
+                    self.logger.info("%d items sent during run %d", run_total, run)
                     self.logger.debug(
-                        'run %d: processed is %d, failed is %d, total is %d' %
-                        (run, run_processed, run_failed, run_total)
+                        'run %d: processed is %d, failed is %d, total is %d',
+                        run, run_processed, run_failed, run_total
                     )
 
                 # Compute next run's offsets
@@ -132,27 +284,185 @@ class DataContainer(SenderProtocol):
                 # Reset socket, which is likely to be closed by server
                 self._socket_reset()
         except:
+            # Items not sent yet are lost
+            self._metrics.inc('items_dropped', len(self._items_list) - start_offset)
             self._reset()
             self._socket_reset()
+            self._save_value_caches(segments)
+            self._save_rejected_keys(rejected_keys)
             raise
+        self._save_value_caches(segments)
+        self._save_rejected_keys(rejected_keys)
         if self.logger: # pragma: no cover
-            self.logger.info('All %d items have been sent in %d runs' % (total, run))
+            self.logger.info('All %d items have been sent in %d runs', total, run)
             self.logger.debug(
-                'Total run is %d; item processed: %d, failed: %d, total: %d, during %f seconds' %
-                (run, processed, failed, total, time)
+                'Total run is %d; item processed: %d, failed: %d, total: %d, during %f seconds',
+                run, processed, failed, total, time
+            )
+        if self._tracer is not None:
+            self._tracer.after(
+                'send', default_timer() - send_start,
+                runs=run, processed=processed, failed=failed, total=total
             )
         # Everything has been sent.
         # Reset DataContainer & return results_list
         self._reset()
         return server_success, server_failure, processed, failed, total, time
 
+    def _last_response_errors(self):
+        """
+        Returns per item errors of last Zabbix answer
+        """
+        if self._last_response is None:
+            return []
+        return self._last_response.errors
+
+    def _find_failed_items(self, items, failed, errors=()):
+        """
+        Returns items Zabbix rejected among a chunk with failed items
+        Per item errors are used when Zabbix Server provides them, otherwise
+        chunk is bisected: only halves with failed items are sent again, so
+        that f failed items among n take about f*log2(n) round-trips
+        Items Zabbix processed in resent halves are stored again
+
+        :items: chunk which has been sent
+        :failed: number of failed items reported for this chunk
+        :errors: per item errors Zabbix reported for this chunk
+        """
+        if errors:
+            return [
+                dict(items[index], error=error)
+                for index, error in errors if index < len(items)
+            ]
+        if len(items) == 1:
+            if self.logger: # pragma: no cover
+                self.logger.warning(
+                    "Item [%s] of host [%s] failed",
+                    items[0]['key'], items[0]['host']
+                )
+            return [dict(items[0], error=None)]
+        middle = len(items) // 2
+        first_half = items[:middle]
+        first_failed = self._send_common(first_half)[2]
+        first_errors = self._last_response_errors()
+        self._socket_reset()
+        failed_items = []
+        if first_failed:
+            failed_items.extend(
+                self._find_failed_items(first_half, first_failed, first_errors)
+            )
+        # Second half failures are deduced from first half's ones
+        if failed - first_failed > 0:
+            failed_items.extend(
+                self._find_failed_items(items[middle:], failed - first_failed)
+            )
+        return failed_items
+
+    def _init_rejected_keys(self):
+        """
+        Returns RejectedKeys cache, None if item filter is disabled
+        Cache is kept for container's life, and loaded from its file
+        if any so that short-lived probes benefit too
+        """
+        ttl = self._config.item_filter_ttl
+        if ttl is None:
+            return None
+        state_file = self._config.item_filter_file
+        if self._rejected_keys is None or self._rejected_keys.state_file != state_file:
+            self._rejected_keys = RejectedKeys(ttl, state_file)
+        self._rejected_keys.ttl = ttl
+        return self._rejected_keys
+
+    def _save_rejected_keys(self, rejected_keys):
+        if rejected_keys is None or rejected_keys.state_file is None:
+            return
+        try:
+            rejected_keys.save()
+        except (IOError, OSError) as e:
+            # Rejected items will only be sent again
+            if self.logger: # pragma: no cover
+                self.logger.warning(
+                    "Unable to save item filter to %s [%s]",
+                    rejected_keys.state_file, e
+                )
+
+    def _init_value_cache(self, data_type):
+        """
+        Returns ValueCache for data_type, None if disabled
+        items use discard_unchanged, LLD use lld_refresh & only keep
+        payloads fingerprint
+        Cache is kept for container's life, and loaded from its file
+        if any so that short-lived probes benefit too
+        """
+        if data_type == 'lld':
+            heartbeat = self._config.lld_refresh
+            state_file = self._config.lld_cache_file
+            fingerprint = sha1_fingerprint
+        elif data_type == 'items':
+            heartbeat = self._config.discard_unchanged
+            state_file = self._config.value_cache_file
+            fingerprint = None
+        else:
+            return None
+        if heartbeat is None:
+            return None
+        value_cache = self._value_caches.get(data_type)
+        if value_cache is None or value_cache.state_file != state_file:
+            value_cache = self._value_caches[data_type] = ValueCache(
+                heartbeat, self._config.value_cache_size, state_file, fingerprint
+            )
+        value_cache.heartbeat = heartbeat
+        value_cache.max_size = self._config.value_cache_size
+        return value_cache
+
+    def _update_value_caches(self, segments, start_offset, stop_offset,
+                             failed_items=()):
+        """
+        Record items sent between start_offset & stop_offset
+        in their value cache, except failed ones
+
+        :failed_items: items Zabbix rejected among them
+        """
+        failed = set((item['host'], item['key']) for item in failed_items)
+        for segment_start, segment_stop, value_cache in segments:
+            start = max(start_offset, segment_start)
+            stop = min(stop_offset, segment_stop)
+            if start < stop:
+                value_cache.update([
+                    item for item in self._items_list[start:stop]
+                    if (item['host'], item['key']) not in failed
+                ])
+
+    def _save_value_caches(self, segments):
+        for segment_start, segment_stop, value_cache in segments:
+            if value_cache.state_file is None:
+                continue
+            try:
+                value_cache.save()
+            except (IOError, OSError) as e:
+                # Values will only be sent again
+                if self.logger: # pragma: no cover
+                    self.logger.warning(
+                        "Unable to save value cache to %s [%s]",
+                        value_cache.state_file, e
+                    )
+
+    def _add_self_monitoring_items(self):
+        """
+        Add sender metrics as protobix.sender.* items for configured hostname
+        Metrics are the ones collected until now, i.e. during previous sends
+        """
+        if self.logger: # pragma: no cover
+            self.logger.debug("Adding self-monitoring items")
+        self.add({self._config.hostname: self._metrics.zabbix_items()}, 'items')
+
     def _send_common(self, item):
         """
         Common part of sending operations
         Calls SenderProtocol._send_to_zabbix
         Returns result as provided by _handle_response
 
-        :item: either a list or a single item depending on debug_level
+        :item: list of items
         """
         total = len(item)
         processed = failed = time = 0
@@ -161,28 +471,57 @@ class DataContainer(SenderProtocol):
             processed = failed = time = 0
             response = 'dryrun'
         else:
-            self._send_to_zabbix(item)
+            start = default_timer()
+            throttle = self._send_to_zabbix(item)
             response, processed, failed, total, time = self._read_from_zabbix()
+            # Time spent waiting for rate limits isn't Zabbix Server's fault
+            round_trip = default_timer() - start - throttle
+            self._metrics.observe('round_trip', round_trip)
+            limiter = self._rate_limiter()
+            if limiter is not None:
+                limiter.feedback(response, round_trip, time)
+            if self.logger and self._last_response is not None: # pragma: no cover
+                for index, error in self._last_response.errors:
+                    if index < len(item):
+                        self.logger.warning(
+                            "Item [%s] of host [%s] failed: %s",
+                            item[index]['key'], item[index]['host'], error
+                        )
 
         output_key = '(bulk)'
         output_item = '(bulk)'
-        if self.debug_level >= 4:
+        if self.debug_level >= 4 and total == 1:
             output_key = item[0]['key']
             output_item = item[0]['value']
         if self.logger: # pragma: no cover
             self.logger.info(
-                "" +
-                ZBX_DBG_SEND_RESULT % (
-                    processed,
-                    failed,
-                    total,
-                    output_key,
-                    output_item,
-                    response
-                )
+                ZBX_DBG_SEND_RESULT,
+                processed,
+                failed,
+                total,
+                output_key,
+                output_item,
+                response
             )
         return response, processed, failed, total, time
 
+    def reload_config(self):
+        """
+        Reload configuration file & included files
+        Current connection is reset if configuration changed
+        so that next send uses new server & TLS settings
+        Returns True if configuration changed
+        """
+        changed = self._config.reload()
+        if changed:
+            if self.logger: # pragma: no cover
+                self.logger.info("Configuration changed, reset connection")
+            self._socket_reset()
+            # Another Zabbix Server may accept rejected items
+            if self._rejected_keys is not None:
+                self._rejected_keys.clear()
+        return changed
+
     def _reset(self):
         """
         Reset main DataContainer properties
@@ -192,6 +531,7 @@ class DataContainer(SenderProtocol):
         if self.logger: # pragma: no cover
             self.logger.info("Reset DataContainer")
         self._items_list = []
+        self._lld_list = []
         self._config.data_type = None
 
     @property
@@ -229,6 +569,36 @@ class DataContainer(SenderProtocol):
         """
         self._config.dryrun = value
 
+    @property
+    def self_monitoring(self):
+        """
+        Returns self_monitoring
+        """
+        return self._config.self_monitoring
+
+    @self_monitoring.setter
+    def self_monitoring(self, value):
+        """
+        Set self_monitoring
+        """
+        self._config.self_monitoring = value
+
+    @property
+    def metrics(self):
+        """
+        Returns SenderMetrics instance
+        """
+        return self._metrics
+
+    @property
+    def failed_items(self):
+        """
+        Returns items Zabbix rejected during last send, with error if known
+        Only filled with diagnose enabled, or when Zabbix details
+        per item errors
+        """
+        return self._failed_items
+
     @dryrun.setter
     def data_type(self, value):
         """
@@ -0,0 +1,232 @@
+"""
+Fake Zabbix trapper to test & benchmark protobix without Zabbix Server
+It speaks Zabbix protocol, including compression, and can inject faults
+
+It's only imported by protobix benchmarks:
+
+    from protobix.faketrapper import FakeTrapper
+    with FakeTrapper(latency=0.01) as trapper:
+        zbx_container.server_port = trapper.port
+        zbx_container.send()
+"""
+import random
+import socket
+import sys
+import threading
+import time
+try: import simplejson as json
+except ImportError: import json # pragma: no cover
+try: import socketserver
+except ImportError: import SocketServer as socketserver # pragma: no cover
+try: import asyncio
+except ImportError: asyncio = None # pragma: no cover
+
+from .framing import pack, unpack, ZBX_RESP_INFO
+
+class _BaseFakeTrapper(object):
+    """
+    Common part of fake trappers
+
+    :host: address to listen on
+    :port: port to listen on, 0 picks a free one between 10100 & 32767
+    :latency: seconds to wait before answering
+    :chunk_size: answer is written by chunks of chunk_size bytes
+    :chunk_delay: seconds to wait between chunks
+    :drop: number of next connections closed without answering
+    :failed_keys: items with these keys are reported as failed
+    :ssl_context: server side ssl.SSLContext to enable TLS
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0,
+                 chunk_size=None, chunk_delay=0, drop=0, failed_keys=None,
+                 ssl_context=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.drop = drop
+        self.failed_keys = set(failed_keys or [])
+        self.ssl_context = ssl_context
+        self.received = []
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _ports(self):
+        if self.port:
+            return [self.port]
+        # ServerPort must be between 1024 and 32767
+        # while ports picked by the OS are usually above
+        return random.sample(range(10100, 32768), 20)
+
+    def _bind(self, create_server):
+        for port in self._ports():
+            try:
+                return create_server(port)
+            except (socket.error, OSError) as e:
+                error = e
+        raise error
+
+    def _should_drop(self):
+        with self._lock:
+            if self.drop > 0:
+                self.drop -= 1
+                return True
+            return False
+
+    def _answer(self, body, compressed):
+        """
+        Process a request & returns answer as a list of chunks to write
+        """
+        start = time.time()
+        if sys.version_info[0] >= 3: # pragma: no cover
+            body = body.decode()
+        request = json.loads(body)
+        items = request.get('data', [])
+        failed = len([
+            item for item in items if item.get('key') in self.failed_keys
+        ])
+        with self._lock:
+            self.requests += 1
+            self.received.extend(items)
+        answer = json.dumps({
+            'response': 'success',
+            'info': ZBX_RESP_INFO % (
+                len(items) - failed, failed, len(items), time.time() - start
+            )
+        }).encode('utf-8')
+        return self._chunks(pack(answer, compressed))
+
+    def _chunks(self, packet):
+        if not self.chunk_size:
+            return [packet]
+        return [
+            packet[offset:offset + self.chunk_size]
+            for offset in range(0, len(packet), self.chunk_size)
+        ]
+
+class _TrapperRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        trapper = self.server.trapper
+        if trapper._should_drop():
+            return
+        if trapper.ssl_context is not None:
+            self.request = trapper.ssl_context.wrap_socket(
+                self.request, server_side=True
+            )
+        data = b''
+        request = None
+        while request is None:
+            _buffer = self.request.recv(4096)
+            if not _buffer:
+                return
+            data += _buffer
+            request = unpack(data)
+        chunks = trapper._answer(*request)
+        time.sleep(trapper.latency)
+        for index, chunk in enumerate(chunks):
+            if index:
+                time.sleep(trapper.chunk_delay)
+            self.request.sendall(chunk)
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class FakeTrapper(_BaseFakeTrapper):
+    """
+    Fake Zabbix trapper handling each connection in its own thread
+    """
+
+    def start(self):
+        self._server = self._bind(
+            lambda port: _ThreadingTCPServer(
+                (self.host, port), _TrapperRequestHandler
+            )
+        )
+        self._server.trapper = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,)
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+if asyncio is not None:
+
+    class _TrapperProtocol(asyncio.Protocol):
+
+        def __init__(self, trapper, loop):
+            self.trapper = trapper
+            self.loop = loop
+            self.data = b''
+            self.answered = False
+
+        def connection_made(self, transport):
+            self.transport = transport
+            if self.trapper._should_drop():
+                transport.close()
+
+        def data_received(self, data):
+            if self.answered:
+                return
+            self.data += data
+            request = unpack(self.data)
+            if request is None:
+                return
+            self.answered = True
+            chunks = self.trapper._answer(*request)
+            self.loop.call_later(self.trapper.latency, self._write, chunks)
+
+        def _write(self, chunks):
+            if self.transport.is_closing():
+                return
+            self.transport.write(chunks[0])
+            if len(chunks) > 1:
+                self.loop.call_later(
+                    self.trapper.chunk_delay, self._write, chunks[1:]
+                )
+            else:
+                self.transport.close()
+
+    class AsyncFakeTrapper(_BaseFakeTrapper):
+        """
+        Fake Zabbix trapper handling all connections in a single
+        asyncio event loop, running in its own thread
+        """
+
+        def start(self):
+            self._loop = asyncio.new_event_loop()
+            self._server = self._bind(
+                lambda port: self._loop.run_until_complete(
+                    self._loop.create_server(
+                        lambda: _TrapperProtocol(self, self._loop),
+                        self.host, port, ssl=self.ssl_context
+                    )
+                )
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+            self._thread = threading.Thread(target=self._loop.run_forever)
+            self._thread.daemon = True
+            self._thread.start()
+
+        def stop(self):
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
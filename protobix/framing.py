@@ -0,0 +1,59 @@
+"""
+Zabbix protocol framing: ZBXD header, flags & payload length
+
+Shared by sender, relay, passive agent & fake trapper
+"""
+import struct
+import zlib
+
+ZBX_HDR_MARK = b'ZBXD'
+ZBX_HDR_SIZE = 13
+ZBX_HDR_FORMAT = struct.Struct('<BII')
+ZBX_FLAG_PROTOCOL = 0x01
+ZBX_FLAG_COMPRESSION = 0x02
+# Info of Zabbix trapper answers
+ZBX_RESP_INFO = 'processed: %d; failed: %d; total: %d; seconds spent: %.6f'
+
+def pack(body, compress=False):
+    """
+    Build a Zabbix protocol packet
+
+    :body: payload as bytes
+    :compress: compress payload with zlib
+    """
+    if compress:
+        data = zlib.compress(body)
+        return ZBX_HDR_MARK + ZBX_HDR_FORMAT.pack(
+            ZBX_FLAG_PROTOCOL | ZBX_FLAG_COMPRESSION, len(data), len(body)
+        ) + data
+    return ZBX_HDR_MARK + ZBX_HDR_FORMAT.pack(ZBX_FLAG_PROTOCOL, len(body), 0) + body
+
+def packet_size(data):
+    """
+    Returns whole packet size read from its header
+    None if header is incomplete
+
+    :data: bytes read so far
+    """
+    if len(data) < ZBX_HDR_SIZE:
+        return None
+    if data[:4] != ZBX_HDR_MARK:
+        raise ValueError('Invalid Zabbix header')
+    return ZBX_HDR_SIZE + ZBX_HDR_FORMAT.unpack(data[4:ZBX_HDR_SIZE])[1]
+
+def unpack(data):
+    """
+    Extract payload from a Zabbix protocol packet
+    Returns a tuple (body, compressed) or None if packet is incomplete
+
+    :data: bytes read so far
+    """
+    size = packet_size(data)
+    if size is None or len(data) < size:
+        return None
+    flags = ZBX_HDR_FORMAT.unpack(data[4:ZBX_HDR_SIZE])[0]
+    body = data[ZBX_HDR_SIZE:size]
+    compressed = bool(flags & ZBX_FLAG_COMPRESSION)
+    if compressed:
+        body = zlib.decompress(body)
+    return body, compressed
@@ -0,0 +1,93 @@
+"""
+Items Zabbix Server rejected, used to drop them before they are
+serialized & sent again
+
+Zabbix only accepts sender data for trapper items, and its answer only
+tells how many items failed. Rejected items are known when Zabbix details
+per item errors, or with diagnose enabled
+"""
+import os
+import time
+try: import simplejson as json
+except ImportError: import json # pragma: no cover
+
+class RejectedKeys(object):
+    """
+    (host, key) pairs Zabbix rejected, dropped during ttl seconds
+    so that they're tried again once Zabbix configuration may have changed
+
+    :ttl: seconds during which a rejected item is dropped
+    :state_file: JSON file where rejected items are persisted,
+                 None to keep them in memory
+    """
+
+    def __init__(self, ttl, state_file=None):
+        self.ttl = ttl
+        self.state_file = state_file
+        # {(host, key): expires}, wall clock so that it can be persisted
+        self._rejected = {}
+        if state_file is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self._rejected)
+
+    def clear(self):
+        self._rejected = {}
+
+    def add(self, items, now=None):
+        """
+        Record items Zabbix rejected
+
+        :items: list of items as built by DataContainer.add_item
+        """
+        if now is None:
+            now = time.time()
+        for item in items:
+            self._rejected[(item['host'], item['key'])] = now + self.ttl
+
+    def filter(self, items, now=None):
+        """
+        Returns items which weren't rejected during last ttl seconds
+
+        :items: list of items as built by DataContainer.add_item
+        """
+        if now is None:
+            now = time.time()
+        if not self._rejected:
+            return items
+        # Drop expired entries so that the cache doesn't grow forever
+        for pair, expires in list(self._rejected.items()):
+            if expires <= now:
+                del self._rejected[pair]
+        return [
+            item for item in items
+            if (item['host'], item['key']) not in self._rejected
+        ]
+
+    def load(self):
+        """
+        Load rejected items from state_file
+        Missing or invalid state file gives an empty cache
+        """
+        rejected = {}
+        try:
+            with open(self.state_file) as state:
+                for host, key, expires in json.load(state):
+                    rejected[(host, key)] = float(expires)
+        except (IOError, OSError, ValueError, TypeError):
+            rejected = {}
+        self._rejected = rejected
+
+    def save(self):
+        """
+        Write rejected items into state_file
+        File is replaced atomically so that a crash can't corrupt it
+        """
+        tmp_file = '%s.%d.tmp' % (self.state_file, os.getpid())
+        with open(tmp_file, 'w') as state:
+            json.dump([
+                [host, key, expires]
+                for (host, key), expires in self._rejected.items()
+            ], state)
+        os.rename(tmp_file, self.state_file)
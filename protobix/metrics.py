@@ -0,0 +1,112 @@
+import bisect
+
+# Prefix used for text exposition & Zabbix self-monitoring items
+METRICS_PREFIX = 'protobix_sender'
+ZBX_METRICS_KEY = 'protobix.sender.%s'
+# Latency histograms buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+class Histogram(object):
+    """
+    Prometheus-style histogram with fixed buckets
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        # Last slot counts observations greater than the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+class SenderMetrics(object):
+    """
+    Instrumentation registry for SenderProtocol & DataContainer
+    Counters are totals since creation or last reset
+    Histograms track latencies in seconds
+    """
+
+    COUNTERS = (
+        'items_queued',
+        'items_sent',
+        'items_failed',
+        'items_dropped',
+        'items_discarded',
+        'items_aggregated',
+        'items_filtered',
+        'bytes_sent',
+        'chunks',
+        'connections',
+    )
+    HISTOGRAMS = (
+        'connect',
+        'tls_handshake',
+        'serialize',
+        'round_trip',
+        'throttle',
+    )
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = dict((name, 0) for name in self.COUNTERS)
+        self.histograms = dict(
+            (name, Histogram()) for name in self.HISTOGRAMS
+        )
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def snapshot(self):
+        """
+        Returns a flat dict of all metrics
+        Histograms are exported as <name>_seconds_count & <name>_seconds_sum
+        """
+        snapshot = dict(self.counters)
+        for name in self.HISTOGRAMS:
+            histogram = self.histograms[name]
+            snapshot[name + '_seconds_count'] = histogram.count
+            snapshot[name + '_seconds_sum'] = histogram.sum
+        return snapshot
+
+    def zabbix_items(self):
+        """
+        Returns metrics as a dict of Zabbix item keys & values
+        """
+        snapshot = self.snapshot()
+        return dict(
+            (ZBX_METRICS_KEY % name, snapshot[name]) for name in snapshot
+        )
+
+    def expose(self):
+        """
+        Returns metrics in Prometheus text exposition format
+        """
+        lines = []
+        for name in self.COUNTERS:
+            metric = '%s_%s_total' % (METRICS_PREFIX, name)
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %d' % (metric, self.counters[name]))
+        for name in self.HISTOGRAMS:
+            histogram = self.histograms[name]
+            metric = '%s_%s_seconds' % (METRICS_PREFIX, name)
+            lines.append('# TYPE %s histogram' % metric)
+            cumulative = 0
+            for bucket, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (metric, bucket, cumulative))
+            lines.append('%s_bucket{le="+Inf"} %d' % (metric, histogram.count))
+            lines.append('%s_sum %s' % (metric, repr(histogram.sum)))
+            lines.append('%s_count %d' % (metric, histogram.count))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,200 @@
+"""
+Passive Zabbix agent serving values collected periodically by a probe
+
+Zabbix Server polls agent keys on port 10050. Instead of forking a probe
+for each poll through UserParameter, values are collected every refresh
+seconds & served from memory by a single asyncio event loop
+"""
+import signal
+import socket
+import threading
+try: import simplejson as json
+except ImportError: import json # pragma: no cover
+try: import asyncio
+except ImportError: asyncio = None # pragma: no cover
+
+from .framing import pack, unpack
+from .sampleprobe import ZBX_PASSIVE_REFRESH
+
+ZBX_AGENT_PORT = 10050
+ZBX_NOTSUPPORTED = 'ZBX_NOTSUPPORTED'
+# Largest key Zabbix Server may send, longer requests are dropped
+ZBX_MAX_REQUEST_SIZE = 65536
+
+def parse_request(data):
+    """
+    Returns requested key, None if request is incomplete
+    Zabbix Server sends key either with Zabbix header or as a text line
+
+    :data: bytes read so far
+    """
+    if data[:4] == b'ZBXD':
+        request = unpack(data)
+        if request is None:
+            return None
+        data = request[0]
+    elif b'\n' in data:
+        data = data.split(b'\n', 1)[0]
+    else:
+        return None
+    return data.decode('utf-8').strip()
+
+def format_value(value):
+    """
+    Returns value as sent to Zabbix Server
+    """
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, float):
+        return repr(value)
+    return '%s' % value
+
+if asyncio is not None:
+
+    class _AgentProtocol(asyncio.Protocol):
+
+        def __init__(self, agent):
+            self.agent = agent
+            self.data = b''
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def data_received(self, data):
+            self.data += data
+            try:
+                key = parse_request(self.data)
+            except ValueError:
+                self.transport.close()
+                return
+            if key is None:
+                if len(self.data) > ZBX_MAX_REQUEST_SIZE:
+                    self.transport.close()
+                return
+            self.transport.write(pack(self.agent._answer(key)))
+            self.transport.close()
+
+class PassiveAgent(object):
+    """
+    Answer Zabbix passive checks from values collected every refresh seconds
+
+    :collect: function returning values as a dict of items per host,
+              like SampleProbe._get_metrics
+    :hostname: host which values are served, like Zabbix agent Hostname
+    :host: address to listen on
+    :port: port to listen on, 0 picks a free one
+    :refresh: seconds between two collections
+    :logger: logging instance
+    """
+
+    def __init__(self, collect, hostname=None, host='0.0.0.0', port=ZBX_AGENT_PORT,
+                 refresh=ZBX_PASSIVE_REFRESH, logger=None):
+        self._collect = collect
+        self.hostname = hostname
+        self.host = host
+        self.port = port
+        self.refresh = refresh
+        self._logger = logger
+        # {key: formatted value}, replaced as a whole on each collection
+        self._values = {}
+        self.requests = 0
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def collect(self):
+        """
+        Collect values now
+        Previous values are kept if collection fails
+        """
+        try:
+            data = self._collect()
+        except Exception as e:
+            if self._logger: # pragma: no cover
+                self._logger.error("Collecting values failed [%s]" % str(e))
+            return False
+        # Zabbix polls an agent for a single host, other hosts values
+        # would be answered for keys they don't belong to
+        others = sorted(host for host in data if host != self.hostname)
+        if others and self._logger: # pragma: no cover
+            self._logger.warning(
+                "Ignoring values of other hosts than %s: %s",
+                self.hostname, ', '.join(others)
+            )
+        values = {}
+        for key, value in data.get(self.hostname, {}).items():
+            values[key] = format_value(value)
+        self._values = values
+        if self._logger: # pragma: no cover
+            self._logger.info("Collected %d values", len(values))
+        return True
+
+    def _answer(self, key):
+        """
+        Returns answer to a key request as bytes
+        """
+        self.requests += 1
+        if key == 'agent.ping':
+            value = '1'
+        else:
+            value = self._values.get(key)
+        if value is None:
+            return ('%s\0Unsupported item key.' % ZBX_NOTSUPPORTED).encode('utf-8')
+        return value.encode('utf-8')
+
+    def _refresh_loop(self):
+        while not self._stopped.wait(self.refresh):
+            self.collect()
+
+    def start(self):
+        if asyncio is None: # pragma: no cover
+            raise NotImplementedError('Passive agent requires asyncio')
+        self.collect()
+        self._stopped.clear()
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(
+            self._loop.create_server(
+                lambda: _AgentProtocol(self), self.host, self.port,
+                backlog=socket.SOMAXCONN, reuse_address=True
+            )
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._threads = [
+            threading.Thread(target=self._loop.run_forever),
+            threading.Thread(target=self._refresh_loop),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        if self._logger: # pragma: no cover
+            self._logger.info("Passive agent listening on port %d", self.port)
+
+    def stop(self):
+        self._stopped.set()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        for thread in self._threads:
+            thread.join()
+        self._server.close()
+        self._loop.run_until_complete(self._server.wait_closed())
+        self._loop.close()
+
+    def serve_forever(self):
+        """
+        Serve until SIGTERM or KeyboardInterrupt
+        """
+        stopped = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+        self.start()
+        try:
+            while not stopped.is_set():
+                stopped.wait(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
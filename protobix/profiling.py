@@ -0,0 +1,194 @@
+"""
+Profiling of SampleProbe runs
+
+Wall time, CPU time & net allocated memory blocks are recorded for each
+probe step & each send pipeline phase. Net blocks are allocations minus
+frees, i.e. memory a step kept, not how much it allocated. Optionally, cProfile & tracemalloc
+reports are written into a directory, so that slow probes can be found
+without patching them
+"""
+import os
+import sys
+import time
+from collections import OrderedDict
+from timeit import default_timer
+try: import simplejson as json
+except ImportError: import json # pragma: no cover
+
+from .tracing import SenderTracer
+
+# Zabbix keys of profile items, filled with step or phase name & measure
+PROFILE_STEP_KEY = 'protobix.profile.step[%s,%s]'
+PROFILE_PHASE_KEY = 'protobix.profile.phase[%s,%s]'
+PROFILE_MEASURES = ('wall', 'cpu', 'net_blocks')
+# Number of lines in tracemalloc report
+PROFILE_MALLOC_TOP = 25
+
+try: _cpu_time = time.process_time
+except AttributeError: _cpu_time = time.clock # pragma: no cover
+
+def _allocated_blocks():
+    """
+    Returns number of memory blocks allocated by interpreter,
+    None if unknown (Python 2)
+    """
+    if hasattr(sys, 'getallocatedblocks'):
+        return sys.getallocatedblocks()
+    return None # pragma: no cover
+
+class _Measure(object):
+
+    def __init__(self):
+        self.wall = default_timer()
+        self.cpu = _cpu_time()
+        self.net_blocks = _allocated_blocks()
+
+class _NoStep(object):
+    """
+    Context doing nothing, used when profiling is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NO_STEP = _NoStep()
+
+class _Step(object):
+
+    def __init__(self, profile, name):
+        self._profile = profile
+        self._name = name
+
+    def __enter__(self):
+        self._start = _Measure()
+        return self
+
+    def __exit__(self, *args):
+        self._profile._record(self._profile.steps, self._name, self._start)
+        return False
+
+class RunProfile(SenderTracer):
+    """
+    Per step & per send phase timings of a probe run
+    Set it as DataContainer tracer to get send phases
+
+    :directory: where cProfile & tracemalloc reports are written,
+                they aren't run when None
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        # {name: {'count', 'wall', 'cpu', 'net_blocks'}}
+        self.steps = OrderedDict()
+        self.phases = OrderedDict()
+        # Started phases, a list per name since phases may be nested
+        self._started = {}
+        self._profiler = None
+        self._tracemalloc = None
+
+    def start(self):
+        """
+        Start cProfile & tracemalloc if reports are wanted
+        cProfile only profiles calling thread
+        """
+        if self.directory is None:
+            return
+        import cProfile
+        self._profiler = cProfile.Profile()
+        try:
+            import tracemalloc
+        except ImportError: # pragma: no cover
+            tracemalloc = None
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracemalloc = tracemalloc
+        self._profiler.enable()
+
+    def stop(self):
+        """
+        Stop cProfile & tracemalloc, write reports
+        Returns written files
+        """
+        if self._profiler is None:
+            return []
+        self._profiler.disable()
+        prefix = os.path.join(
+            self.directory, 'protobix-%d-%d' % (int(time.time()), os.getpid())
+        )
+        files = [prefix + '.json', prefix + '.prof']
+        with open(files[0], 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+        self._profiler.dump_stats(files[1])
+        self._profiler = None
+        if self._tracemalloc is not None:
+            snapshot = self._tracemalloc.take_snapshot()
+            self._tracemalloc.stop()
+            self._tracemalloc = None
+            files.append(prefix + '.malloc.txt')
+            with open(files[-1], 'w') as malloc_file:
+                for stat in snapshot.statistics('lineno')[:PROFILE_MALLOC_TOP]:
+                    malloc_file.write('%s\n' % stat)
+        return files
+
+    def step(self, name):
+        """
+        Returns a context recording a probe step
+
+        :name: step name, like get_data
+        """
+        return _Step(self, name)
+
+    def _record(self, records, name, start):
+        end = _Measure()
+        record = records.setdefault(
+            name, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'net_blocks': None}
+        )
+        record['count'] += 1
+        record['wall'] += end.wall - start.wall
+        record['cpu'] += end.cpu - start.cpu
+        if start.net_blocks is not None:
+            record['net_blocks'] = (record['net_blocks'] or 0) + \
+                end.net_blocks - start.net_blocks
+
+    def before(self, phase, **info):
+        self._started.setdefault(phase, []).append(_Measure())
+
+    def after(self, phase, duration, **info):
+        started = self._started.get(phase)
+        if started:
+            self._record(self.phases, phase, started.pop())
+
+    def summary(self):
+        return {'steps': self.steps, 'phases': self.phases}
+
+    def report(self):
+        """
+        Returns a line per step & phase as text
+        """
+        lines = []
+        for kind, records in (('step', self.steps), ('phase', self.phases)):
+            for name, record in records.items():
+                lines.append(
+                    '%s %s: %d call(s), wall %.6fs, cpu %.6fs, net blocks %s' % (
+                        kind, name, record['count'], record['wall'],
+                        record['cpu'], record['net_blocks']
+                    )
+                )
+        return '\n'.join(lines)
+
+    def items(self):
+        """
+        Returns profile as a dict of Zabbix items
+        Unknown net blocks aren't included
+        """
+        items = {}
+        for key, records in ((PROFILE_STEP_KEY, self.steps),
+                             (PROFILE_PHASE_KEY, self.phases)):
+            for name, record in records.items():
+                for measure in PROFILE_MEASURES:
+                    if record[measure] is not None:
+                        items[key % (name, measure)] = record[measure]
+        return items
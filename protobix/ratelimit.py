@@ -0,0 +1,157 @@
+"""
+Rate limiting & backpressure for chunks sent to Zabbix Server
+
+Limiters are shared by all senders of a process targeting the same
+Zabbix Server, so that many DataContainer can't overload it together
+"""
+import threading
+import time
+from timeit import default_timer
+
+# Maximum pause between chunks when Zabbix Server is slow
+MAX_BACKPRESSURE_PAUSE = 30.0
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at rate tokens per second
+    Bucket holds at most one second worth of tokens
+
+    :rate: tokens per second, 0 means unlimited
+    """
+
+    def __init__(self, rate=0):
+        self.rate = 0
+        self._tokens = 0
+        self._updated = default_timer()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """
+        Change rate, bucket is full again if rate changed
+        """
+        if rate != self.rate:
+            self.rate = rate
+            self._tokens = rate
+
+    def reserve(self, amount, now):
+        """
+        Take amount tokens & returns seconds to wait until they are available
+        Tokens are taken even when not yet available, so that later callers
+        wait for earlier ones
+
+        :amount: number of tokens
+        :now: current default_timer value
+        """
+        if not self.rate:
+            return 0.0
+        self._tokens = min(
+            self.rate, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+class RateLimiter(object):
+    """
+    Items/s & bytes/s limits for a Zabbix Server,
+    along with backpressure: each slow or failed answer doubles
+    the pause between chunks, each fast one halves it
+
+    :items_per_second: 0 means unlimited
+    :bytes_per_second: 0 means unlimited
+    :threshold: answers slower than threshold seconds trigger backpressure,
+                None disables backpressure
+    """
+
+    # Limiters shared by the whole process
+    # {(server_active, server_port): RateLimiter}
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, items_per_second=0, bytes_per_second=0, threshold=None):
+        self._lock = threading.Lock()
+        self._items = TokenBucket()
+        self._bytes = TokenBucket()
+        self.pause = 0.0
+        self._next_send = 0.0
+        self.configure(items_per_second, bytes_per_second, threshold)
+
+    @classmethod
+    def shared(cls, server_active, server_port):
+        """
+        Returns the limiter shared by all senders of the process
+        targeting this Zabbix Server
+
+        :server_active: Zabbix Server address
+        :server_port: Zabbix Server port
+        """
+        with cls._shared_lock:
+            key = (server_active, server_port)
+            if key not in cls._shared:
+                cls._shared[key] = cls()
+            return cls._shared[key]
+
+    def configure(self, items_per_second, bytes_per_second, threshold):
+        """
+        Update limits, latest configuration wins
+        """
+        with self._lock:
+            self._items.set_rate(items_per_second)
+            self._bytes.set_rate(bytes_per_second)
+            self.threshold = threshold
+            if threshold is None:
+                self.pause = 0.0
+
+    def reserve(self, items, size):
+        """
+        Reserve a chunk & returns seconds to wait before sending it
+
+        :items: number of items in chunk
+        :size: chunk size in bytes
+        """
+        with self._lock:
+            now = default_timer()
+            wait = max(
+                self._items.reserve(items, now),
+                self._bytes.reserve(size, now)
+            )
+            # Chunks are spaced by pause, whichever sender sends them
+            if self.pause:
+                wait = max(wait, self._next_send - now)
+                self._next_send = now + wait + self.pause
+            return wait
+
+    def acquire(self, items, size):
+        """
+        Wait until a chunk can be sent
+        Returns seconds waited
+        """
+        wait = self.reserve(items, size)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def feedback(self, response, round_trip, seconds_spent):
+        """
+        Adjust backpressure from Zabbix Server answer
+
+        :response: 'success' or 'failed'
+        :round_trip: seconds between sending chunk & reading answer
+        :seconds_spent: seconds spent by Zabbix Server as reported in answer
+        """
+        if self.threshold is None:
+            return
+        with self._lock:
+            if response == 'failed' or \
+               max(round_trip, seconds_spent) > self.threshold:
+                self.pause = min(
+                    max(self.pause * 2, round_trip), MAX_BACKPRESSURE_PAUSE
+                )
+            elif self.pause:
+                # Forget pause once it's negligible
+                self.pause = self.pause / 2 if self.pause > 0.001 else 0.0
+            # Pause starts once answer is received
+            if self.pause:
+                self._next_send = default_timer() + self.pause
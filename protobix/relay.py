@@ -0,0 +1,293 @@
+"""
+Local relay daemon batching items of many short-lived probes
+
+Probes send items to relay's UNIX socket, using relay_socket option,
+and get their answer as soon as items are queued. Relay coalesces
+items of all probes into full chunks sent to Zabbix Server, so that
+connections & TLS handshakes are shared by all probes of a host
+
+    python -m protobix.relay --socket /run/protobix/relay.sock \\
+        --config /etc/zabbix/zabbix_agentd.conf
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+from timeit import default_timer
+try: import simplejson as json
+except ImportError: import json # pragma: no cover
+try: import socketserver
+except ImportError: import SocketServer as socketserver # pragma: no cover
+
+from .datacontainer import DataContainer, ZBX_TRAPPER_MAX_VALUE
+from .framing import pack, packet_size, unpack, ZBX_RESP_INFO
+from .response import ZabbixProtocolError
+from .zabbixagentconfig import ZabbixAgentConfig
+
+RELAY_SOCKET = '/tmp/protobix-relay.sock'
+# Maximum seconds items wait for other probes' items
+RELAY_FLUSH_INTERVAL = 1.0
+# Maximum number of items waiting to be forwarded
+RELAY_MAX_QUEUE = 100000
+# Maximum size of a probe's request, bigger ones are refused
+RELAY_MAX_REQUEST_SIZE = 64 * 1024 * 1024
+# Mode of relay socket, only relay's user may send items by default
+RELAY_SOCKET_MODE = 0o600
+
+class _RelayRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        data = b''
+        request = None
+        try:
+            while request is None:
+                _buffer = self.request.recv(4096)
+                if not _buffer:
+                    return
+                data += _buffer
+                size = packet_size(data)
+                if size is not None and size > RELAY_MAX_REQUEST_SIZE:
+                    return
+                request = unpack(data)
+        except ValueError:
+            return
+        answer = self.server.relay._answer(request[0])
+        if answer is not None:
+            self.request.sendall(pack(json.dumps(answer).encode('utf-8')))
+
+class _ThreadingUnixStreamServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    # Many probes may connect at once, UNIX sockets refuse extra connections
+    request_queue_size = socket.SOMAXCONN
+
+class Relay(object):
+    """
+    Relay items received on a UNIX socket to Zabbix Server
+
+    :socket_path: UNIX socket probes send items to
+    :config: ZabbixAgentConfig used to send items upstream
+    :flush_interval: maximum seconds items wait before being forwarded
+    :max_queue: maximum number of items waiting, extra items are refused
+    :logger: logging instance
+    :socket_mode: permissions of UNIX socket
+    """
+
+    def __init__(self, socket_path=RELAY_SOCKET, config=None,
+                 flush_interval=RELAY_FLUSH_INTERVAL, max_queue=RELAY_MAX_QUEUE,
+                 logger=None, socket_mode=RELAY_SOCKET_MODE):
+        if config is None:
+            config = ZabbixAgentConfig()
+        self.socket_path = socket_path
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.socket_mode = socket_mode
+        self._logger = logger
+        self._container = DataContainer(config, logger)
+        self._condition = threading.Condition()
+        self._queue = []
+        self._first_queued = None
+        self._stopping = False
+        self._server = None
+        self._threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def metrics(self):
+        """
+        Returns SenderMetrics of items forwarded upstream
+        """
+        return self._container.metrics
+
+    def start(self):
+        # Socket left by a previous run
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        # Nobody may connect before socket_mode is set
+        umask = os.umask(0o177)
+        try:
+            self._server = _ThreadingUnixStreamServer(
+                self.socket_path, _RelayRequestHandler
+            )
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, self.socket_mode)
+        self._server.relay = self
+        self._stopping = False
+        self._threads = [
+            threading.Thread(target=self._server.serve_forever, args=(0.05,)),
+            threading.Thread(target=self._forward_loop),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        if self._logger: # pragma: no cover
+            self._logger.info("Relay listening on %s", self.socket_path)
+
+    def stop(self):
+        """
+        Stop accepting items & forward queued ones
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        for thread in self._threads:
+            thread.join()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _answer(self, body):
+        """
+        Process a probe's request & returns answer as a dict
+        None closes connection without answering
+        """
+        start = default_timer()
+        try:
+            if not isinstance(body, str):
+                body = body.decode('utf-8')
+            request = json.loads(body)
+        except ValueError:
+            return None
+        if request.get('request') != 'sender data':
+            return {'response': 'failed', 'info': 'unsupported request'}
+        items = request.get('data') or []
+        if self._enqueue(items):
+            processed, failed = len(items), 0
+        else:
+            processed, failed = 0, len(items)
+        return {
+            'response': 'success',
+            'info': ZBX_RESP_INFO % (
+                processed, failed, len(items), default_timer() - start
+            )
+        }
+
+    def _enqueue(self, items):
+        """
+        Queue items to be forwarded
+        Returns False if queue is full
+        """
+        with self._condition:
+            if len(self._queue) + len(items) > self.max_queue:
+                if self._logger: # pragma: no cover
+                    self._logger.warning("Queue is full, refused %d items", len(items))
+                return False
+            if not self._queue:
+                self._first_queued = default_timer()
+            self._queue.extend(items)
+            if len(self._queue) >= ZBX_TRAPPER_MAX_VALUE:
+                self._condition.notify()
+        return True
+
+    def _forward_loop(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopping:
+                    self._condition.wait(self.flush_interval)
+                # Wait for a full chunk, or for oldest item to be late
+                while self._queue and not self._stopping and \
+                      len(self._queue) < ZBX_TRAPPER_MAX_VALUE:
+                    remaining = self._first_queued + self.flush_interval - default_timer()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                items, self._queue = self._queue, []
+                stopping = self._stopping
+            if items:
+                self._forward(items)
+            elif stopping:
+                return
+
+    def _forward(self, items):
+        """
+        Send items to Zabbix Server
+        Items of failed sends are lost, like with probes sending directly
+        Any error is logged so that forward loop keeps running
+        """
+        try:
+            for item in items:
+                # Discovery payloads are already serialized by probes
+                self._container.add_item(
+                    item.get('host'), item.get('key'), item.get('value'),
+                    item.get('clock'), item.get('state', 0), data_type='items'
+                )
+            self._container.send()
+        except (socket.error, ZabbixProtocolError) as e:
+            if self._logger: # pragma: no cover
+                self._logger.error("Unable to forward %d items: %s", len(items), e)
+        except Exception as e:
+            # Next batch mustn't carry items of this one
+            self._container._reset()
+            if self._logger: # pragma: no cover
+                self._logger.exception(
+                    "Dropped %d items, forwarding failed [%s]", len(items), e
+                )
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Relay items of local probes to Zabbix Server'
+    )
+    parser.add_argument(
+        '-s', '--socket', default=RELAY_SOCKET,
+        help="UNIX socket probes send items to. Default is %s" % RELAY_SOCKET
+    )
+    parser.add_argument(
+        '-c', '--config', dest='config_file',
+        help="Zabbix agent config file used to send items upstream"
+    )
+    parser.add_argument(
+        '--flush-interval', type=float, default=RELAY_FLUSH_INTERVAL,
+        help="Maximum seconds items wait before being forwarded. "
+             "Default is %s" % RELAY_FLUSH_INTERVAL
+    )
+    parser.add_argument(
+        '--max-queue', type=int, default=RELAY_MAX_QUEUE,
+        help="Maximum number of items waiting to be forwarded. "
+             "Default is %d" % RELAY_MAX_QUEUE
+    )
+    parser.add_argument(
+        '--socket-mode', type=lambda mode: int(mode, 8), default=RELAY_SOCKET_MODE,
+        help="Octal permissions of UNIX socket, 0660 lets probes of socket's "
+             "group send items. Default is %04o" % RELAY_SOCKET_MODE
+    )
+    parser.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="Enable verbose mode. Is potentially repeatable."
+    )
+    return parser.parse_args(args)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    options = _parse_args(args)
+    logger = logging.getLogger('ProtobixRelay')
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(max(logging.DEBUG, logging.WARNING - 10 * options.verbose))
+    relay = Relay(
+        options.socket, ZabbixAgentConfig(options.config_file, logger),
+        options.flush_interval, options.max_queue, logger, options.socket_mode
+    )
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    relay.start()
+    try:
+        while not stopped.is_set():
+            stopped.wait(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.stop()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
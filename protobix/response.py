@@ -0,0 +1,98 @@
+"""
+Zabbix Server answers parsing
+
+Counters are read from structured fields when Zabbix provides them,
+otherwise from the info string, which format depends on Zabbix version:
+* <= 2.0: Processed 0 Failed 1 Total 1 Seconds spent 0.000057
+* >= 2.2: processed: 50; failed: 1000; total: 1050; seconds spent: 0.09957
+"""
+import re
+try: import simplejson as json
+except ImportError: import json # pragma: no cover
+
+ZBX_RESP_REGEX = r'[Pp]rocessed:? (\d+);? [Ff]ailed:? (\d+);? ' + \
+                 r'[Tt]otal:? (\d+);? [Ss]econds spent:? (\d+\.\d+)'
+ZBX_RESP_PATTERN = re.compile(ZBX_RESP_REGEX)
+ZBX_RESP_FIELDS = ('processed', 'failed', 'total')
+
+class ZabbixProtocolError(ValueError):
+    """
+    Zabbix Server answer doesn't follow Zabbix protocol
+    """
+
+class ZabbixResponseError(ZabbixProtocolError):
+    """
+    Zabbix Server answer can't be parsed
+    """
+
+class SenderResponse(object):
+    """
+    Parsed Zabbix Server answer
+
+    :response: 'success' or 'failed'
+    :processed: number of items processed
+    :failed: number of items failed
+    :total: number of items received
+    :seconds: time spent by Zabbix Server
+    :errors: list of (index, error) for failed items when Zabbix details them
+    """
+    __slots__ = ('response', 'processed', 'failed', 'total', 'seconds', 'errors')
+
+    def __init__(self, response, processed, failed, total, seconds, errors=None):
+        self.response = response
+        self.processed = processed
+        self.failed = failed
+        self.total = total
+        self.seconds = seconds
+        self.errors = errors or []
+
+    def as_tuple(self):
+        """
+        Returns (response, processed, failed, total, seconds)
+        """
+        return self.response, self.processed, self.failed, self.total, self.seconds
+
+def parse_response(body):
+    """
+    Parse Zabbix Server answer body
+    Returns a SenderResponse
+
+    :body: answer body as string
+    """
+    try:
+        answer = json.loads(body)
+    except ValueError:
+        raise ZabbixResponseError('Invalid JSON in Zabbix answer')
+    if not isinstance(answer, dict):
+        raise ZabbixResponseError('Invalid JSON in Zabbix answer')
+    response = answer.get('response')
+
+    # Per item results, in the same order as sent items
+    errors = []
+    data = answer.get('data')
+    if isinstance(data, list):
+        errors = [
+            (index, result['error']) for index, result in enumerate(data)
+            if isinstance(result, dict) and 'error' in result
+        ]
+
+    # Structured counters
+    if all(isinstance(answer.get(field), int) for field in ZBX_RESP_FIELDS):
+        seconds = answer.get('seconds spent', answer.get('seconds_spent', 0))
+        return SenderResponse(
+            response, answer['processed'], answer['failed'], answer['total'],
+            float(seconds), errors
+        )
+
+    info = answer.get('info')
+    if info is None and isinstance(data, list):
+        return SenderResponse(
+            response, len(data) - len(errors), len(errors), len(data), 0.0, errors
+        )
+    match = ZBX_RESP_PATTERN.search(info or '')
+    if match is None:
+        raise ZabbixResponseError('Unable to parse Zabbix answer: %s' % info)
+    processed, failed, total, seconds = match.groups()
+    return SenderResponse(
+        response, int(processed), int(failed), int(total), float(seconds), errors
+    )
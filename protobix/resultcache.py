@@ -0,0 +1,89 @@
+"""
+Probe results shared by concurrent runs
+
+First run collecting a result holds a file lock, so that runs starting
+meanwhile wait for it & reuse its result instead of hitting the monitored
+service again. Results are reused until they are ttl seconds old
+"""
+import os
+import tempfile
+import time
+try: import simplejson as json
+except ImportError: import json # pragma: no cover
+try: import fcntl
+except ImportError: fcntl = None # pragma: no cover
+
+def default_directory():
+    """
+    Returns /dev/shm when available so that results stay in memory,
+    temporary directory otherwise
+    """
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+class ResultCache(object):
+    """
+    TTL-bound results stored as JSON files, protected by file locks
+
+    :directory: where results & lock files are written
+    :prefix: results file names prefix, unique per probe & options
+    :ttl: seconds during which a result is reused
+    """
+
+    def __init__(self, directory, prefix, ttl):
+        self.directory = directory
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def path(self, name):
+        return os.path.join(self.directory, '%s-%s.json' % (self.prefix, name))
+
+    def _read(self, path, now):
+        """
+        Returns (True, result) if a fresh result exists, (False, None) otherwise
+        """
+        try:
+            with open(path) as result_file:
+                cached = json.load(result_file)
+            if now - cached['clock'] < self.ttl:
+                return True, cached['data']
+        except (IOError, OSError, ValueError, TypeError, KeyError):
+            pass
+        return False, None
+
+    def _write(self, path, data, now):
+        # Readers don't lock, result is replaced atomically
+        tmp_file = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_file, 'w') as result_file:
+            json.dump({'clock': now, 'data': data}, result_file)
+        os.rename(tmp_file, path)
+
+    def get(self, name, collect):
+        """
+        Returns a fresh result, calling collect only if none exists
+        Concurrent calls wait for the one collecting
+        None results aren't cached, collect's exceptions are raised
+
+        :name: result name, like items or lld
+        :collect: function returning a JSON serializable result
+        """
+        path = self.path(name)
+        found, data = self._read(path, time.time())
+        if found:
+            return data
+        with open(path + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Another run may have collected it while we were waiting
+                found, data = self._read(path, time.time())
+                if found:
+                    return data
+                data = collect()
+                if data is not None:
+                    self._write(path, data, time.time())
+                return data
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,249 @@
+"""
+Route items to Zabbix Servers or proxies according to their host
+
+Hosts are matched against explicit rules first, by prefix or regular
+expression, then spread over proxies with consistent hashing, so that
+adding or removing a proxy only moves a fraction of hosts
+"""
+import bisect
+import copy
+import hashlib
+import re
+import threading
+try: import queue
+except ImportError: import Queue as queue # pragma: no cover
+
+from .datacontainer import DataContainer
+from .zabbixagentconfig import ZabbixAgentConfig
+
+ZBX_DEFAULT_PORT = 10051
+# Points per proxy on the hash ring, more points spread hosts more evenly
+ROUTING_REPLICAS = 100
+
+def parse_destination(destination):
+    """
+    Returns (server, port) from "server[:port]"
+    """
+    if ':' in destination:
+        server, port = destination.rsplit(':', 1)
+        return server, int(port)
+    return destination, ZBX_DEFAULT_PORT
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+class RoutingTable(object):
+    """
+    Map hosts to "server[:port]" destinations
+
+    :default: destination of hosts matching no rule when there is no proxy,
+              None uses sender's configuration
+    :proxies: destinations hosts matching no rule are spread over
+    :replicas: points per proxy on the hash ring
+    """
+
+    def __init__(self, default=None, proxies=(), replicas=ROUTING_REPLICAS):
+        self.default = default
+        self.replicas = replicas
+        # [(prefix, regex, destination)], first matching rule wins
+        self._rules = []
+        self._ring = []
+        self._ring_destinations = []
+        self._proxies = []
+        # {host: destination}, hosts are routed once
+        self._routes = {}
+        for proxy in proxies:
+            self.add_proxy(proxy)
+
+    def add_rule(self, destination, prefix=None, regex=None):
+        """
+        Route hosts starting with prefix, or matching regex, to destination
+        Rules are tried in the order they were added
+        """
+        if (prefix is None) == (regex is None):
+            raise ValueError('Rule requires either prefix or regex')
+        if regex is not None:
+            regex = re.compile(regex)
+        self._rules.append((prefix, regex, destination))
+        self._routes = {}
+
+    def add_proxy(self, destination):
+        """
+        Add destination to the hash ring
+        """
+        if destination in self._proxies:
+            return
+        self._proxies.append(destination)
+        for replica in range(self.replicas):
+            point = _hash('%s-%d' % (destination, replica))
+            index = bisect.bisect(self._ring, point)
+            self._ring.insert(index, point)
+            self._ring_destinations.insert(index, destination)
+        self._routes = {}
+
+    def remove_proxy(self, destination):
+        """
+        Remove destination from the hash ring
+        Only its hosts are routed to other proxies
+        """
+        if destination not in self._proxies:
+            return
+        self._proxies.remove(destination)
+        kept = [
+            (point, proxy)
+            for point, proxy in zip(self._ring, self._ring_destinations)
+            if proxy != destination
+        ]
+        self._ring = [point for point, proxy in kept]
+        self._ring_destinations = [proxy for point, proxy in kept]
+        self._routes = {}
+
+    @property
+    def proxies(self):
+        return list(self._proxies)
+
+    def route(self, host):
+        """
+        Returns host's destination, None for sender's configuration
+        """
+        try:
+            return self._routes[host]
+        except KeyError:
+            pass
+        destination = self._match(host)
+        self._routes[host] = destination
+        return destination
+
+    def _match(self, host):
+        for prefix, regex, destination in self._rules:
+            if prefix is not None and host.startswith(prefix):
+                return destination
+            if regex is not None and regex.match(host):
+                return destination
+        if not self._ring:
+            return self.default
+        index = bisect.bisect(self._ring, _hash(host)) % len(self._ring)
+        return self._ring_destinations[index]
+
+class RoutedSender(object):
+    """
+    Send items to the destination of their host
+    Each destination has its own DataContainer, kept between sends along
+    with its value caches, item filter & metrics
+    Destinations are sent to concurrently
+
+    :routing: RoutingTable
+    :config: ZabbixAgentConfig used for every destination but server & port
+    :workers: maximum number of destinations sent to concurrently
+    :logger: logging instance
+    """
+
+    def __init__(self, routing, config=None, workers=8, logger=None):
+        if config is None:
+            config = ZabbixAgentConfig()
+        self.routing = routing
+        self._config = config
+        self.workers = workers
+        self._logger = logger
+        # {destination: DataContainer}
+        self._containers = {}
+        # {destination: exception} of last send
+        self.errors = {}
+
+    @property
+    def data_type(self):
+        return self._config.data_type
+
+    @data_type.setter
+    def data_type(self, value):
+        self._config.data_type = value
+        for container in self._containers.values():
+            container.data_type = value
+
+    @property
+    def containers(self):
+        """
+        Returns {destination: DataContainer}, None being sender's configuration
+        """
+        return dict(self._containers)
+
+    def _container(self, destination):
+        container = self._containers.get(destination)
+        if container is None:
+            config = self._config
+            if destination is not None:
+                config = copy.copy(self._config)
+                config.config = dict(self._config.config)
+                server, port = parse_destination(destination)
+                config.server_active = server
+                config.server_port = port
+            container = self._containers[destination] = DataContainer(
+                config, self._logger
+            )
+        return container
+
+    def add_item(self, host, key, value, clock=None, state=0, data_type=None):
+        """
+        Add a single item into its destination's DataContainer
+        See DataContainer.add_item
+        """
+        self._container(self.routing.route(host)).add_item(
+            host, key, value, clock, state, data_type
+        )
+
+    def add(self, data, data_type=None):
+        """
+        Add items of each host into its destination's DataContainer
+
+        :data: dict of items & value per hostname
+        :data_type: "items" or "lld", overrides sender's data_type
+        """
+        for host in data:
+            self._container(self.routing.route(host)).add(
+                {host: data[host]}, data_type
+            )
+
+    def send(self):
+        """
+        Send items to all destinations concurrently, then reset data_type
+        Returns {destination: DataContainer.send result} of destinations
+        which succeeded. Failed ones are in errors, first error is raised
+        once all destinations were sent to
+        """
+        pending = queue.Queue()
+        for destination, container in self._containers.items():
+            if container.items_list:
+                pending.put(destination)
+        results = {}
+        errors = {}
+
+        def worker():
+            while True:
+                try:
+                    destination = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[destination] = self._containers[destination].send()
+                except Exception as e:
+                    errors[destination] = e
+                    if self._logger: # pragma: no cover
+                        self._logger.error(
+                            "Sending to %s failed [%s]",
+                            destination or self._config.server_active, e
+                        )
+
+        threads = [
+            threading.Thread(target=worker)
+            for _ in range(min(max(1, self.workers), pending.qsize()))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.errors = errors
+        # Like DataContainer, data_type has to be set again before next adds
+        self._config.data_type = None
+        if errors:
+            raise list(errors.values())[0]
+        return results
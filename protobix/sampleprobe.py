@@ -1,13 +1,44 @@
-import argparse
-from argparse import RawTextHelpFormatter
+import hashlib
+import os
+import signal
 import socket
 import sys
+import threading
+import time
 import traceback
 import logging
-from logging import handlers
+try: import queue
+except ImportError: import Queue as queue # pragma: no cover
+try: import simplejson as json
+except ImportError: import json # pragma: no cover
 
 from .datacontainer import DataContainer
 from .zabbixagentconfig import ZabbixAgentConfig
+from .resultcache import ResultCache, default_directory
+from .profiling import RunProfile, NO_STEP
+
+# Maximum seconds a detached send may last
+ZBX_DETACH_TIMEOUT = 300
+# Seconds between two collections of values served by passive agent
+# Kept here since passive agent module loads asyncio & ssl
+ZBX_PASSIVE_REFRESH = 60
+# Options which don't change collected data, ignored in result cache key
+RESULT_CACHE_IGNORED_OPTIONS = (
+    'probe_mode', 'update', 'discovery', 'dryrun', 'debug_level',
+    'detach', 'detach_timeout', 'diagnose', 'result_cache', 'result_cache_dir',
+    'profile', 'profile_dir', 'profile_items',
+)
+
+class _MetricsCollector(object):
+    """
+    Gathers items collected by SampleProbe._collect_metrics into a dict
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def add(self, data):
+        self.data.update(data)
 
 class SampleProbe(object):
 
@@ -25,12 +56,19 @@ class SampleProbe(object):
     probe_config = None
     hostname = None
     options = None
+    # RunProfile of last run, when profiling is enabled
+    run_profile = None
+    # Set by Zygote once _init_probe ran, so that forked probes skip it
+    _probe_initialized = False
 
     def _parse_args(self, args):
         if self.logger:
             self.logger.info(
                 "Read command line options"
             )
+        # argparse is imported here to keep protobix import cheap
+        import argparse
+        from argparse import RawTextHelpFormatter
         # Parse the script arguments
         parser = argparse.ArgumentParser(
             usage='%(prog)s [options]',
@@ -57,8 +95,7 @@ class SampleProbe(object):
         common.add_argument(
             '-v', action='count', dest='debug_level',
             help="Enable verbose mode. Is used to setup logging level.\n"
-                 "Specifying 4 or more 'v' (-vvvv) enables Debug. Items are then\n"
-                 "sent one after the other instead of bulk"
+                 "Specifying 4 or more 'v' (-vvvv) enables Debug."
         )
         # Protobix specific options
         protobix = parser.add_argument_group('Protobix specific options')
@@ -129,6 +166,106 @@ class SampleProbe(object):
             '--tls-psk-file',
             help="Full pathname of a file containing the pre-shared key."
         )
+        protobix.add_argument(
+            '--workers', type=int, default=8,
+            help="Maximum number of hosts polled concurrently when the probe\n"
+                 "implements _list_hosts & _get_metrics_for. Default is 8."
+        )
+        protobix.add_argument(
+            '--host-timeout', type=int,
+            help="Maximum number of seconds spent collecting a single host.\n"
+                 "Defaults to Timeout parameter from agentd configuration."
+        )
+        protobix.add_argument(
+            '--discard-unchanged', type=int, metavar='HEARTBEAT',
+            help="Do not send items whose value didn't change, unless\n"
+                 "HEARTBEAT seconds elapsed since it was last sent."
+        )
+        protobix.add_argument(
+            '--value-cache-file',
+            help="Full pathname of a file where last sent values are kept\n"
+                 "between probe runs. Used with --discard-unchanged."
+        )
+        protobix.add_argument(
+            '--lld-refresh', type=int, metavar='SECONDS',
+            help="Do not send discovery identical to the one sent less\n"
+                 "than SECONDS ago."
+        )
+        protobix.add_argument(
+            '--lld-cache-file',
+            help="Full pathname of a file where sent discovery fingerprints\n"
+                 "are kept between probe runs. Used with --lld-refresh."
+        )
+        protobix.add_argument(
+            '--item-filter-ttl', type=int, metavar='SECONDS',
+            help="Do not send again during SECONDS items Zabbix rejected.\n"
+                 "Rejected items are known with --diagnose, or when Zabbix\n"
+                 "details per item errors. Use --item-filter-file to keep\n"
+                 "them between probe runs."
+        )
+        protobix.add_argument(
+            '--item-filter-file',
+            help="Full pathname of a file where items Zabbix rejected are\n"
+                 "kept between probe runs. Used with --item-filter-ttl."
+        )
+        protobix.add_argument(
+            '--relay-socket',
+            help="Send items to protobix-relay listening on this UNIX\n"
+                 "socket instead of Zabbix Server."
+        )
+        protobix.add_argument(
+            '--passive-port', type=int, metavar='PORT',
+            help="Do not send anything, but serve values as a passive\n"
+                 "Zabbix agent listening on PORT, usually 10050."
+        )
+        protobix.add_argument(
+            '--passive-refresh', type=int, metavar='SECONDS',
+            default=ZBX_PASSIVE_REFRESH,
+            help="Seconds between two collections of values served with\n"
+                 "--passive-port. Default is %d." % ZBX_PASSIVE_REFRESH
+        )
+        protobix.add_argument(
+            '--detach', action='store_true',
+            help="Return as soon as data is collected, and send it from\n"
+                 "a background process."
+        )
+        protobix.add_argument(
+            '--detach-timeout', type=int, metavar='SECONDS',
+            default=ZBX_DETACH_TIMEOUT,
+            help="Maximum number of seconds spent sending data in\n"
+                 "background with --detach. Default is %d." % ZBX_DETACH_TIMEOUT
+        )
+        protobix.add_argument(
+            '--result-cache', type=int, metavar='SECONDS',
+            help="Share collected data with runs starting within SECONDS,\n"
+                 "so that concurrent runs only hit monitored service once."
+        )
+        protobix.add_argument(
+            '--result-cache-dir', metavar='DIR',
+            help="Directory where shared data is kept with --result-cache.\n"
+                 "Default is /dev/shm when available."
+        )
+        protobix.add_argument(
+            '--diagnose', action='store_true',
+            help="Find out which items Zabbix rejected by sending again\n"
+                 "halves of chunks with failed items. Items Zabbix accepted\n"
+                 "in those halves are stored twice."
+        )
+        protobix.add_argument(
+            '--profile', action='store_true',
+            help="Record wall time, CPU time & net allocated memory blocks of\n"
+                 "each step & send phase. Logged at info level."
+        )
+        protobix.add_argument(
+            '--profile-dir', metavar='DIR',
+            help="Also run cProfile & tracemalloc, write their reports\n"
+                 "into DIR. Implies --profile."
+        )
+        protobix.add_argument(
+            '--profile-items', action='store_true',
+            help="Also send profile to Zabbix as protobix.profile.step[*]\n"
+                 "& protobix.profile.phase[*] items. Implies --profile."
+        )
         # Probe specific options
         parser = self._parse_probe_args(parser)
         # Analyze provided command line options
@@ -178,10 +315,11 @@ class SampleProbe(object):
             file_handler.setFormatter(log_formatter)
             self.logger.addHandler(file_handler)
         if log_type == 'system':
+            from logging import handlers
             # TODO: manage syslog address as command line option
-            syslog_handler = logging.handlers.SysLogHandler(
+            syslog_handler = handlers.SysLogHandler(
                 address=('localhost', 514),
-                facility=logging.handlers.SysLogHandler.LOG_DAEMON
+                facility=handlers.SysLogHandler.LOG_DAEMON
             )
             # Use same date format as Zabbix does: when logging into
             # zabbix_agentd log file, it's easier to read & parse
@@ -245,6 +383,30 @@ class SampleProbe(object):
             self.options.debug_level = min(4, self.options.debug_level)
             zbx_config.debug_level = self.options.debug_level
 
+        if self.options.discard_unchanged:
+            zbx_config.discard_unchanged = self.options.discard_unchanged
+
+        if self.options.value_cache_file:
+            zbx_config.value_cache_file = self.options.value_cache_file
+
+        if self.options.lld_refresh:
+            zbx_config.lld_refresh = self.options.lld_refresh
+
+        if self.options.lld_cache_file:
+            zbx_config.lld_cache_file = self.options.lld_cache_file
+
+        if self.options.item_filter_ttl:
+            zbx_config.item_filter_ttl = self.options.item_filter_ttl
+
+        if self.options.item_filter_file:
+            zbx_config.item_filter_file = self.options.item_filter_file
+
+        if self.options.relay_socket:
+            zbx_config.relay_socket = self.options.relay_socket
+
+        if self.options.diagnose:
+            zbx_config.diagnose = True
+
         zbx_config.dryrun = False
         if self.options.dryrun:
             zbx_config.dryrun = self.options.dryrun
@@ -259,6 +421,31 @@ class SampleProbe(object):
         # mandatory method
         raise NotImplementedError
 
+    def _get_raw_data(self):
+        # non mandatory method
+        # Return data both items & discovery are built from,
+        # with _get_metrics_from & _get_discovery_from
+        return None
+
+    def _get_metrics_from(self, raw_data):
+        # mandatory method if _get_raw_data is implemented
+        raise NotImplementedError
+
+    def _get_discovery_from(self, raw_data):
+        # mandatory method if _get_raw_data is implemented
+        raise NotImplementedError
+
+    def _list_hosts(self):
+        # non mandatory method
+        # Return a list of hostnames to collect metrics concurrently
+        # with _get_metrics_for instead of calling _get_metrics
+        return None
+
+    def _get_metrics_for(self, host):
+        # mandatory method if _list_hosts is implemented
+        # Returns a dict of items for a single host: {key: value}
+        raise NotImplementedError
+
     def _init_probe(self):
         # non mandatory method
         pass
@@ -267,7 +454,228 @@ class SampleProbe(object):
         # non mandatory method
         return parser
 
-    def run(self, options=None):
+    def _collect_metrics(self, hosts, zbx_container):
+        """
+        Collect metrics for each host with a bounded pool of threads
+        Each host's items are added into zbx_container as soon as they arrive
+        A host failing or exceeding host_timeout is logged & skipped
+
+        :hosts: list of hostnames as returned by _list_hosts
+        :zbx_container: DataContainer to fill
+        """
+        host_timeout = self.options.host_timeout or self.zbx_config.timeout
+        pending = queue.Queue()
+        results = queue.Queue()
+        # Hosts being collected & their start time, hosts which timed out
+        # Both are shared with workers under lock
+        lock = threading.Lock()
+        started = {}
+        timed_out = set()
+        remaining = set()
+        for host in hosts:
+            if host not in remaining:
+                remaining.add(host)
+                pending.put(host)
+
+        def worker():
+            while True:
+                try:
+                    host = pending.get_nowait()
+                except queue.Empty:
+                    return
+                with lock:
+                    started[host] = time.time()
+                try:
+                    results.put((host, self._get_metrics_for(host), None))
+                except Exception as e:
+                    results.put((host, None, e))
+                with lock:
+                    del started[host]
+                    # A replacement worker took over, pool size is kept
+                    if host in timed_out:
+                        return
+
+        def start_worker():
+            # Threads stuck on a timed out host can't be killed
+            # They're daemonized so that they won't block probe exit
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        for _ in range(min(max(1, self.options.workers), len(remaining))):
+            start_worker()
+
+        while remaining:
+            try:
+                host, metrics, error = results.get(timeout=0.1)
+            except queue.Empty:
+                host = None
+            if host in remaining:
+                remaining.discard(host)
+                self._add_host_metrics(zbx_container, host, metrics, error)
+            # Results of other hosts mustn't delay finding stuck ones
+            now = time.time()
+            with lock:
+                for host, start in list(started.items()):
+                    if host in remaining and now - start > host_timeout:
+                        remaining.discard(host)
+                        timed_out.add(host)
+                        if self.logger:
+                            self.logger.error(
+                                "Collecting host %s timed out after %ds" %
+                                (host, host_timeout)
+                            )
+                        # Replace the stuck worker so that pool size is kept
+                        start_worker()
+
+    def _add_host_metrics(self, zbx_container, host, metrics, error):
+        """
+        Add a host's items into zbx_container
+        A failing host is logged & skipped without affecting others
+        """
+        if error is None and not isinstance(metrics, dict):
+            error = ValueError('Expected a dict of items, got %s' % type(metrics).__name__)
+        if error is None:
+            try:
+                zbx_container.add({host: metrics})
+                return
+            except Exception as e:
+                error = e
+        if self.logger:
+            self.logger.error(
+                "Collecting host %s failed [%s]" % (host, str(error))
+            )
+
+    def _result_cache(self):
+        """
+        Returns ResultCache shared by runs of this probe with same options
+        """
+        options = dict(
+            (name, value) for name, value in vars(self.options).items()
+            if name not in RESULT_CACHE_IGNORED_OPTIONS
+        )
+        key = hashlib.sha1(
+            json.dumps(options, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()[:12]
+        return ResultCache(
+            self.options.result_cache_dir or default_directory(),
+            'protobix-%s-%s' % (self.__class__.__name__, key),
+            self.options.result_cache
+        )
+
+    def _cached(self, name, collect):
+        """
+        Returns collect() result, shared with concurrent runs
+        when result cache is enabled
+        """
+        if not self.options.result_cache:
+            return collect()
+        return self._result_cache().get(name, collect)
+
+    def _get_data(self, data_type):
+        """
+        Returns items or discovery to add into DataContainer
+        Both are built from the same raw data if _get_raw_data is implemented
+
+        :data_type: "items" or "lld"
+        """
+        raw_data = self._cached('raw', self._get_raw_data)
+        if raw_data is not None:
+            if data_type == 'items':
+                return self._get_metrics_from(raw_data)
+            return self._get_discovery_from(raw_data)
+        if data_type == 'items':
+            return self._cached('items', self._get_metrics)
+        return self._cached('lld', self._get_discovery)
+
+    def _get_passive_metrics(self):
+        """
+        Returns items served by passive agent, collected like Step 2 does
+        """
+        hosts = self._list_hosts()
+        if hosts is None:
+            return self._get_data('items')
+        collector = _MetricsCollector()
+        self._collect_metrics(hosts, collector)
+        return collector.data
+
+    def _serve_passive(self):
+        """
+        Serve items as a passive agent until stopped
+        """
+        # Passive agent loads asyncio & ssl, only import it when needed
+        from .passiveagent import PassiveAgent
+        agent = PassiveAgent(
+            self._get_passive_metrics, self.hostname,
+            port=self.options.passive_port,
+            refresh=self.options.passive_refresh,
+            logger=self.logger
+        )
+        try:
+            agent.serve_forever()
+        except Exception as e:
+            if self.logger:
+                self.logger.critical(
+                    "Passive agent failed [%s]" % str(e)
+                )
+                self.logger.debug(traceback.format_exc())
+            return 2
+        return 0
+
+    def _step(self, name):
+        """
+        Returns a context recording step in run profile
+        """
+        if self.run_profile is None:
+            return NO_STEP
+        return self.run_profile.step(name)
+
+    def _start_profile(self, profile):
+        self.run_profile = None
+        options = self.options
+        if profile or options.profile or options.profile_dir or \
+           options.profile_items:
+            self.run_profile = RunProfile(options.profile_dir)
+            self.run_profile.start()
+
+    def _finish_profile(self, code, send_items=True):
+        """
+        Log profile, write reports & send profile items
+        Returns probe's exit code unchanged
+        """
+        run_profile = self.run_profile
+        if run_profile is None:
+            return code
+        try:
+            files = run_profile.stop()
+            if self.logger:
+                self.logger.info("Run profile:\n%s" % run_profile.report())
+                for profile_file in files:
+                    self.logger.info("Profile written to %s" % profile_file)
+            if self.options.profile_items and send_items and code != 4:
+                zbx_container = DataContainer(
+                    config=self.zbx_config,
+                    logger=self.logger
+                )
+                zbx_container.data_type = 'items'
+                zbx_container.add({self.hostname: run_profile.items()})
+                zbx_container.send()
+        except Exception as e:
+            # Probe's outcome doesn't depend on profiling
+            if self.logger:
+                self.logger.error(
+                    "Profiling failed [%s]" % str(e)
+                )
+                self.logger.debug(traceback.format_exc())
+        return code
+
+    def run(self, options=None, profile=False):
+        """
+        Run probe & returns its exit code
+
+        :options: command line options list, defaults to sys.argv
+        :profile: profile run like --profile does
+        """
         # Init logging with default values since we don't have real config yet
         self._init_logging()
 
@@ -276,52 +684,70 @@ class SampleProbe(object):
         if isinstance(options, list):
             args = options
         self.options = self._parse_args(args)
+        self._start_profile(profile)
 
-        # Get configuration
-        self.zbx_config = self._init_config()
+        with self._step('init'):
+            # Get configuration
+            self.zbx_config = self._init_config()
 
-        # Update logger with configuration
-        self._setup_logging(
-            self.zbx_config.log_type,
-            self.zbx_config.debug_level,
-            self.zbx_config.log_file
-        )
+            # Update logger with configuration
+            self._setup_logging(
+                self.zbx_config.log_type,
+                self.zbx_config.debug_level,
+                self.zbx_config.log_file
+            )
 
-        # Datacontainer init
-        zbx_container = DataContainer(
-            config = self.zbx_config,
-            logger=self.logger
-        )
-        # Get back hostname from ZabbixAgentConfig
-        self.hostname = self.zbx_config.hostname
+            # Datacontainer init
+            zbx_container = DataContainer(
+                config = self.zbx_config,
+                logger=self.logger
+            )
+            if self.run_profile is not None:
+                zbx_container.tracer = self.run_profile
+            # Get back hostname from ZabbixAgentConfig
+            self.hostname = self.zbx_config.hostname
+
+            # Step 1: read probe configuration
+            #         initialize any needed object or connection
+            init_failed = False
+            try:
+                if not self._probe_initialized:
+                    self._init_probe()
+            except:
+                if self.logger:
+                    self.logger.critical(
+                        "Step 1 - Read probe configuration failed"
+                    )
+                self.logger.debug(traceback.format_exc())
+                init_failed = True
+        if init_failed:
+            return self._finish_profile(1)
 
-        # Step 1: read probe configuration
-        #         initialize any needed object or connection
-        try:
-            self._init_probe()
-        except:
-            if self.logger:
-                self.logger.critical(
-                    "Step 1 - Read probe configuration failed"
-                )
-            self.logger.debug(traceback.format_exc())
-            return 1
+        # Values are served to Zabbix Server instead of being sent
+        if self.options.passive_port is not None:
+            return self._finish_profile(self._serve_passive(), send_items=False)
 
         # Step 2: get data
         try:
-            data = {}
-            if self.options.probe_mode == "update":
-                zbx_container.data_type = 'items'
-                data = self._get_metrics()
-            elif self.options.probe_mode == "discovery":
-                zbx_container.data_type = 'lld'
-                data = self._get_discovery()
+            with self._step('get_data'):
+                data = {}
+                if self.options.probe_mode == "update":
+                    zbx_container.data_type = 'items'
+                    hosts = self._list_hosts()
+                    if hosts is None:
+                        data = self._get_data('items')
+                    else:
+                        self._collect_metrics(hosts, zbx_container)
+                elif self.options.probe_mode == "discovery":
+                    zbx_container.data_type = 'lld'
+                    data = self._get_data('lld')
         except NotImplementedError as e:
             if self.logger:
                 self.logger.critical(
                     "Step 2 - Get Data failed [%s]" % str(e)
                 )
                 self.logger.debug(traceback.format_exc())
+            self._finish_profile(2, send_items=False)
             raise
         except Exception as e:
             if self.logger:
@@ -329,11 +755,12 @@ class SampleProbe(object):
                     "Step 2 - Get Data failed [%s]" % str(e)
                 )
                 self.logger.debug(traceback.format_exc())
-            return 2
+            return self._finish_profile(2)
 
         # Step 3: add data to container
         try:
-            zbx_container.add(data)
+            with self._step('add'):
+                zbx_container.add(data)
         except Exception as e:
             if self.logger:
                 self.logger.critical(
@@ -341,11 +768,67 @@ class SampleProbe(object):
                 )
                 self.logger.debug(traceback.format_exc())
             zbx_container._reset()
-            return 3
+            return self._finish_profile(3)
 
         # Step 4: send data to Zabbix server
+        # Dry run sends nothing, there is nothing to detach from
+        if self.options.detach and not self.zbx_config.dryrun:
+            if not self._detach():
+                # Detached process profiles whole run, including send
+                return self._finish_profile(0, send_items=False)
+            # Detached process must never go back to caller
+            code = 4
+            try:
+                signal.signal(signal.SIGALRM, self._detach_timeout)
+                signal.alarm(self.options.detach_timeout)
+                code = self._finish_profile(self._send(zbx_container))
+            finally:
+                os._exit(code)
+        return self._finish_profile(self._send(zbx_container))
+
+    def _detach(self):
+        """
+        Double fork so that data is sent by a process Zabbix Agent
+        doesn't wait for
+        Returns True in detached process, False in probe process
+        """
+        pid = os.fork()
+        if pid > 0:
+            # Intermediate process exits right away, don't leave a zombie
+            os.waitpid(pid, 0)
+            return False
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+        # Zabbix Agent reads probe output until it's closed
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        if self.logger:
+            self.logger.info(
+                "Sending data in background process %d" % os.getpid()
+            )
+        return True
+
+    def _detach_timeout(self, signum, frame):
+        """
+        SIGALRM handler of detached process, tells timeout from a crash
+        """
+        if self.logger:
+            self.logger.critical(
+                "Step 4 - Detached send timed out after %ds" %
+                self.options.detach_timeout
+            )
+        os._exit(4)
+
+    def _send(self, zbx_container):
+        """
+        Step 4: send data to Zabbix server
+        Returns probe's exit code
+        """
         try:
-            zbx_container.send()
+            with self._step('send'):
+                zbx_container.send()
         except socket.error as e:
             if self.logger:
                 self.logger.critical(
@@ -1,13 +1,20 @@
-import struct
+import logging
 import sys
 import time
-import re
+from timeit import default_timer
 
 import socket
 try: import simplejson as json
 except ImportError: import json # pragma: no cover
 
 from .zabbixagentconfig import ZabbixAgentConfig
+from .metrics import SenderMetrics
+from .tracing import SenderTracer
+from .response import ZabbixProtocolError, parse_response
+# Kept importable from here for backward compatibility
+from .response import ZBX_RESP_REGEX
+from .ratelimit import RateLimiter
+from .framing import pack, packet_size, unpack, ZBX_HDR_SIZE
 
 if sys.version_info < (3,): # pragma: no cover
     def b(x):
@@ -17,27 +24,45 @@ else: # pragma: no cover
     def b(x):
         return codecs.utf_8_encode(x)[0]
 
-HAVE_DECENT_SSL = False
-if sys.version_info > (2,7,9):
-    import ssl
-    # Zabbix force TLSv1.2 protocol
-    # in src/libs/zbxcrypto/tls.c function zbx_tls_init_child
-    ZBX_TLS_PROTOCOL=ssl.PROTOCOL_TLSv1_2
-    HAVE_DECENT_SSL = True
-
+# ssl module is only imported when TLS is enabled
+# since it's expensive to load & most probes don't need it
+HAVE_DECENT_SSL = sys.version_info > (2,7,9)
+# Zabbix force TLSv1.2 protocol
+# in src/libs/zbxcrypto/tls.c function zbx_tls_init_child
+ZBX_TLS_PROTOCOL_NAME = 'PROTOCOL_TLSv1_2'
+# Framing moved to protobix.framing, kept for backward compatibility
 ZBX_HDR = "ZBXD\1"
-ZBX_HDR_SIZE = 13
-ZBX_RESP_REGEX = r'[Pp]rocessed:? (\d+);? [Ff]ailed:? (\d+);? ' + \
-                 r'[Tt]otal:? (\d+);? [Ss]econds spent:? (\d+\.\d+)'
+
+if sys.version_info < (3, 7): # pragma: no cover
+    # Module __getattr__ requires Python 3.7
+    if HAVE_DECENT_SSL:
+        import ssl
+        ZBX_TLS_PROTOCOL = getattr(ssl, ZBX_TLS_PROTOCOL_NAME)
+else:
+    def __getattr__(name):
+        # ZBX_TLS_PROTOCOL is an ssl constant, ssl is loaded when it's used
+        if name == 'ZBX_TLS_PROTOCOL':
+            import ssl
+            return getattr(ssl, ZBX_TLS_PROTOCOL_NAME)
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name)
+        )
+
+# Maximum payload length written in debug log
+ZBX_DBG_PAYLOAD_SIZE = 1024
 
 class SenderProtocol(object):
 
     REQUEST = "sender data"
     _logger = None
+    _tracer = None
+    _last_response = None
 
     def __init__(self, logger=None):
         self._config = ZabbixAgentConfig()
         self._items_list = []
+        self._metrics = SenderMetrics()
+        self._last_response = None
         self.socket = None
         if logger: # pragma: no cover
             self._logger = logger
@@ -50,8 +75,8 @@ class SenderProtocol(object):
     def server_active(self, value):
         if self._logger: # pragma: no cover
             self._logger.debug(
-                "Replacing server_active  '%s' with '%s'" %
-                (self._config.server_active, value)
+                "Replacing server_active  '%s' with '%s'",
+                self._config.server_active, value
             )
         self._config.server_active = value
 
@@ -63,8 +88,8 @@ class SenderProtocol(object):
     def server_port(self, value):
         if self._logger: # pragma: no cover
             self._logger.debug(
-                "Replacing server_port  '%s' with '%s'" %
-                (self._config.server_port, value)
+                "Replacing server_port  '%s' with '%s'",
+                self._config.server_port, value
             )
         self._config.server_port = value
 
@@ -76,8 +101,8 @@ class SenderProtocol(object):
     def debug_level(self, value):
         if self._logger: # pragma: no cover
             self._logger.debug(
-                "Replacing debug_level  '%s' with '%s'" %
-                (self._config.debug_level, value)
+                "Replacing debug_level  '%s' with '%s'",
+                self._config.debug_level, value
             )
         self._config.debug_level = value
 
@@ -85,11 +110,40 @@ class SenderProtocol(object):
     def items_list(self):
         return self._items_list
 
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def last_response(self):
+        """
+        Returns last SenderResponse received from Zabbix Server
+        """
+        return self._last_response
+
+    @property
+    def tracer(self):
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, value):
+        # None disables tracing
+        if value is None or isinstance(value, SenderTracer):
+            self._tracer = value
+        else:
+            raise ValueError('tracer requires a SenderTracer instance')
+
     @property
     def clock(self):
         return int(time.time())
 
     def _send_to_zabbix(self, item):
+        """
+        Send items to Zabbix Server
+        Returns seconds spent waiting for rate limits
+
+        :item: list of items
+        """
         if self._logger: # pragma: no cover
             self._logger.info(
                 "Send data to Zabbix Server"
@@ -100,69 +154,151 @@ class SenderProtocol(object):
             self._logger.debug(
                 "Building packet to be sent to Zabbix Server"
             )
+        if self._tracer is not None:
+            self._tracer.before('serialize', items=len(item))
+        start = default_timer()
         payload = json.dumps({"data": item,
                               "request": self.REQUEST,
                               "clock": self.clock })
-        if self._logger: # pragma: no cover
-            self._logger.debug('About to send: ' + str(payload))
-        data_length = len(payload)
-        data_header = struct.pack('<Q', data_length)
-        packet = b(ZBX_HDR) + data_header + b(payload)
+        if self._logger and self._logger.isEnabledFor(logging.DEBUG): # pragma: no cover
+            # Payload can be huge, only log its beginning
+            self._logger.debug(
+                'About to send %d bytes: %s%s',
+                len(payload),
+                payload[:ZBX_DBG_PAYLOAD_SIZE],
+                '...' if len(payload) > ZBX_DBG_PAYLOAD_SIZE else ''
+            )
+        packet = self._build_packet(payload)
+        duration = default_timer() - start
+        self._metrics.observe('serialize', duration)
+        if self._tracer is not None:
+            self._tracer.after('serialize', duration, bytes=len(packet))
+        throttle = 0
+        limiter = self._rate_limiter()
+        if limiter is not None:
+            throttle = limiter.acquire(len(item), len(packet))
+            if throttle > 0:
+                if self._logger: # pragma: no cover
+                    self._logger.info(
+                        "Rate limited, waited %f seconds", throttle
+                    )
+                self._metrics.observe('throttle', throttle)
+        zbx_socket = self._socket()
         if self._logger: # pragma: no cover
             self._logger.debug(
                 "Sending packet to Zabbix Server"
             )
         # Send payload to Zabbix Server
-        self._socket().sendall(packet)
+        if self._tracer is not None:
+            self._tracer.before('sendall', bytes=len(packet))
+            start = default_timer()
+        zbx_socket.sendall(packet)
+        self._metrics.inc('bytes_sent', len(packet))
+        if self._tracer is not None:
+            self._tracer.after('sendall', default_timer() - start, bytes=len(packet))
+        return throttle
+
+    def _build_packet(self, payload):
+        """
+        Returns payload with Zabbix header
+        """
+        return pack(b(payload))
+
+    def _rate_limiter(self):
+        """
+        Returns RateLimiter shared with other senders to the same Zabbix Server
+        None if neither rate limits nor backpressure are configured
+        """
+        if not self._config.rate_limit_items and \
+           not self._config.rate_limit_bytes and \
+           self._config.backpressure_threshold is None:
+            return None
+        limiter = RateLimiter.shared(
+            self._config.server_active, self._config.server_port
+        )
+        limiter.configure(
+            self._config.rate_limit_items,
+            self._config.rate_limit_bytes,
+            self._config.backpressure_threshold
+        )
+        return limiter
 
     def _read_from_zabbix(self):
-        recv_length = 4096
+        """
+        Read Zabbix Server answer to sent items
+        Returns result as provided by _handle_response
+        """
+        zbx_srv_resp_body = self._read_packet()
+        # Analyze Zabbix answer
+        if self._tracer is not None:
+            self._tracer.before('handle_response')
+            start = default_timer()
+        response, processed, failed, total, time = self._handle_response(zbx_srv_resp_body)
+        if self._tracer is not None:
+            self._tracer.after(
+                'handle_response', default_timer() - start,
+                response=response, processed=processed, failed=failed, total=total
+            )
+
+        # Return Zabbix Server answer as JSON
+        return response, processed, failed, total, time
+
+    def _read_packet(self):
+        """
+        Read a whole Zabbix answer
+        Returns its body as string
+        """
         zbx_srv_resp_data = b''
+        # Header is needed to know answer's length
+        expected_length = ZBX_HDR_SIZE
 
         # Read Zabbix server answer
         if self._logger: # pragma: no cover
             self._logger.info(
                 "Reading Zabbix Server's answer"
             )
-        while recv_length >= 4096:
+        if self._tracer is not None:
+            self._tracer.before('read_response')
+            start = default_timer()
+        while len(zbx_srv_resp_data) < expected_length:
             _buffer = self._socket().recv(4096)
+            if not _buffer:
+                raise ZabbixProtocolError(
+                    'Connection closed after %d bytes of Zabbix answer' %
+                    len(zbx_srv_resp_data)
+                )
             zbx_srv_resp_data += _buffer
-            recv_length = len(_buffer)
-
-        _buffer = None
-        recv_length = None
-        # Check that we have a valid Zabbix header mark
-        if self._logger: # pragma: no cover
-            self._logger.debug(
-                "Checking Zabbix headers"
+            if expected_length == ZBX_HDR_SIZE and \
+               len(zbx_srv_resp_data) >= ZBX_HDR_SIZE:
+                # Check that we have a valid Zabbix header mark
+                if self._logger: # pragma: no cover
+                    self._logger.debug(
+                        "Checking Zabbix headers"
+                    )
+                # Extract response body length from packet
+                try:
+                    expected_length = packet_size(zbx_srv_resp_data)
+                except ValueError as e:
+                    raise ZabbixProtocolError(str(e))
+        if self._tracer is not None:
+            self._tracer.after(
+                'read_response', default_timer() - start,
+                bytes=len(zbx_srv_resp_data)
             )
-        assert zbx_srv_resp_data[:5] == b(ZBX_HDR)
 
-        # Extract response body length from packet
-        zbx_srv_resp_body_len = struct.unpack('<Q', zbx_srv_resp_data[5:ZBX_HDR_SIZE])[0]
+        # Check that we have read the whole packet
+        if len(zbx_srv_resp_data) > expected_length:
+            raise ZabbixProtocolError('Unexpected data after Zabbix answer')
 
         # Extract response body
         if self._logger: # pragma: no cover
             self._logger.debug(
                 "Extracting answer's body"
             )
-        body_offset=ZBX_HDR_SIZE+zbx_srv_resp_body_len
-        zbx_srv_resp_body = zbx_srv_resp_data[ZBX_HDR_SIZE:body_offset]
-
-        # Check that we have read the whole packet
-        assert zbx_srv_resp_data[body_offset:] == b''
-
-        if self._logger: # pragma: no cover
-            self._logger.debug(
-                "Building JSON object to be analyzed"
-            )
+        zbx_srv_resp_body = unpack(zbx_srv_resp_data)[0]
         if sys.version_info[0] >= 3: # pragma: no cover
             zbx_srv_resp_body = zbx_srv_resp_body.decode()
-        # Analyze Zabbix answer
-        response, processed, failed, total, time = self._handle_response(zbx_srv_resp_body)
-
-        # Return Zabbix Server answer as JSON
-        return response, processed, failed, total, time
+        return zbx_srv_resp_body
 
     def _handle_response(self, zbx_answer):
         """
@@ -172,29 +308,18 @@ class SenderProtocol(object):
         * failed items
         * total items
         * time spent
+        Full answer, including per item errors, is kept in last_response
 
         :zbx_answer: Zabbix server response as string
         """
-        zbx_answer = json.loads(zbx_answer)
         if self._logger: # pragma: no cover
             self._logger.info(
                 "Anaylizing Zabbix Server's answer"
             )
             if zbx_answer:
-                self._logger.debug("Zabbix Server response is: [%s]" % zbx_answer)
-
-        # Default items number in length of th storage list
-        nb_item = len(self._items_list)
-        if self._config.debug_level >= 4:
-            # If debug enabled, force it to 1
-            nb_item = 1
-
-        # If dryrun is disabled, we can process answer
-        response = zbx_answer.get('response')
-        result = re.findall(ZBX_RESP_REGEX, zbx_answer.get('info'))
-        processed, failed, total, time = result[0]
-
-        return response, int(processed), int(failed), int(total), float(time)
+                self._logger.debug("Zabbix Server response is: [%s]", zbx_answer)
+        self._last_response = parse_response(zbx_answer)
+        return self._last_response.as_tuple()
 
     def _socket_reset(self):
         if self.socket:
@@ -220,6 +345,8 @@ class SenderProtocol(object):
                 "Setting socket options"
             )
         socket.setdefaulttimeout(self._config.timeout)
+        if self._config.relay_socket is not None:
+            return self._relay_socket()
         # Connect to Zabbix server or proxy with provided config options
         if self._logger: # pragma: no cover
             self._logger.info(
@@ -228,13 +355,19 @@ class SenderProtocol(object):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         # TLS is enabled, let's set it up
-        if self._config.tls_connect != 'unencrypted' and HAVE_DECENT_SSL is True:
+        tls_enabled = self._config.tls_connect != 'unencrypted' and HAVE_DECENT_SSL is True
+        if tls_enabled:
             if self._logger: # pragma: no cover
                 self._logger.info(
-                    'Configuring TLS to %s' % str(self._config.tls_connect)
+                    'Configuring TLS to %s', self._config.tls_connect
                 )
             # Setup TLS context & Wrap socket
+            if self._tracer is not None:
+                self._tracer.before('tls_wrap')
+                start = default_timer()
             self.socket = self._init_tls()
+            if self._tracer is not None:
+                self._tracer.after('tls_wrap', default_timer() - start)
             if self._logger: # pragma: no cover
                 self._logger.info(
                     'Network socket initialized with TLS support'
@@ -245,9 +378,31 @@ class SenderProtocol(object):
                 'Network socket initialized with no TLS'
             )
         # Connect to Zabbix Server
+        if self._tracer is not None:
+            self._tracer.before(
+                'connect',
+                server=self._config.server_active,
+                port=self._config.server_port
+            )
+        start = default_timer()
         self.socket.connect(
             (self._config.server_active, self._config.server_port)
         )
+        duration = default_timer() - start
+        self._metrics.observe('connect', duration)
+        self._metrics.inc('connections')
+        if self._tracer is not None:
+            self._tracer.after('connect', duration)
+        # TLS handshake is done separately to measure its duration
+        if tls_enabled:
+            if self._tracer is not None:
+                self._tracer.before('tls_handshake')
+            start = default_timer()
+            self.socket.do_handshake()
+            duration = default_timer() - start
+            self._metrics.observe('tls_handshake', duration)
+            if self._tracer is not None:
+                self._tracer.after('tls_handshake', duration)
         #if isinstance(self.socket, ssl.SSLSocket):
         #    server_cert = self.socket.getpeercert()
         #    if self._config.tls_server_cert_issuer:
@@ -267,18 +422,40 @@ class SenderProtocol(object):
 
         return self.socket
 
+    def _relay_socket(self):
+        """
+        Connect to local relay's UNIX socket instead of Zabbix Server
+        Relay forwards items upstream, with TLS if configured
+        """
+        if self._logger: # pragma: no cover
+            self._logger.info(
+                "Connecting to relay %s", self._config.relay_socket
+            )
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self._tracer is not None:
+            self._tracer.before('connect', relay=self._config.relay_socket)
+        start = default_timer()
+        self.socket.connect(self._config.relay_socket)
+        duration = default_timer() - start
+        self._metrics.observe('connect', duration)
+        self._metrics.inc('connections')
+        if self._tracer is not None:
+            self._tracer.after('connect', duration)
+        return self.socket
+
     """
     Manage TLS context & Wrap socket
     Returns ssl.SSLSocket if TLS enabled
             socket.socket if TLS disabled
     """
     def _init_tls(self):
+        import ssl
         # Create a SSLContext and configure it
         if self._logger: # pragma: no cover
             self._logger.info(
                 "Initialize TLS context"
             )
-        ssl_context = ssl.SSLContext(ZBX_TLS_PROTOCOL)
+        ssl_context = ssl.SSLContext(getattr(ssl, ZBX_TLS_PROTOCOL_NAME))
         if self._logger: # pragma: no cover
             self._logger.debug(
                 'Setting TLS verify_mode to ssl.CERT_REQUIRED'
@@ -297,10 +474,10 @@ class SenderProtocol(object):
         if self._config.tls_connect == 'cert':
             if self._logger: # pragma: no cover
                 self._logger.debug(
-                    "Using provided TLSCertFile %s" % self._config.tls_cert_file
+                    "Using provided TLSCertFile %s", self._config.tls_cert_file
                 )
                 self._logger.debug(
-                    "Using provided TLSKeyFile %s" % self._config.tls_key_file
+                    "Using provided TLSKeyFile %s", self._config.tls_key_file
                 )
             ssl_context.load_cert_chain(
                 self._config.tls_cert_file,
@@ -313,7 +490,7 @@ class SenderProtocol(object):
         if self._config.tls_ca_file:
             if self._logger: # pragma: no cover
                 self._logger.debug(
-                    "Using provided TLSCAFile %s" % self._config.tls_ca_file
+                    "Using provided TLSCAFile %s", self._config.tls_ca_file
                 )
             ssl_context.load_default_certs(ssl.Purpose.SERVER_AUTH)
             ssl_context.load_verify_locations(
@@ -324,7 +501,7 @@ class SenderProtocol(object):
         if self._config.tls_crl_file:
             if self._logger: # pragma: no cover
                 self._logger.debug(
-                    "Using provided TLSCRLFile %s" % self._config.tls_crl_file
+                    "Using provided TLSCRLFile %s", self._config.tls_crl_file
                 )
             ssl_context.verify_flags |=  ssl.VERIFY_CRL_CHECK_LEAF
             ssl_context.load_verify_locations(
@@ -341,7 +518,8 @@ class SenderProtocol(object):
 
         # Once configuration is done, wrap network socket to TLS context
         tls_socket = ssl_context.wrap_socket(
-            self.socket
+            self.socket,
+            do_handshake_on_connect=False
         )
         assert isinstance(tls_socket, ssl.SSLSocket)
         return tls_socket
@@ -0,0 +1,35 @@
+class SenderTracer(object):
+    """
+    Tracing hooks called around each phase of the send pipeline
+    Extend it and override before & after to plug your own tracing
+
+    Phases are:
+    * send: whole DataContainer.send call
+    * serialize: JSON payload & packet building
+    * connect: TCP connection to Zabbix Server
+    * tls_wrap: TLS context setup & socket wrapping
+    * tls_handshake: TLS handshake
+    * sendall: packet sending
+    * read_response: Zabbix Server answer reading
+    * handle_response: Zabbix Server answer parsing
+    """
+
+    def before(self, phase, **info):
+        """
+        Called before phase starts
+
+        :phase: phase name
+        :info: phase details, like items count
+        """
+        pass
+
+    def after(self, phase, duration, **info):
+        """
+        Called once phase is done
+        Not called if phase raised an exception
+
+        :phase: phase name
+        :duration: phase duration in seconds
+        :info: phase details, like bytes count
+        """
+        pass
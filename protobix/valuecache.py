@@ -0,0 +1,114 @@
+"""
+Last sent values cache, used to discard unchanged values before sending
+like Zabbix "Discard unchanged with heartbeat" preprocessing does
+"""
+import hashlib
+import os
+from collections import OrderedDict
+try: import simplejson as json
+except ImportError: import json # pragma: no cover
+
+# Default maximum number of (host, key) tracked
+ZBX_VALUE_CACHE_SIZE = 10000
+
+def sha1_fingerprint(value):
+    """
+    Returns value's SHA-1 hex digest, used for big values like LLD payloads
+    """
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return hashlib.sha1(value).hexdigest()
+
+class ValueCache(object):
+    """
+    Bounded LRU cache of last value sent per (host, key)
+
+    :heartbeat: seconds after which an unchanged value is sent anyway
+    :max_size: maximum number of (host, key), least recently sent are evicted
+    :state_file: JSON file where cache is persisted, None to keep it in memory
+    :fingerprint: function applied to values before caching them, None keeps values
+    """
+
+    def __init__(self, heartbeat, max_size=ZBX_VALUE_CACHE_SIZE, state_file=None,
+                 fingerprint=None):
+        self.heartbeat = heartbeat
+        self.max_size = max_size
+        self.state_file = state_file
+        self.fingerprint = fingerprint
+        self._values = OrderedDict()
+        if state_file is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self._values)
+
+    def _value(self, value):
+        if self.fingerprint is None:
+            return value
+        return self.fingerprint(value)
+
+    def changed(self, host, key, value, clock):
+        """
+        Returns True if value must be sent
+        """
+        value = self._value(value)
+        cached = self._values.get((host, key))
+        return cached is None or cached[0] != value or \
+            clock - cached[1] >= self.heartbeat
+
+    def filter(self, items):
+        """
+        Returns items which value changed or reached heartbeat
+
+        :items: list of items as built by DataContainer.add_item
+        """
+        return [
+            item for item in items
+            if self.changed(item['host'], item['key'], item['value'], item['clock'])
+        ]
+
+    def update(self, items):
+        """
+        Record items as sent
+
+        :items: list of items as built by DataContainer.add_item
+        """
+        for item in items:
+            cache_key = (item['host'], item['key'])
+            value = self._value(item['value'])
+            cached = self._values.pop(cache_key, None)
+            if cached is not None and cached[0] == value and \
+               item['clock'] - cached[1] < self.heartbeat:
+                # Unchanged value sent anyway, heartbeat still starts from first one
+                self._values[cache_key] = cached
+            else:
+                self._values[cache_key] = (value, item['clock'])
+        while len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+
+    def load(self):
+        """
+        Load cache from state_file
+        Missing or invalid state file gives an empty cache
+        """
+        values = OrderedDict()
+        try:
+            with open(self.state_file) as state:
+                for host, key, value, clock in json.load(state)[-self.max_size:]:
+                    values[(host, key)] = (value, clock)
+        except (IOError, OSError, ValueError, TypeError):
+            values = OrderedDict()
+        self._values = values
+
+    def save(self):
+        """
+        Write cache into state_file
+        File is replaced atomically so that a crash can't corrupt it
+        """
+        tmp_file = '%s.%d.tmp' % (self.state_file, os.getpid())
+        with open(tmp_file, 'w') as state:
+            json.dump([
+                [host, key, value, clock]
+                for (host, key), (value, clock) in self._values.items()
+            ], state)
+        os.rename(tmp_file, self.state_file)
@@ -1,10 +1,58 @@
-import configobj
+import glob
+import os
+import re
 import socket
 
+# Zabbix Agent options used by protobix
+# Any other option (UserParameter, Alias, ...) is ignored when parsing
+ZBX_CONFIG_KEYS = (
+    'ServerActive',
+    'LogType',
+    'LogFile',
+    'DebugLevel',
+    'Timeout',
+    'Hostname',
+    'TLSConnect',
+    'TLSCAFile',
+    'TLSCertFile',
+    'TLSCRLFile',
+    'TLSKeyFile',
+    'TLSServerCertIssuer',
+    'TLSServerCertSubject',
+    'TLSPSKIdentity',
+    'TLSPSKFile',
+)
+# Protobix specific options, kept when reloading configuration file
+PROTOBIX_CONFIG_KEYS = (
+    'data_type',
+    'dryrun',
+    'self_monitoring',
+    'rate_limit_items',
+    'rate_limit_bytes',
+    'backpressure_threshold',
+    'discard_unchanged',
+    'value_cache_size',
+    'value_cache_file',
+    'lld_refresh',
+    'lld_cache_file',
+    'lld_first',
+    'diagnose',
+    'item_filter_ttl',
+    'item_filter_file',
+    'relay_socket',
+)
+# Same limit as Zabbix Agent for nested Include directives
+ZBX_MAX_INCLUDE_LEVEL = 10
+# Include directives with these characters are wildcard patterns
+ZBX_INCLUDE_MAGIC = re.compile('[*?[]')
+
 class ZabbixAgentConfig(object):
 
     _logger = None
     _default_config_file='/etc/zabbix/zabbix_agentd.conf'
+    # Parsed configuration files, shared by all instances
+    # {config_file: ((mtime, size), parsed_config)}
+    _config_cache = {}
 
     def __init__(self, config_file=None, logger=None):
         if config_file is None:
@@ -18,14 +66,38 @@ class ZabbixAgentConfig(object):
                 "Initializing"
             )
 
+        self._config_file = config_file
+        # Only a configuration file which disappeared is an error on reload
+        self._config_file_found = os.path.isfile(config_file)
+        self._reload_callbacks = []
+        self._fqdn = None
+        self.config = self._default_config()
+        self._load_config_file()
+
+    def _default_config(self):
         # Set default config value from sample zabbix_agentd.conf
         # Only exception is hostname. While non mandatory, we must have
-        # This property set. Default goes to server FQDN
+        # This property set. Default goes to server FQDN, which is only
+        # resolved when needed since reverse DNS lookup can be slow
         # We do *NOT* support HostnameItem except to fake system.hostname
-        self.config = {
+        return {
             # Protobix specific options
             'data_type': None,
             'dryrun': False,
+            'self_monitoring': False,
+            'rate_limit_items': 0,
+            'rate_limit_bytes': 0,
+            'backpressure_threshold': None,
+            'discard_unchanged': None,
+            'value_cache_size': 10000,
+            'value_cache_file': None,
+            'lld_refresh': None,
+            'lld_cache_file': None,
+            'lld_first': True,
+            'diagnose': False,
+            'item_filter_ttl': None,
+            'item_filter_file': None,
+            'relay_socket': None,
             # Zabbix Agent options
             'ServerActive': '127.0.0.1',
             'ServerPort': 10051,
@@ -33,7 +105,7 @@ class ZabbixAgentConfig(object):
             'LogFile': '/tmp/zabbix_agentd.log',
             'DebugLevel': 3,
             'Timeout': 3,
-            'Hostname': socket.getfqdn(),
+            'Hostname': None,
             'TLSConnect': 'unencrypted',
             'TLSCAFile': None,
             'TLSCertFile': None,
@@ -45,15 +117,13 @@ class ZabbixAgentConfig(object):
             'TLSPSKFile': None,
         }
 
-        # list_values=False argument below is needed because of potential
-        # UserParameter with spaces which breaks ConfigObj
-        # See
+    def _load_config_file(self):
         if self._logger: # pragma: no cover
             self._logger.debug(
                 "Reading Zabbix Agent configuration file %s" %
-                config_file
+                self._config_file
             )
-        tmp_config = configobj.ConfigObj(config_file, list_values=False)
+        tmp_config = self._read_config_file(self._config_file)
 
         # If not config_file found or provided,
         # we should fallback to the default
@@ -83,13 +153,152 @@ class ZabbixAgentConfig(object):
         self._process_log_config(tmp_config)
         self._process_tls_config(tmp_config)
 
+    def reload(self):
+        """
+        Read configuration file & included files again
+        Only files changed since they were last read are parsed
+        Values set through properties are replaced by configuration file ones,
+        except protobix specific options like data_type or dryrun
+        Registered callbacks are called if configuration changed
+        Missing or unreadable configuration file keeps previous configuration
+        Returns True if configuration changed
+        """
+        if self._logger: # pragma: no cover
+            self._logger.info(
+                "Reloading configuration"
+            )
+        previous_config = self.config
+        self.config = self._default_config()
+        for key in PROTOBIX_CONFIG_KEYS:
+            self.config[key] = previous_config[key]
+        try:
+            if self._config_file_found and not os.path.isfile(self._config_file):
+                raise IOError('%s no longer exists' % self._config_file)
+            self._load_config_file()
+        except (IOError, OSError) as e:
+            # Defaults would send items to another server
+            self.config = previous_config
+            if self._logger: # pragma: no cover
+                self._logger.error(
+                    "Unable to reload configuration, keeping previous one [%s]" % str(e)
+                )
+            return False
+        except ValueError:
+            # Keep running with previous configuration
+            self.config = previous_config
+            raise
+        if self.config == previous_config:
+            return False
+        for callback in self._reload_callbacks:
+            callback(self)
+        return True
+
+    def add_reload_callback(self, callback):
+        """
+        Register a callback called with this instance
+        each time reload() changes the configuration
+
+        :callback: callable taking ZabbixAgentConfig as only argument
+        """
+        self._reload_callbacks.append(callback)
+
+    def _read_config_file(self, config_file, level=0):
+        """
+        Returns parsed configuration file as a dict
+        Include directives are expanded, included files override
+        values from the including file
+
+        :config_file: path to zabbix_agentd.conf
+        :level: Include nesting level
+        """
+        tmp_config = self._read_cached_file(config_file)
+        for include in tmp_config.pop('Include', []):
+            if level >= ZBX_MAX_INCLUDE_LEVEL:
+                raise ValueError(
+                    'Include nesting is too deep in %s' % config_file
+                )
+            for include_file in self._expand_include(include):
+                tmp_config.update(
+                    self._read_config_file(include_file, level + 1)
+                )
+        return tmp_config
+
+    def _expand_include(self, include):
+        """
+        Returns the list of files matching an Include directive
+        It can be a single file, a directory or a wildcard pattern
+
+        :include: Include directive value
+        """
+        if os.path.isdir(include):
+            include_files = [
+                os.path.join(include, name) for name in os.listdir(include)
+            ]
+        elif ZBX_INCLUDE_MAGIC.search(include):
+            include_files = glob.glob(include)
+        else:
+            return [include]
+        return sorted(
+            include_file for include_file in include_files
+            if os.path.isfile(include_file)
+        )
+
+    def _read_cached_file(self, config_file):
+        """
+        Returns a single parsed configuration file as a dict
+        Parsed files are cached until their mtime or size change
+
+        :config_file: path to configuration file
+        """
+        try:
+            stat = os.stat(config_file)
+        except OSError:
+            return {}
+        signature = (stat.st_mtime, stat.st_size)
+        cached = self._config_cache.get(config_file)
+        if cached is not None and cached[0] == signature:
+            if self._logger: # pragma: no cover
+                self._logger.debug(
+                    "Using cached configuration for %s" % config_file
+                )
+            tmp_config = cached[1]
+        else:
+            tmp_config = self._parse_config_file(config_file)
+            self._config_cache[config_file] = (signature, tmp_config)
+        tmp_config = dict(tmp_config)
+        if 'Include' in tmp_config:
+            tmp_config['Include'] = list(tmp_config['Include'])
+        return tmp_config
+
+    def _parse_config_file(self, config_file):
+        """
+        Parse zabbix_agentd.conf and extract ZBX_CONFIG_KEYS only
+        Format is one Key=Value per line, # starts a comment line
+        Include directives are returned as a list under 'Include' key
+
+        :config_file: path to zabbix_agentd.conf
+        """
+        tmp_config = {}
+        with open(config_file) as config:
+            for line in config:
+                line = line.strip()
+                if not line or line[0] == '#' or '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                key = key.strip()
+                if key in ZBX_CONFIG_KEYS:
+                    tmp_config[key] = value.strip()
+                elif key == 'Include':
+                    tmp_config.setdefault('Include', []).append(value.strip())
+        return tmp_config
+
     def _process_server_config(self, tmp_config):
         if self._logger: # pragma: no cover
             self._logger.debug(
                 "Processing server config"
             )
         if 'ServerActive' in tmp_config:
-            # Because of list_values=False above,
+            # ServerActive can be a list of servers,
             # we have to check ServerActive format
             # and extract server & port manually
             # See  https://github.com/jbfavre/python-protobix/issues/16
@@ -222,6 +431,10 @@ class ZabbixAgentConfig(object):
 
     @property
     def hostname(self):
+        if self.config['Hostname'] is None:
+            if self._fqdn is None:
+                self._fqdn = socket.getfqdn()
+            return self._fqdn
         return self.config['Hostname']
 
     @hostname.setter
@@ -323,6 +536,162 @@ class ZabbixAgentConfig(object):
         else:
             raise ValueError('dryrun parameter requires boolean')
 
+    @property
+    def self_monitoring(self):
+        return self.config['self_monitoring']
+
+    @self_monitoring.setter
+    def self_monitoring(self, value):
+        if value in [True, False]:
+            self.config['self_monitoring'] = value
+        else:
+            raise ValueError('self_monitoring parameter requires boolean')
+
+    @property
+    def rate_limit_items(self):
+        return self.config['rate_limit_items']
+
+    @rate_limit_items.setter
+    def rate_limit_items(self, value):
+        # 0 means unlimited
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0:
+            self.config['rate_limit_items'] = value
+        else:
+            raise ValueError('rate_limit_items must be a positive number of items per second')
+
+    @property
+    def rate_limit_bytes(self):
+        return self.config['rate_limit_bytes']
+
+    @rate_limit_bytes.setter
+    def rate_limit_bytes(self, value):
+        # 0 means unlimited
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0:
+            self.config['rate_limit_bytes'] = value
+        else:
+            raise ValueError('rate_limit_bytes must be a positive number of bytes per second')
+
+    @property
+    def backpressure_threshold(self):
+        return self.config['backpressure_threshold']
+
+    @backpressure_threshold.setter
+    def backpressure_threshold(self, value):
+        # None disables backpressure
+        if value is None or \
+           (isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0):
+            self.config['backpressure_threshold'] = value
+        else:
+            raise ValueError('backpressure_threshold must be a number of seconds greater than 0')
+
+    @property
+    def discard_unchanged(self):
+        return self.config['discard_unchanged']
+
+    @discard_unchanged.setter
+    def discard_unchanged(self, value):
+        # Heartbeat in seconds, None sends every value
+        if value is None or \
+           (isinstance(value, int) and not isinstance(value, bool) and value > 0):
+            self.config['discard_unchanged'] = value
+        else:
+            raise ValueError('discard_unchanged must be a heartbeat in seconds greater than 0')
+
+    @property
+    def value_cache_size(self):
+        return self.config['value_cache_size']
+
+    @value_cache_size.setter
+    def value_cache_size(self, value):
+        if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+            self.config['value_cache_size'] = value
+        else:
+            raise ValueError('value_cache_size must be greater than 0')
+
+    @property
+    def value_cache_file(self):
+        return self.config['value_cache_file']
+
+    @value_cache_file.setter
+    def value_cache_file(self, value):
+        self.config['value_cache_file'] = value
+
+    @property
+    def lld_refresh(self):
+        return self.config['lld_refresh']
+
+    @lld_refresh.setter
+    def lld_refresh(self, value):
+        # Seconds during which unchanged discovery isn't sent again,
+        # None sends every discovery
+        if value is None or \
+           (isinstance(value, int) and not isinstance(value, bool) and value > 0):
+            self.config['lld_refresh'] = value
+        else:
+            raise ValueError('lld_refresh must be a number of seconds greater than 0')
+
+    @property
+    def lld_cache_file(self):
+        return self.config['lld_cache_file']
+
+    @lld_cache_file.setter
+    def lld_cache_file(self, value):
+        self.config['lld_cache_file'] = value
+
+    @property
+    def lld_first(self):
+        return self.config['lld_first']
+
+    @lld_first.setter
+    def lld_first(self, value):
+        if value in [True, False]:
+            self.config['lld_first'] = value
+        else:
+            raise ValueError('lld_first parameter requires boolean')
+
+    @property
+    def diagnose(self):
+        return self.config['diagnose']
+
+    @diagnose.setter
+    def diagnose(self, value):
+        # Bisect chunks with failed items to find which ones Zabbix rejected
+        if value in [True, False]:
+            self.config['diagnose'] = value
+        else:
+            raise ValueError('diagnose parameter requires boolean')
+
+    @property
+    def item_filter_ttl(self):
+        return self.config['item_filter_ttl']
+
+    @item_filter_ttl.setter
+    def item_filter_ttl(self, value):
+        # Seconds during which items Zabbix rejected aren't sent again,
+        # None always sends them
+        if value is None or \
+           (isinstance(value, int) and not isinstance(value, bool) and value > 0):
+            self.config['item_filter_ttl'] = value
+        else:
+            raise ValueError('item_filter_ttl must be a number of seconds greater than 0')
+
+    @property
+    def item_filter_file(self):
+        return self.config['item_filter_file']
+
+    @item_filter_file.setter
+    def item_filter_file(self, value):
+        self.config['item_filter_file'] = value
+
+    @property
+    def relay_socket(self):
+        return self.config['relay_socket']
+
+    @relay_socket.setter
+    def relay_socket(self, value):
+        # UNIX socket of a protobix relay, None sends to Zabbix Server
+        self.config['relay_socket'] = value
+
     @property
     def data_type(self):
         return self.config['data_type']
@@ -0,0 +1,383 @@
+"""
+Pre-forked probe zygote: protobix & probe are imported and initialized
+once, then each UserParameter call is served by a forked process
+
+    protobix-zygote --probe myprobe:MyProbe --socket /run/myprobe.sock
+    UserParameter=myprobe.update,protobix-zygote-call --socket /run/myprobe.sock --update-items
+
+Client passes its stdin, stdout & stderr along with probe arguments,
+so forked probe writes directly to Zabbix Agent, then gets exit code back
+File descriptors passing requires Python 3
+
+Socket is only accessible to zygote's user, and peers of another user are
+refused where SO_PEERCRED is available. Clients may only pass options which
+neither read nor write arbitrary files, see ZYGOTE_ALLOWED_OPTIONS
+"""
+import array
+import io
+import os
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+try: import simplejson as json
+except ImportError: import json # pragma: no cover
+
+ZYGOTE_SOCKET = '/tmp/protobix-zygote.sock'
+# Maximum seconds to read a request
+ZYGOTE_REQUEST_TIMEOUT = 5
+ZYGOTE_LENGTH = struct.Struct('!I')
+ZYGOTE_EXIT_CODE = struct.Struct('!i')
+# Exit code returned by client when zygote can't be reached
+ZYGOTE_UNAVAILABLE = 1
+# Seconds between two checks of forked probes while waiting for clients
+ZYGOTE_POLL_INTERVAL = 0.05
+ZYGOTE_CHILD_POLL_INTERVAL = 0.005
+# Options clients may pass, others like --config or --value-cache-file
+# would let any local user read or write files as zygote's user
+ZYGOTE_ALLOWED_OPTIONS = frozenset([
+    '--update-items', '--discovery', '-d', '--dryrun', '--workers',
+    '--host-timeout', '--discard-unchanged', '--lld-refresh',
+    '--item-filter-ttl', '--detach', '--detach-timeout', '--result-cache',
+    '--diagnose', '--profile', '--profile-items',
+])
+# -v, -vv... & negative numbers given as option values
+ZYGOTE_ALLOWED_ARG = re.compile(r'^(-v+|-\d+)$')
+
+def _recv_exactly(sock, size, data=b''):
+    while len(data) < size:
+        _buffer = sock.recv(size - len(data))
+        if not _buffer:
+            raise socket.error('Connection closed')
+        data += _buffer
+    return data
+
+def _exit_code(status):
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return 128 + os.WTERMSIG(status)
+
+def check_args(args, allowed_options=ZYGOTE_ALLOWED_OPTIONS):
+    """
+    Raise ValueError if args hold an option clients may not pass
+    Abbreviated & combined short options are refused too
+    """
+    for arg in args:
+        if not arg.startswith('-') or ZYGOTE_ALLOWED_ARG.match(arg):
+            continue
+        if arg.split('=', 1)[0] not in allowed_options:
+            raise ValueError('Option %s is not allowed' % arg)
+
+def _peer_uid(conn):
+    """
+    Returns uid of peer process, None when unknown
+    """
+    if not hasattr(socket, 'SO_PEERCRED'): # pragma: no cover
+        return None
+    creds = struct.Struct('3i')
+    return creds.unpack(
+        conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, creds.size)
+    )[1]
+
+class Zygote(object):
+    """
+    Serve probe calls by forking an initialized probe
+
+    Forked probes run with args followed by client's arguments
+
+    A single thread accepts clients, forks & reaps forked probes.
+    serve_forever runs it in main thread, so that no other thread may hold
+    a logging or import lock when forking. When served with start(),
+    no other thread may log or import while zygote serves
+
+    :probe: SampleProbe instance
+    :socket_path: UNIX socket clients connect to
+    :args: probe arguments used to run _init_probe
+    :allowed_options: options clients may pass
+    """
+
+    def __init__(self, probe, socket_path=ZYGOTE_SOCKET, args=None,
+                 allowed_options=ZYGOTE_ALLOWED_OPTIONS):
+        self.probe = probe
+        self.socket_path = socket_path
+        self.args = args or []
+        self.allowed_options = allowed_options
+        self._socket = None
+        self._stopped = threading.Event()
+        self._thread = None
+        # {pid: client connection} of running forked probes
+        self._children = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def init_probe(self):
+        """
+        Parse arguments & run _init_probe like SampleProbe.run does
+        """
+        probe = self.probe
+        probe._init_logging()
+        probe.options = probe._parse_args(self.args)
+        probe.zbx_config = probe._init_config()
+        probe._setup_logging(
+            probe.zbx_config.log_type,
+            probe.zbx_config.debug_level,
+            probe.zbx_config.log_file
+        )
+        probe.hostname = probe.zbx_config.hostname
+        probe._init_probe()
+        probe._probe_initialized = True
+
+    def _listen(self):
+        if not hasattr(socket.socket, 'recvmsg'): # pragma: no cover
+            raise NotImplementedError('Zygote requires Python 3')
+        self.init_probe()
+        # Socket left by a previous run
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Socket is created with 0600 mode, other users can't connect
+        umask = os.umask(0o177)
+        try:
+            self._socket.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self._socket.listen(socket.SOMAXCONN)
+        self._stopped.clear()
+        if self.probe.logger: # pragma: no cover
+            self.probe.logger.info("Zygote listening on %s", self.socket_path)
+
+    def start(self):
+        """
+        Serve from a background thread
+        """
+        self._listen()
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._socket.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def serve_forever(self):
+        """
+        Serve from main thread until SIGTERM or KeyboardInterrupt
+        """
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._stopped.set())
+        self._listen()
+        try:
+            self._serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def _serve(self):
+        while not self._stopped.is_set():
+            self._reap()
+            # Check forked probes more often while some are running
+            self._socket.settimeout(
+                ZYGOTE_CHILD_POLL_INTERVAL if self._children else ZYGOTE_POLL_INTERVAL
+            )
+            try:
+                conn = self._socket.accept()[0]
+            except socket.timeout:
+                continue
+            try:
+                args, fds = self._read_request(conn)
+            except (socket.error, ValueError) as e:
+                if self.probe.logger: # pragma: no cover
+                    self.probe.logger.error("Invalid zygote request [%s]" % str(e))
+                conn.close()
+                continue
+            self._fork(conn, args, fds)
+        # Running probes' clients still get their exit code
+        while self._children:
+            self._reap()
+            time.sleep(ZYGOTE_CHILD_POLL_INTERVAL)
+
+    def _read_request(self, conn):
+        """
+        Returns probe arguments & client's stdin, stdout & stderr
+        """
+        uid = _peer_uid(conn)
+        if uid is not None and uid != os.getuid():
+            raise ValueError('Peer uid %d differs from zygote uid' % uid)
+        conn.settimeout(ZYGOTE_REQUEST_TIMEOUT)
+        fd_size = array.array('i').itemsize
+        data, ancdata, flags, address = conn.recvmsg(
+            4096, socket.CMSG_SPACE(3 * fd_size)
+        )
+        fds = array.array('i')
+        for level, kind, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fd_size])
+        fds = list(fds)
+        if len(fds) != 3:
+            for fd in fds:
+                os.close(fd)
+            raise ValueError('Expected 3 file descriptors, got %d' % len(fds))
+        try:
+            data = _recv_exactly(conn, ZYGOTE_LENGTH.size, data)
+            length = ZYGOTE_LENGTH.unpack(data[:ZYGOTE_LENGTH.size])[0]
+            data = _recv_exactly(conn, ZYGOTE_LENGTH.size + length, data)
+            args = json.loads(data[ZYGOTE_LENGTH.size:].decode('utf-8'))
+            if not isinstance(args, list):
+                raise ValueError('Arguments must be a list')
+            args = [str(arg) for arg in args]
+            check_args(args, self.allowed_options)
+        except:
+            for fd in fds:
+                os.close(fd)
+            raise
+        return args, fds
+
+    def _fork(self, conn, args, fds):
+        # Don't let children write zygote's pending output
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self._run_child(conn, args, fds)
+        for fd in fds:
+            os.close(fd)
+        self._children[pid] = conn
+
+    def _run_child(self, conn, args, fds):
+        """
+        Run probe with client's stdin, stdout & stderr
+        Never returns
+        """
+        code = 1
+        try:
+            self._socket.close()
+            conn.close()
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+            for fd in fds:
+                if fd > 2:
+                    os.close(fd)
+            sys.stdin = io.open(0, 'r', closefd=False)
+            sys.stdout = io.open(1, 'w', closefd=False)
+            sys.stderr = io.open(2, 'w', closefd=False)
+            code = self.probe.run(self.args + args)
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code or 0)
+
+    def _reap(self):
+        """
+        Send exit code of finished forked probes to their client
+        """
+        for pid in list(self._children):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if not done:
+                continue
+            conn = self._children.pop(pid)
+            try:
+                conn.sendall(ZYGOTE_EXIT_CODE.pack(_exit_code(status)))
+            except socket.error:
+                pass
+            conn.close()
+
+def call(args, socket_path=ZYGOTE_SOCKET, fds=(0, 1, 2)):
+    """
+    Run probe in zygote with current stdin, stdout & stderr
+    Returns probe's exit code
+
+    :args: probe arguments
+    :socket_path: zygote's UNIX socket
+    :fds: file descriptors used as probe's stdin, stdout & stderr
+    """
+    payload = json.dumps(list(args)).encode('utf-8')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendmsg(
+            [ZYGOTE_LENGTH.pack(len(payload)) + payload],
+            [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+        )
+        return ZYGOTE_EXIT_CODE.unpack(
+            _recv_exactly(sock, ZYGOTE_EXIT_CODE.size)
+        )[0]
+    finally:
+        sock.close()
+
+def call_main(args=None):
+    """
+    protobix-zygote-call [--socket PATH] [probe arguments]
+    argparse isn't used to keep client startup minimal
+    """
+    if args is None:
+        args = sys.argv[1:]
+    socket_path = ZYGOTE_SOCKET
+    if args[:1] == ['--socket']:
+        socket_path = args[1]
+        args = args[2:]
+    try:
+        return call(args, socket_path)
+    except socket.error as e:
+        sys.stderr.write('Unable to reach zygote on %s: %s\n' % (socket_path, e))
+        return ZYGOTE_UNAVAILABLE
+
+def _load_probe(name):
+    """
+    Returns probe instance from module:Class
+    """
+    import importlib
+    module_name, class_name = name.split(':', 1)
+    return getattr(importlib.import_module(module_name), class_name)()
+
+def main(args=None):
+    """
+    protobix-zygote --probe module:Class [--socket PATH] [--allow-option OPTION]
+                    [-- probe arguments]
+    """
+    import argparse
+    if args is None:
+        args = sys.argv[1:]
+    probe_args = []
+    if '--' in args:
+        probe_args = args[args.index('--') + 1:]
+        args = args[:args.index('--')]
+    parser = argparse.ArgumentParser(
+        description='Serve probe calls by forking an initialized probe'
+    )
+    parser.add_argument(
+        '--probe', required=True,
+        help="SampleProbe subclass as module:Class"
+    )
+    parser.add_argument(
+        '-s', '--socket', default=ZYGOTE_SOCKET,
+        help="UNIX socket clients connect to. Default is %s" % ZYGOTE_SOCKET
+    )
+    parser.add_argument(
+        '--allow-option', action='append', default=[], metavar='OPTION',
+        help="Probe specific option clients may pass, like\n"
+             "--allow-option=--my-option. May be repeated"
+    )
+    options = parser.parse_args(args)
+    Zygote(
+        _load_probe(options.probe), options.socket, probe_args,
+        ZYGOTE_ALLOWED_OPTIONS.union(options.allow_option)
+    ).serve_forever()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
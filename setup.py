@@ -8,7 +8,6 @@ setup(
     packages = ['protobix'],
     version = '1.0.2',
     install_requires = [
-        'configobj',
         'simplejson'
     ],
     tests_require = [
@@ -16,6 +15,13 @@ setup(
         'pytest',
     ],
     test_suite='tests',
+    entry_points = {
+        'console_scripts': [
+            'protobix-relay = protobix.relay:main',
+            'protobix-zygote = protobix.zygote:main',
+            'protobix-zygote-call = protobix.zygote:call_main',
+        ],
+    },
     description = 'Implementation of Zabbix Sender protocol',
     long_description = ( 'This module implements Zabbix Sender Protocol.\n'
                          'It allows to build list of items and send '
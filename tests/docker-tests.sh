@@ -3,15 +3,15 @@
 VERSION=$(sed 's/\..*//' /etc/debian_version)
 case ${VERSION} in
   7) echo 'Debian Wheezy'
-     packages_list='python2.7 python-setuptools python-configobj python-simplejson python-pytest python-mock adduser'
+     packages_list='python2.7 python-setuptools python-simplejson python-pytest python-mock adduser'
      test_suite_list='python'
      ;;
   8) echo 'Debian Jessie'
-     packages_list='python2.7 python3 python-setuptools python3-setuptools python-configobj python-simplejson python3-configobj python3-simplejson python-pytest python-pytest-cov python-mock python3-pytest python3-pytest-cov python3-mock'
+     packages_list='python2.7 python3 python-setuptools python3-setuptools python-simplejson python3-simplejson python-pytest python-pytest-cov python-mock python3-pytest python3-pytest-cov python3-mock'
      test_suite_list='python python3'
      ;;
   *) echo 'Debian stretch/sid'
-     packages_list='python2.7 python3 python-setuptools python3-setuptools python-configobj python-simplejson python3-configobj python3-simplejson python-pytest python-pytest-cov python-mock python3-pytest python3-pytest-cov python3-mock'
+     packages_list='python2.7 python3 python-setuptools python3-setuptools python-simplejson python3-simplejson python-pytest python-pytest-cov python-mock python3-pytest python3-pytest-cov python3-mock'
      test_suite_list='python python3'
      ;;
 esac
@@ -0,0 +1,137 @@
+"""
+Tests for protobix.aggregation
+"""
+import pytest
+import mock
+import random
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix.aggregation import (
+    Aggregator, AggregationRule, QuantileSketch, derived_key
+)
+
+@pytest.mark.parametrize(('key', 'expected'), (
+    ('app.latency', 'app.latency.p99'),
+    ('net.if.in[eth0,bytes]', 'net.if.in.p99[eth0,bytes]'),
+))
+def test_derived_key(key, expected):
+    """
+    Function is inserted before key parameters
+    """
+    assert derived_key(key, 'p99') == expected
+
+def test_quantile_sketch():
+    """
+    Quantiles are within sketch accuracy
+    """
+    values = [random.uniform(-100, 1000) for index in range(10000)] + [0] * 100
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    values.sort()
+    for quantile in (0.01, 0.5, 0.9, 0.99):
+        expected = values[int(round(quantile * (len(values) - 1)))]
+        assert sketch.quantile(quantile) == pytest.approx(expected, rel=0.02, abs=0.5)
+    assert QuantileSketch().quantile(0.5) is None
+    # Memory doesn't depend on samples count
+    assert len(sketch._positive) + len(sketch._negative) < 1200
+
+def test_aggregator_functions():
+    """
+    Each function is sent as a derived key once window is over
+    """
+    aggregator = Aggregator()
+    aggregator.add_rule(AggregationRule(
+        'app.latency[*]', ('last', 'min', 'max', 'avg', 'sum', 'count', 'p50'),
+        window=60, derived_keys=True
+    ))
+    for index, value in enumerate([3, 1, 2, 4]):
+        assert aggregator.add('myhostname', 'app.latency[api]', value, 1200 + index) is True
+    assert aggregator.add('myhostname', 'app.other', 1, 1200) is False
+    assert len(aggregator) == 1
+    assert aggregator.flush(1259) == []
+    results = dict(
+        (key, (value, clock)) for host, key, value, clock in aggregator.flush(1260)
+    )
+    assert results == {
+        'app.latency.last[api]': (4, 1203),
+        'app.latency.min[api]': (1, 1203),
+        'app.latency.max[api]': (4, 1203),
+        'app.latency.avg[api]': (2.5, 1203),
+        'app.latency.sum[api]': (10, 1203),
+        'app.latency.count[api]': (4, 1203),
+        'app.latency.p50[api]': (pytest.approx(2, rel=0.01), 1203),
+    }
+    assert len(aggregator) == 0
+
+def test_aggregator_windows():
+    """
+    Samples are aggregated per host & window, open windows are kept
+    """
+    aggregator = Aggregator()
+    aggregator.add_rule(AggregationRule('app.*', 'max', window=10))
+    aggregator.add('host1', 'app.requests', 5, 100)
+    aggregator.add('host1', 'app.requests', 7, 111)
+    aggregator.add('host2', 'app.requests', 6, 105)
+    assert aggregator.flush(115) == [
+        ('host1', 'app.requests', 5, 100),
+        ('host2', 'app.requests', 6, 105),
+    ]
+    assert aggregator.flush(115, force=True) == [('host1', 'app.requests', 7, 111)]
+
+def test_aggregator_last_string():
+    """
+    last keeps non numeric values
+    """
+    aggregator = Aggregator()
+    aggregator.add_rule(AggregationRule('app.version', 'last', window=10))
+    aggregator.add('myhostname', 'app.version', '1.0', 101)
+    aggregator.add('myhostname', 'app.version', '1.1', 102)
+    assert aggregator.flush(110) == [('myhostname', 'app.version', '1.1', 102)]
+
+@pytest.mark.parametrize(('functions', 'window', 'derived_keys', 'message'), (
+    (('median',), 60, False, 'Unknown aggregation function median'),
+    (('min', 'max'), 60, False, 'derived_keys is required to aggregate with several functions'),
+    (('avg',), 0, False, 'window must be a number of seconds greater than 0'),
+))
+def test_aggregation_rule_invalid(functions, window, derived_keys, message):
+    """
+    Invalid rules are refused
+    """
+    with pytest.raises(ValueError) as err:
+        AggregationRule('app.*', functions, window, derived_keys)
+    assert str(err.value) == message
+
+def test_datacontainer_aggregate():
+    """
+    Aggregated keys are collapsed, others are sent as is
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer.aggregate('app.latency', ('avg', 'p99'), window=60, derived_keys=True)
+    zbx_datacontainer.data_type = 'items'
+    for index in range(1000):
+        zbx_datacontainer.add_item('myhostname', 'app.latency', index % 100, clock=1200 + index % 60)
+    zbx_datacontainer.add_item('myhostname', 'app.version', '1.0', clock=1200)
+    assert len(zbx_datacontainer.items_list) == 1
+    assert zbx_datacontainer.metrics.snapshot()['items_aggregated'] == 1000
+    with mock.patch('protobix.DataContainer._send_common') as mock_send_common:
+        mock_send_common.return_value = ('success', 3, 0, 3, 0)
+        zbx_datacontainer.send()
+        items = mock_send_common.call_args[0][0]
+    values = dict((item['key'], item['value']) for item in items)
+    assert sorted(values) == ['app.latency.avg', 'app.latency.p99', 'app.version']
+    assert values['app.latency.avg'] == 49.5
+    assert values['app.latency.p99'] == pytest.approx(99, rel=0.02)
+
+def test_datacontainer_aggregate_invalid_value():
+    """
+    Aggregated values must be numeric
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer.aggregate('app.latency')
+    zbx_datacontainer.data_type = 'items'
+    with pytest.raises(ValueError):
+        zbx_datacontainer.add_item('myhostname', 'app.latency', 'invalid')
@@ -0,0 +1,50 @@
+"""
+Tests for protobix.benchmark
+Only check that benchmarks run, with a small number of items
+"""
+import pytest
+try: import simplejson as json
+except ImportError: import json
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix import benchmark
+
+def test_percentile():
+    assert benchmark.percentile([], 50) == 0
+    assert benchmark.percentile([3, 1, 2], 50) == 2
+    assert benchmark.percentile(list(range(101)), 99) == 99
+
+@pytest.mark.parametrize('data_type', ('items', 'lld'))
+def test_generate_data(data_type):
+    data = benchmark.generate_data(data_type, 250)
+    assert len(data) == 3
+    assert sum(len(keys) for keys in data.values()) == 250
+
+@pytest.mark.parametrize('scenario', benchmark.SCENARIOS)
+def test_run_scenario(scenario):
+    options = benchmark._parse_args(['--rtt', '0'])
+    result = benchmark.run_scenario(scenario, 300, options)
+    assert result['items_per_second'] > 0
+    assert result['peak_rss_kb'] > 0
+    if scenario.startswith('send'):
+        # 250 items per chunk
+        assert result['chunks'] == 2
+        assert result['bytes_per_second'] > 0
+        assert result['p99_latency'] >= result['p50_latency'] > 0
+
+def test_baseline(tmpdir):
+    baseline_file = str(tmpdir.join('baseline.json'))
+    args = ['--sizes', '100', '--scenarios', 'add,send_items', '--rtt', '0']
+    assert benchmark.main(args + ['--save-baseline', baseline_file]) == 0
+    with open(baseline_file) as baseline:
+        results = json.load(baseline)
+    assert sorted(results) == ['add/100', 'send_items/100']
+    # Nothing can be 100 times slower
+    assert benchmark.main(args + ['--baseline', baseline_file, '--tolerance', '0.99']) == 0
+    results['send_items/100']['items_per_second'] *= 1000
+    with open(baseline_file, 'w') as baseline:
+        json.dump(results, baseline)
+    assert benchmark.main(args + ['--baseline', baseline_file]) == 1
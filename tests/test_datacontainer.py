@@ -1,7 +1,6 @@
 """
 Tests for protobix.SenderProtocol
 """
-import configobj
 import pytest
 import mock
 import unittest
@@ -14,6 +13,7 @@ import sys
 import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 import protobix
+from protobix.faketrapper import FakeTrapper
 
 DATA = {
     'items': {
@@ -235,7 +235,8 @@ def test_need_backend_debug_yes_dryrun_no(data_type):
 
     ''' Send data to zabbix '''
     srv_success, srv_failure, processed, failed, total, time = zbx_datacontainer.send()
-    assert srv_success == 4
+    # Debug doesn't send items one by one anymore
+    assert srv_success == 1
     assert srv_failure == 0
     assert processed == 4
     assert failed == 0
@@ -261,9 +262,294 @@ def test_need_backend_debug_yes_dryrun_no(data_type):
 
     ''' Send data to zabbix '''
     srv_success, srv_failure, processed, failed, total, time = zbx_datacontainer.send()
-    assert srv_success == 4
+    # Debug doesn't send items one by one anymore
+    assert srv_success == 1
     assert srv_failure == 0
     assert processed == 4
     assert failed == 0
     assert total == 4
     assert zbx_datacontainer.items_list == []
+
+def test_reload_config_resets_socket():
+    """
+    Socket must be reset when configuration changes on reload
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    mock_socket = mock.MagicMock(name='socket', spec=socket.socket)
+    zbx_datacontainer.socket = mock_socket
+    with mock.patch('protobix.ZabbixAgentConfig.reload', return_value=False):
+        assert zbx_datacontainer.reload_config() is False
+    assert zbx_datacontainer.socket is mock_socket
+    with mock.patch('protobix.ZabbixAgentConfig.reload', return_value=True):
+        assert zbx_datacontainer.reload_config() is True
+    assert zbx_datacontainer.socket is None
+    mock_socket.close.assert_called_once_with()
+
+def test_metrics_send():
+    """
+    Sender metrics are updated when sending
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer.data_type = 'items'
+    zbx_datacontainer.add(DATA['items'])
+    with mock.patch('protobix.DataContainer._send_to_zabbix', return_value=0):
+        with mock.patch('protobix.DataContainer._read_from_zabbix') as mock_read:
+            mock_read.return_value = ('success', 3, 1, 4, 0.001)
+            zbx_datacontainer.send()
+    snapshot = zbx_datacontainer.metrics.snapshot()
+    assert snapshot['items_queued'] == 4
+    assert snapshot['items_sent'] == 3
+    assert snapshot['items_failed'] == 1
+    assert snapshot['items_dropped'] == 0
+    assert snapshot['chunks'] == 1
+    assert snapshot['round_trip_seconds_count'] == 1
+
+def test_metrics_send_fails():
+    """
+    Items not sent are counted as dropped
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer.server_port = 10060
+    zbx_datacontainer.data_type = 'items'
+    zbx_datacontainer.add(DATA['items'])
+    with pytest.raises(socket.error):
+        zbx_datacontainer.send()
+    assert zbx_datacontainer.metrics.snapshot()['items_dropped'] == 4
+
+def test_self_monitoring():
+    """
+    Self-monitoring items are sent along with items
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer.dryrun = True
+    zbx_datacontainer.self_monitoring = True
+    zbx_datacontainer._config.hostname = 'myhostname'
+    zbx_datacontainer.data_type = 'items'
+    zbx_datacontainer.add(DATA['items'])
+    with mock.patch('protobix.DataContainer._send_common') as mock_send_common:
+        mock_send_common.return_value = ('dryrun', 0, 0, 0, 0)
+        zbx_datacontainer.send()
+        items = mock_send_common.call_args[0][0]
+    keys = [item['key'] for item in items if item['host'] == 'myhostname']
+    assert 'protobix.sender.items_queued' in keys
+    assert 'protobix.sender.round_trip_seconds_sum' in keys
+    assert len(items) == 4 + len(zbx_datacontainer.metrics.snapshot())
+
+def test_self_monitoring_invalid():
+    """
+    self_monitoring requires a boolean
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    with pytest.raises(ValueError) as err:
+        zbx_datacontainer.self_monitoring = 'invalid'
+    assert str(err.value) == 'self_monitoring parameter requires boolean'
+
+def test_discard_unchanged(tmpdir):
+    """
+    Unchanged items are only sent once, even across containers
+    """
+    value_cache_file = str(tmpdir.join('values.json'))
+    for run, sent, discarded in ((1, 5, 0), (2, 1, 4)):
+        zbx_datacontainer = protobix.DataContainer()
+        zbx_datacontainer._config.discard_unchanged = 3600
+        zbx_datacontainer._config.value_cache_file = value_cache_file
+        zbx_datacontainer.data_type = 'items'
+        zbx_datacontainer.add(DATA['items'])
+        zbx_datacontainer.add_item('protobix.host1', 'my.protobix.item.run', run)
+        with mock.patch('protobix.DataContainer._send_common') as mock_send_common:
+            mock_send_common.return_value = ('success', sent, 0, sent, 0)
+            zbx_datacontainer.send()
+            items = mock_send_common.call_args[0][0]
+        assert len(items) == sent
+        assert zbx_datacontainer.metrics.snapshot()['items_discarded'] == discarded
+
+def test_discard_unchanged_failed_send():
+    """
+    Values are not cached when Zabbix didn't receive them
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer._config.discard_unchanged = 3600
+    for response in ('failed', 'success'):
+        zbx_datacontainer.data_type = 'items'
+        zbx_datacontainer.add(DATA['items'])
+        with mock.patch('protobix.DataContainer._send_common') as mock_send_common:
+            mock_send_common.return_value = (response, 0, 4, 4, 0)
+            zbx_datacontainer.send()
+            assert len(mock_send_common.call_args[0][0]) == 4
+
+@pytest.mark.parametrize('data_type', ('items', 'lld'))
+@pytest.mark.parametrize('diagnose', (False, True))
+def test_value_cache_failed_items(data_type, diagnose):
+    """
+    Values Zabbix rejected are sent again, though Zabbix answers success
+    Without diagnose, failed items are unknown & their whole chunk is sent again
+    """
+    value = [{'{#FSNAME}': '/'}] if data_type == 'lld' else 1
+    with FakeTrapper(failed_keys=['bad.key']) as trapper:
+        zbx_datacontainer = protobix.DataContainer()
+        zbx_datacontainer.server_port = trapper.port
+        zbx_datacontainer._config.discard_unchanged = 3600
+        zbx_datacontainer._config.lld_refresh = 3600
+        zbx_datacontainer._config.diagnose = diagnose
+        for run in range(2):
+            first_sent = len(trapper.received)
+            zbx_datacontainer.data_type = data_type
+            zbx_datacontainer.add({'myhostname': {'good.key': value, 'bad.key': value}})
+            zbx_datacontainer.send()
+        keys = sorted(item['key'] for item in trapper.received[first_sent:])
+    if diagnose:
+        assert keys == ['bad.key']
+        assert len(zbx_datacontainer._value_caches[data_type]) == 1
+    else:
+        assert keys == ['bad.key', 'good.key']
+        assert len(zbx_datacontainer._value_caches[data_type]) == 0
+
+def test_lld_refresh(tmpdir):
+    """
+    Unchanged discovery is only sent once per refresh window,
+    whatever entries & macros order
+    """
+    lld_cache_file = str(tmpdir.join('lld.json'))
+    discovery = [
+        {'{#FSNAME}': '/', '{#FSTYPE}': 'ext4'},
+        {'{#FSNAME}': '/boot', '{#FSTYPE}': 'vfat'},
+    ]
+    reordered = [dict(reversed(list(entry.items()))) for entry in reversed(discovery)]
+    for lld, sent in ((discovery, 1), (reordered, 0), (discovery + [{'{#FSNAME}': '/home'}], 1)):
+        zbx_datacontainer = protobix.DataContainer()
+        zbx_datacontainer._config.lld_refresh = 3600
+        zbx_datacontainer._config.lld_cache_file = lld_cache_file
+        zbx_datacontainer.data_type = 'lld'
+        zbx_datacontainer.add({'myhostname': {'vfs.fs.discovery': lld}})
+        with mock.patch('protobix.DataContainer._send_common') as mock_send_common:
+            mock_send_common.return_value = ('success', 1, 0, 1, 0)
+            zbx_datacontainer.send()
+            assert mock_send_common.call_count == sent
+        if sent:
+            payload = json.loads(mock_send_common.call_args[0][0][0]['value'])
+            assert len(payload['data']) == len(lld)
+
+def test_lld_refresh_not_a_list():
+    """
+    Discovery which isn't a list of entries is sent as is
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer._config.lld_refresh = 3600
+    zbx_datacontainer.data_type = 'lld'
+    zbx_datacontainer.add_item('myhostname', 'my.lld.key1', {'{#NAME}': 'a', '{#TYPE}': 'b'})
+    zbx_datacontainer.add_item('myhostname', 'my.lld.key2', 'a')
+    assert [item['value'] for item in zbx_datacontainer.items_list] == [
+        '{"data": {"{#NAME}": "a", "{#TYPE}": "b"}}', '{"data": "a"}'
+    ]
+
+@pytest.mark.parametrize('lld_first', (True, False))
+def test_mixed_items_and_lld(lld_first):
+    """
+    Items & LLD share chunks & connection, discovery first by default
+    """
+    with FakeTrapper() as trapper:
+        zbx_datacontainer = protobix.DataContainer()
+        zbx_datacontainer.server_port = trapper.port
+        zbx_datacontainer._config.lld_first = lld_first
+        zbx_datacontainer.add(DATA['items'], data_type='items')
+        zbx_datacontainer.add(DATA['lld'], data_type='lld')
+        assert len(zbx_datacontainer.items_list) == 8
+        result = zbx_datacontainer.send()
+        assert result[2] == 8
+        assert zbx_datacontainer.metrics.snapshot()['connections'] == 1
+        keys = [item['key'] for item in trapper.received]
+    lld_keys = [key for key in keys if 'lld' in key]
+    assert len(lld_keys) == 4
+    if lld_first:
+        assert keys[:4] == lld_keys
+    else:
+        assert keys[4:] == lld_keys
+    assert zbx_datacontainer.items_list == []
+
+def test_mixed_items_and_lld_value_caches():
+    """
+    Each data type uses its own value cache
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer._config.discard_unchanged = 3600
+    zbx_datacontainer._config.lld_refresh = 3600
+    for sent in (8, 0):
+        zbx_datacontainer.add(DATA['items'], data_type='items')
+        zbx_datacontainer.add(DATA['lld'], data_type='lld')
+        with mock.patch('protobix.DataContainer._send_common') as mock_send_common:
+            mock_send_common.return_value = ('success', sent, 0, sent, 0)
+            zbx_datacontainer.send()
+            assert mock_send_common.call_count == (1 if sent else 0)
+    assert len(zbx_datacontainer._value_caches['items']) == 4
+    assert len(zbx_datacontainer._value_caches['lld']) == 4
+
+@pytest.mark.parametrize('failed_keys', (
+    ['my.item.key7'],
+    ['my.item.key0', 'my.item.key249'],
+    ['my.item.key10', 'my.item.key11', 'my.item.key200'],
+))
+def test_diagnose(failed_keys):
+    """
+    Chunks with failed items are bisected to find rejected items
+    """
+    with FakeTrapper(failed_keys=failed_keys) as trapper:
+        zbx_datacontainer = protobix.DataContainer()
+        zbx_datacontainer.server_port = trapper.port
+        zbx_datacontainer._config.diagnose = True
+        zbx_datacontainer.data_type = 'items'
+        zbx_datacontainer.add({
+            'myhostname': dict(('my.item.key%d' % index, index) for index in range(500))
+        })
+        result = zbx_datacontainer.send()
+        assert result[3] == len(failed_keys)
+        # Second chunk has no failed items & isn't bisected
+        assert trapper.requests <= 2 + 2 * len(failed_keys) * 8
+    failed_items = zbx_datacontainer.failed_items
+    assert sorted(item['key'] for item in failed_items) == sorted(failed_keys)
+    assert all(item['host'] == 'myhostname' for item in failed_items)
+    assert all(item['error'] is None for item in failed_items)
+
+def test_diagnose_per_item_errors():
+    """
+    Per item errors from Zabbix answer avoid bisecting
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer._config.diagnose = True
+    zbx_datacontainer.data_type = 'items'
+    zbx_datacontainer.add(DATA['items'])
+    zbx_datacontainer._last_response = protobix.SenderResponse(
+        'success', 3, 1, 4, 0, errors=[(2, 'Unsupported item key.')]
+    )
+    with mock.patch('protobix.DataContainer._send_common') as mock_send_common:
+        mock_send_common.return_value = ('success', 3, 1, 4, 0)
+        zbx_datacontainer.send()
+        assert mock_send_common.call_count == 1
+    assert len(zbx_datacontainer.failed_items) == 1
+    assert zbx_datacontainer.failed_items[0]['error'] == 'Unsupported item key.'
+
+def test_debug_sends_bulk():
+    """
+    Debug doesn't send items one by one anymore
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer.debug_level = 4
+    zbx_datacontainer.dryrun = True
+    zbx_datacontainer.data_type = 'items'
+    zbx_datacontainer.add(DATA['items'])
+    zbx_datacontainer.send()
+    assert zbx_datacontainer.metrics.snapshot()['chunks'] == 1
+    assert zbx_datacontainer.failed_items == []
+
+def test_debug_doesnt_diagnose():
+    """
+    Only diagnose option sends failed chunks halves again
+    """
+    with FakeTrapper(failed_keys=['my.protobix.item.int']) as trapper:
+        zbx_datacontainer = protobix.DataContainer()
+        zbx_datacontainer.server_port = trapper.port
+        zbx_datacontainer.debug_level = 4
+        zbx_datacontainer.data_type = 'items'
+        zbx_datacontainer.add(DATA['items'])
+        zbx_datacontainer.send()
+        assert trapper.requests == 1
+    assert zbx_datacontainer.failed_items == []
@@ -0,0 +1,106 @@
+"""
+Tests for protobix.faketrapper
+"""
+import pytest
+import socket
+import time
+try: import simplejson as json
+except ImportError: import json
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix import faketrapper
+
+trappers = [faketrapper.FakeTrapper]
+if faketrapper.asyncio is not None:
+    trappers.append(faketrapper.AsyncFakeTrapper)
+
+def zabbix_request(port, body, compress=False):
+    """
+    Send a raw request & read whole answer, whatever the chunks
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(faketrapper.pack(body, compress))
+    data = b''
+    recv_count = 0
+    while True:
+        _buffer = sock.recv(4096)
+        if not _buffer:
+            break
+        recv_count += 1
+        data += _buffer
+    sock.close()
+    return data, recv_count
+
+@pytest.mark.parametrize('trapper_class', trappers)
+def test_datacontainer_send(trapper_class):
+    """
+    DataContainer can send items to the fake trapper
+    """
+    with trapper_class(failed_keys=['my.failed.key']) as trapper:
+        zbx_datacontainer = protobix.DataContainer()
+        zbx_datacontainer.server_port = trapper.port
+        zbx_datacontainer.data_type = 'items'
+        zbx_datacontainer.add_item('myhostname', 'my.item.key', 1)
+        zbx_datacontainer.add_item('myhostname', 'my.failed.key', 2)
+        srv_success, srv_failure, processed, failed, total, time = zbx_datacontainer.send()
+    assert srv_success == 1
+    assert processed == 1
+    assert failed == 1
+    assert total == 2
+    assert trapper.requests == 1
+    assert [item['key'] for item in trapper.received] == ['my.item.key', 'my.failed.key']
+
+@pytest.mark.parametrize('trapper_class', trappers)
+def test_compressed_request(trapper_class):
+    """
+    Compressed requests are answered with compression
+    """
+    body = json.dumps({'request': 'sender data', 'data': [{'key': 'my.item.key'}]}).encode()
+    with trapper_class() as trapper:
+        data, recv_count = zabbix_request(trapper.port, body, compress=True)
+    answer, compressed = faketrapper.unpack(data)
+    assert compressed is True
+    assert json.loads(answer.decode())['info'].startswith('processed: 1; failed: 0; total: 1;')
+
+@pytest.mark.parametrize('trapper_class', trappers)
+def test_partial_answer(trapper_class):
+    """
+    Answer can be written by small chunks
+    """
+    body = json.dumps({'request': 'sender data', 'data': []}).encode()
+    with trapper_class(chunk_size=10, chunk_delay=0.01) as trapper:
+        data, recv_count = zabbix_request(trapper.port, body)
+    assert faketrapper.unpack(data) is not None
+    assert recv_count > 1
+
+@pytest.mark.parametrize('trapper_class', trappers)
+def test_latency(trapper_class):
+    """
+    Answer can be delayed
+    """
+    body = json.dumps({'request': 'sender data', 'data': []}).encode()
+    with trapper_class(latency=0.2) as trapper:
+        start = time.time()
+        zabbix_request(trapper.port, body)
+        assert time.time() - start >= 0.2
+
+@pytest.mark.parametrize('trapper_class', trappers)
+def test_drop_connection(trapper_class):
+    """
+    Connections can be dropped without answer
+    """
+    with trapper_class(drop=1) as trapper:
+        zbx_datacontainer = protobix.DataContainer()
+        zbx_datacontainer.server_port = trapper.port
+        zbx_datacontainer.data_type = 'items'
+        zbx_datacontainer.add_item('myhostname', 'my.item.key', 1)
+        # Client either fails to send or gets an empty answer
+        with pytest.raises((socket.error, protobix.ZabbixProtocolError)):
+            zbx_datacontainer.send()
+        zbx_datacontainer.data_type = 'items'
+        zbx_datacontainer.add_item('myhostname', 'my.item.key', 1)
+        assert zbx_datacontainer.send()[2] == 1
+    assert trapper.requests == 1
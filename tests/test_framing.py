@@ -0,0 +1,33 @@
+"""
+Tests for protobix.framing
+"""
+import pytest
+import struct
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix import framing
+
+@pytest.mark.parametrize('compress', (False, True))
+def test_pack_unpack(compress):
+    """
+    Packets are unpacked once complete
+    """
+    packet = framing.pack(b'{"request": "sender data"}', compress)
+    assert framing.packet_size(packet) == len(packet)
+    assert framing.unpack(packet) == (b'{"request": "sender data"}', compress)
+    assert framing.unpack(packet[:-1]) is None
+    assert framing.packet_size(packet[:12]) is None
+
+def test_sender_header():
+    """
+    Uncompressed header is ZBXD, protocol flag & 64 bits length
+    """
+    assert framing.pack(b'{}') == b'ZBXD\x01' + struct.pack('<Q', 2) + b'{}'
+
+def test_invalid_header():
+    with pytest.raises(ValueError) as err:
+        framing.unpack(b'HTTP/1.1 200 OK\r\n\r\n')
+    assert str(err.value) == 'Invalid Zabbix header'
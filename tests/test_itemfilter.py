@@ -0,0 +1,148 @@
+"""
+Tests for protobix.itemfilter
+"""
+import pytest
+import mock
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix.itemfilter import RejectedKeys
+from protobix.faketrapper import FakeTrapper
+
+def item(key, host='myhostname'):
+    return {'host': host, 'key': key, 'value': 1, 'clock': 1000}
+
+def test_rejected_ttl():
+    """
+    Rejected items are dropped until ttl elapsed
+    """
+    rejected_keys = RejectedKeys(60)
+    items = [item('my.item.key1'), item('my.item.key2'), item('my.item.key1', 'otherhostname')]
+    assert rejected_keys.filter(items, 1000) == items
+    rejected_keys.add([items[0]], 1000)
+    assert rejected_keys.filter(items, 1059) == items[1:]
+    assert len(rejected_keys) == 1
+    assert rejected_keys.filter(items, 1060) == items
+    assert len(rejected_keys) == 0
+
+def test_state_file(tmpdir):
+    """
+    Rejected items are kept between instances, expired ones aren't
+    """
+    state_file = str(tmpdir.join('rejected.json'))
+    rejected_keys = RejectedKeys(60, state_file)
+    rejected_keys.add([item('my.item.key1')], 1000)
+    rejected_keys.add([item('my.item.key2')], 2000)
+    rejected_keys.save()
+    rejected_keys = RejectedKeys(60, state_file)
+    assert len(rejected_keys) == 2
+    items = [item('my.item.key1'), item('my.item.key2')]
+    assert rejected_keys.filter(items, 1100) == items[:1]
+
+def test_invalid_state_file(tmpdir):
+    """
+    Missing or invalid state file gives an empty filter
+    """
+    state_file = tmpdir.join('rejected.json')
+    assert len(RejectedKeys(60, str(state_file))) == 0
+    state_file.write('invalid')
+    assert len(RejectedKeys(60, str(state_file))) == 0
+
+def test_clear():
+    rejected_keys = RejectedKeys(60)
+    rejected_keys.add([item('my.item.key')], 1000)
+    rejected_keys.clear()
+    assert len(rejected_keys) == 0
+
+def test_send_filters_rejected_items():
+    """
+    Items Zabbix rejected aren't sent again, items & LLD alike
+    """
+    with FakeTrapper(failed_keys=['my.item.key3', 'my.lld.key']) as trapper:
+        zbx_datacontainer = protobix.DataContainer()
+        zbx_datacontainer.server_port = trapper.port
+        zbx_datacontainer._config.item_filter_ttl = 3600
+        zbx_datacontainer._config.diagnose = True
+        for run in range(2):
+            first_sent = len(trapper.received)
+            zbx_datacontainer.add({
+                'myhostname': dict(('my.item.key%d' % index, index) for index in range(5)),
+                'otherhostname': {'my.item.key3': 0},
+            }, data_type='items')
+            zbx_datacontainer.add({'myhostname': {'my.lld.key': [{'{#NAME}': 'a'}]}}, data_type='lld')
+            zbx_datacontainer.send()
+    sent = sorted((item['host'], item['key']) for item in trapper.received[first_sent:])
+    assert sent == [('myhostname', 'my.item.key%d' % index) for index in (0, 1, 2, 4)]
+    assert zbx_datacontainer.metrics.snapshot()['items_filtered'] == 3
+
+def test_send_filters_across_containers(tmpdir):
+    """
+    With item_filter_file, items rejected by a probe run are filtered
+    by the next one
+    """
+    state_file = str(tmpdir.join('rejected.json'))
+    with FakeTrapper(failed_keys=['my.item.key1']) as trapper:
+        for run in range(2):
+            first_sent = len(trapper.received)
+            zbx_datacontainer = protobix.DataContainer()
+            zbx_datacontainer.server_port = trapper.port
+            zbx_datacontainer._config.item_filter_ttl = 3600
+            zbx_datacontainer._config.item_filter_file = state_file
+            zbx_datacontainer._config.diagnose = True
+            zbx_datacontainer.data_type = 'items'
+            zbx_datacontainer.add({'myhostname': {'my.item.key1': 1, 'my.item.key2': 2}})
+            zbx_datacontainer.send()
+    assert [item['key'] for item in trapper.received[first_sent:]] == ['my.item.key2']
+
+def test_send_per_item_errors():
+    """
+    Per item errors from Zabbix answer are enough to filter items
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer._config.item_filter_ttl = 3600
+    zbx_datacontainer.data_type = 'items'
+    zbx_datacontainer.add_item('myhostname', 'my.item.key1', 1)
+    zbx_datacontainer.add_item('myhostname', 'my.item.key2', 1)
+    zbx_datacontainer._last_response = protobix.SenderResponse(
+        'success', 1, 1, 2, 0, errors=[(1, 'Unsupported item key.')]
+    )
+    with mock.patch('protobix.DataContainer._send_common') as mock_send_common:
+        mock_send_common.return_value = ('success', 1, 1, 2, 0)
+        zbx_datacontainer.send()
+        assert mock_send_common.call_count == 1
+        zbx_datacontainer._last_response = None
+        zbx_datacontainer.data_type = 'items'
+        zbx_datacontainer.add_item('myhostname', 'my.item.key1', 1)
+        zbx_datacontainer.add_item('myhostname', 'my.item.key2', 1)
+        zbx_datacontainer.send()
+        assert [item['key'] for item in mock_send_common.call_args[0][0]] == ['my.item.key1']
+
+def test_unknown_failed_items_not_filtered():
+    """
+    Without diagnose nor per item errors, failed items are unknown
+    & everything is sent again
+    """
+    with FakeTrapper(failed_keys=['my.item.key1']) as trapper:
+        zbx_datacontainer = protobix.DataContainer()
+        zbx_datacontainer.server_port = trapper.port
+        zbx_datacontainer._config.item_filter_ttl = 3600
+        for run in range(2):
+            zbx_datacontainer.data_type = 'items'
+            zbx_datacontainer.add({'myhostname': {'my.item.key1': 1, 'my.item.key2': 2}})
+            zbx_datacontainer.send()
+    assert len(trapper.received) == 4
+    assert len(zbx_datacontainer._rejected_keys) == 0
+
+def test_reload_config_clears_rejected_items():
+    """
+    Another Zabbix Server may accept rejected items
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer._config.item_filter_ttl = 3600
+    zbx_datacontainer._init_rejected_keys().add([item('my.item.key')])
+    with mock.patch('protobix.ZabbixAgentConfig.reload') as mock_reload:
+        mock_reload.return_value = True
+        assert zbx_datacontainer.reload_config() is True
+    assert len(zbx_datacontainer._rejected_keys) == 0
@@ -1,17 +1,27 @@
 """
 Test long running process & detect memory leak
+Allocations made from protobix are traced with tracemalloc
 """
-import configobj
 import pytest
-import mock
-import unittest
+import gc
 
-import resource
 import sys
 import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 import protobix
+from protobix.faketrapper import FakeTrapper
+try: import tracemalloc
+except ImportError: tracemalloc = None
+
+# Cycles run before first snapshot so that caches & counters are set up
+WARMUP_CYCLES = 100
+# Memory retained per cycle above this is considered as a leak
+MAX_BYTES_PER_CYCLE = 16
+TRACEMALLOC_FRAMES = 10
+TOP_ALLOCATIONS = 10
+# Only protobix package, not tests nor a checkout directory named protobix
+PROTOBIX_DIR = os.path.dirname(protobix.__file__)
 
 PAYLOAD = {
     "items": {
@@ -81,47 +91,70 @@ PAYLOAD = {
     }
 }
 
-def long_run(data_type, debug_level):
+def protobix_traces(snapshot):
+    """
+    Keep allocations with protobix in their traceback
+    except the ones from the fake trapper itself
+    """
+    return snapshot.filter_traces([
+        tracemalloc.Filter(True, os.path.join(PROTOBIX_DIR, '*'), all_frames=True),
+        tracemalloc.Filter(False, os.path.join(PROTOBIX_DIR, 'faketrapper.py'), all_frames=True),
+    ])
+
+def long_run(data_type, debug_level, cycles):
     """
     Generic long running process simulator
     Used by tests below
+    Returns memory retained between first & last cycle
+    and allocation sites sorted by retained size
     """
-    zbx_container = protobix.DataContainer()
-    zbx_container.debug_level = debug_level
-    run=1
-    max_run=1000
-    while run <= max_run:
-        zbx_container.data_type = data_type
-        zbx_container.add(PAYLOAD[data_type])
-        try:
+    with FakeTrapper() as trapper:
+        zbx_container = protobix.DataContainer()
+        zbx_container.server_port = trapper.port
+        zbx_container.debug_level = debug_level
+
+        def cycle():
+            zbx_container.data_type = data_type
+            zbx_container.add(PAYLOAD[data_type])
             zbx_container.send()
-        except:
-            pass
-        if run % (max_run/10) == 0 or run <=1:
-            usage=resource.getrusage(resource.RUSAGE_SELF)
-            display_memory = usage[2]*resource.getpagesize()/1000000.0
-            if run == 1:
-                initial_memory = usage[2]
-                display_initial_memory = usage[2]*resource.getpagesize()/1000000.0
-            final_memory = usage[2]
-            print ('Run %i: ru_maxrss=%f mb - initial=%f mb' % (
-                run, (display_memory), display_initial_memory
-            ))
-        run += 1
-    return initial_memory, final_memory
+            del trapper.received[:]
+
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        try:
+            for run in range(WARMUP_CYCLES):
+                cycle()
+            gc.collect()
+            initial_snapshot = protobix_traces(tracemalloc.take_snapshot())
+            for run in range(cycles):
+                cycle()
+            gc.collect()
+            final_snapshot = protobix_traces(tracemalloc.take_snapshot())
+        finally:
+            tracemalloc.stop()
+    statistics = final_snapshot.compare_to(initial_snapshot, 'traceback')
+    retained = sum(stat.size_diff for stat in statistics)
+    return retained, statistics
 
 memory_leak_matrix = (
-    ('items', 2),
-    ('items', 4),
-    ('lld', 2),
-    ('lld', 4)
+    ('items', 2, 2000),
+    ('items', 4, 2000),
+    ('lld', 2, 2000),
+    ('lld', 4, 2000)
 )
 
-@pytest.mark.parametrize(('data_type','debug_level'), memory_leak_matrix)
-def test_long_run_for_memory_leak(data_type, debug_level):
+@pytest.mark.skipif(tracemalloc is None, reason='tracemalloc requires Python 3.4')
+@pytest.mark.parametrize(('data_type','debug_level','cycles'), memory_leak_matrix)
+def test_long_run_for_memory_leak(data_type, debug_level, cycles):
     """
     Simulate long running process with and without debug
-    and control memory usage
+    and control memory retained by protobix
     """
-    initial_memory, final_memory = long_run(data_type, debug_level)
-    assert initial_memory == final_memory
+    retained, statistics = long_run(data_type, debug_level, cycles)
+    print('%d cycles: %d bytes retained, %.2f bytes per cycle' % (
+        cycles, retained, float(retained) / cycles
+    ))
+    for stat in statistics[:TOP_ALLOCATIONS]:
+        print('%+d bytes in %d blocks' % (stat.size_diff, stat.count_diff))
+        for line in stat.traceback.format()[-4:]:
+            print(line)
+    assert float(retained) / cycles <= MAX_BYTES_PER_CYCLE
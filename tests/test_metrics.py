@@ -0,0 +1,73 @@
+"""
+Tests for protobix.SenderMetrics
+"""
+import pytest
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+
+def test_default_metrics():
+    """
+    All metrics are 0 by default
+    """
+    metrics = protobix.SenderMetrics()
+    snapshot = metrics.snapshot()
+    assert snapshot['items_queued'] == 0
+    assert snapshot['round_trip_seconds_count'] == 0
+    assert snapshot['round_trip_seconds_sum'] == 0
+    assert all(value == 0 for value in snapshot.values())
+
+def test_counters_and_histograms():
+    """
+    Counters & histograms are updated
+    """
+    metrics = protobix.SenderMetrics()
+    metrics.inc('items_sent', 10)
+    metrics.inc('chunks')
+    metrics.observe('connect', 0.002)
+    metrics.observe('connect', 10)
+    snapshot = metrics.snapshot()
+    assert snapshot['items_sent'] == 10
+    assert snapshot['chunks'] == 1
+    assert snapshot['connect_seconds_count'] == 2
+    assert snapshot['connect_seconds_sum'] == 10.002
+    assert metrics.histograms['connect'].counts == [0, 1, 0, 0, 0, 0, 0, 0, 1]
+    metrics.reset()
+    assert metrics.snapshot()['items_sent'] == 0
+
+def test_unknown_metric():
+    """
+    Unknown metrics are refused
+    """
+    metrics = protobix.SenderMetrics()
+    with pytest.raises(KeyError):
+        metrics.inc('unknown')
+
+def test_zabbix_items():
+    """
+    Metrics are exported as protobix.sender.* items
+    """
+    metrics = protobix.SenderMetrics()
+    metrics.inc('bytes_sent', 42)
+    items = metrics.zabbix_items()
+    assert items['protobix.sender.bytes_sent'] == 42
+    assert 'protobix.sender.round_trip_seconds_sum' in items
+
+def test_expose():
+    """
+    Text exposition uses Prometheus format
+    """
+    metrics = protobix.SenderMetrics()
+    metrics.inc('items_sent', 3)
+    metrics.observe('round_trip', 0.02)
+    lines = metrics.expose().splitlines()
+    assert '# TYPE protobix_sender_items_sent_total counter' in lines
+    assert 'protobix_sender_items_sent_total 3' in lines
+    assert '# TYPE protobix_sender_round_trip_seconds histogram' in lines
+    assert 'protobix_sender_round_trip_seconds_bucket{le="0.01"} 0' in lines
+    assert 'protobix_sender_round_trip_seconds_bucket{le="0.05"} 1' in lines
+    assert 'protobix_sender_round_trip_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'protobix_sender_round_trip_seconds_sum 0.02' in lines
+    assert 'protobix_sender_round_trip_seconds_count 1' in lines
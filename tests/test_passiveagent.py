@@ -0,0 +1,109 @@
+"""
+Tests for protobix.passiveagent
+"""
+import pytest
+import socket
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix import framing, passiveagent
+from protobix.passiveagent import PassiveAgent, parse_request, format_value
+
+pytestmark = pytest.mark.skipif(
+    passiveagent.asyncio is None, reason='Passive agent requires asyncio'
+)
+
+def agent_request(port, data):
+    """
+    Send a raw request & read whole answer
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(data)
+    answer = b''
+    while True:
+        _buffer = sock.recv(4096)
+        if not _buffer:
+            break
+        answer += _buffer
+    sock.close()
+    return answer
+
+def values():
+    return {
+        'otherhostname': {'my.item.key': 'other', 'my.other.key': 2},
+        'myhostname': {'my.item.key': 1.5, 'my.lld.key': [{'{#NAME}': 'a'}]},
+    }
+
+def test_parse_request():
+    """
+    Keys are sent with Zabbix header or as text lines
+    """
+    assert parse_request(framing.pack(b'agent.ping')) == 'agent.ping'
+    assert parse_request(framing.pack(b'agent.ping')[:-1]) is None
+    assert parse_request(b'agent.ping\n') == 'agent.ping'
+    assert parse_request(b'agent.ping') is None
+
+def test_format_value():
+    """
+    Values are sent as text
+    """
+    assert format_value(1) == '1'
+    assert format_value(1.5) == '1.5'
+    assert format_value('string') == 'string'
+    assert format_value({'data': []}) == '{"data": []}'
+
+def test_collect():
+    """
+    Only configured host values are served
+    """
+    agent = PassiveAgent(values, 'myhostname')
+    assert agent.collect() is True
+    assert agent._answer('my.item.key') == b'1.5'
+    assert agent._answer('my.other.key') == b'ZBX_NOTSUPPORTED\0Unsupported item key.'
+    assert agent._answer('unknown.key') == b'ZBX_NOTSUPPORTED\0Unsupported item key.'
+    assert agent._answer('agent.ping') == b'1'
+
+def test_collect_failed():
+    """
+    Previous values are kept when collection fails
+    """
+    results = [values(), Exception('Backend is down')]
+    def collect():
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    agent = PassiveAgent(collect, 'myhostname')
+    assert agent.collect() is True
+    assert agent.collect() is False
+    assert agent._answer('my.item.key') == b'1.5'
+
+def test_serve():
+    """
+    Values are served over Zabbix agent protocol
+    """
+    with PassiveAgent(values, 'myhostname', host='127.0.0.1', port=0) as agent:
+        answer = agent_request(agent.port, framing.pack(b'my.item.key'))
+        assert framing.unpack(answer) == (b'1.5', False)
+        answer = agent_request(agent.port, b'my.other.key\n')
+        assert framing.unpack(answer) == (b'ZBX_NOTSUPPORTED\0Unsupported item key.', False)
+        answer = agent_request(agent.port, b'my.lld.key\n')
+        assert framing.unpack(answer) == (b'[{"{#NAME}": "a"}]', False)
+        assert agent.requests == 3
+
+def test_refresh():
+    """
+    Values are collected again every refresh seconds
+    """
+    counter = []
+    def collect():
+        counter.append(1)
+        return {'myhostname': {'my.item.key': len(counter)}}
+    with PassiveAgent(collect, 'myhostname', host='127.0.0.1', port=0, refresh=0.05) as agent:
+        for attempt in range(100):
+            if len(counter) >= 3:
+                break
+            agent._stopped.wait(0.01)
+        assert agent._answer('my.item.key') != b'1'
@@ -0,0 +1,85 @@
+"""
+Tests for protobix.profiling
+"""
+import pytest
+import mock
+import time
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix.faketrapper import FakeTrapper
+from protobix.profiling import RunProfile, NO_STEP
+
+def test_steps():
+    """
+    Steps wall & CPU times are summed per name
+    """
+    profile = RunProfile()
+    for _ in range(2):
+        with profile.step('get_data'):
+            time.sleep(0.01)
+    with pytest.raises(ValueError):
+        with profile.step('add'):
+            raise ValueError
+    assert list(profile.steps) == ['get_data', 'add']
+    assert profile.steps['get_data']['count'] == 2
+    assert profile.steps['get_data']['wall'] >= 0.02
+    assert profile.steps['get_data']['cpu'] < profile.steps['get_data']['wall']
+    assert profile.steps['add']['count'] == 1
+    with NO_STEP:
+        pass
+
+def test_phases():
+    """
+    Send phases are recorded through tracer hooks,
+    phases which raised aren't
+    """
+    profile = RunProfile()
+    profile.before('send', items=2)
+    profile.before('connect')
+    profile.after('connect', 0.1)
+    profile.before('sendall')
+    profile.after('send', 0.2)
+    profile.after('unknown', 0.1)
+    assert sorted(profile.phases) == ['connect', 'send']
+
+def test_items():
+    """
+    Profile is turned into Zabbix items
+    """
+    profile = RunProfile()
+    with profile.step('send'):
+        pass
+    profile.before('send')
+    profile.after('send', 0)
+    items = profile.items()
+    assert 'protobix.profile.step[send,wall]' in items
+    assert 'protobix.profile.phase[send,cpu]' in items
+    if hasattr(sys, 'getallocatedblocks'):
+        assert 'protobix.profile.step[send,net_blocks]' in items
+    assert 'step send: 1 call(s)' in profile.report()
+
+def test_reports(tmpdir):
+    """
+    cProfile & tracemalloc reports are written into directory
+    """
+    profile = RunProfile(str(tmpdir))
+    profile.start()
+    with profile.step('get_data'):
+        [str(index) for index in range(1000)]
+    files = profile.stop()
+    assert all(os.path.dirname(path) == str(tmpdir) for path in files)
+    assert [os.path.splitext(path)[1] for path in files[:2]] == ['.json', '.prof']
+    import pstats
+    pstats.Stats(files[1])
+    assert profile.stop() == []
+
+def test_no_reports():
+    """
+    Nothing is written without directory
+    """
+    profile = RunProfile()
+    profile.start()
+    assert profile.stop() == []
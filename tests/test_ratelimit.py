@@ -0,0 +1,125 @@
+"""
+Tests for protobix.ratelimit
+"""
+import pytest
+import mock
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix.ratelimit import TokenBucket, RateLimiter, MAX_BACKPRESSURE_PAUSE
+from protobix.faketrapper import FakeTrapper
+
+def test_token_bucket():
+    """
+    Bucket starts full & reservations beyond it have to wait
+    """
+    bucket = TokenBucket(100)
+    now = bucket._updated
+    assert bucket.reserve(100, now) == 0
+    assert bucket.reserve(50, now) == 0.5
+    # Previous reservation is paid first
+    assert bucket.reserve(50, now) == 1.0
+    assert bucket.reserve(50, now + 2) == 0
+
+def test_token_bucket_unlimited():
+    """
+    0 means unlimited
+    """
+    bucket = TokenBucket()
+    assert bucket.reserve(10 ** 9, bucket._updated) == 0
+
+def test_rate_limiter_items_and_bytes():
+    """
+    Slowest limit wins
+    """
+    limiter = RateLimiter(items_per_second=1000, bytes_per_second=10000)
+    assert limiter.reserve(250, 1000) == 0
+    assert limiter.reserve(250, 19000) == pytest.approx(1.0, abs=0.01)
+
+def test_rate_limiter_acquire_sleeps():
+    """
+    acquire waits for reservation
+    """
+    limiter = RateLimiter(items_per_second=100)
+    with mock.patch('time.sleep') as mock_sleep:
+        assert limiter.acquire(100, 0) == 0
+        waited = limiter.acquire(50, 0)
+    assert waited == pytest.approx(0.5, abs=0.01)
+    mock_sleep.assert_called_once_with(waited)
+
+def test_backpressure():
+    """
+    Slow & failed answers double pause between chunks, fast ones halve it
+    """
+    limiter = RateLimiter(threshold=0.5)
+    limiter.feedback('success', 0.1, 0.01)
+    assert limiter.pause == 0
+    limiter.feedback('success', 1.0, 0.01)
+    assert limiter.pause == 1.0
+    limiter.feedback('success', 0.1, 0.6)
+    assert limiter.pause == 2.0
+    limiter.feedback('failed', 0.1, 0.01)
+    assert limiter.pause == 4.0
+    limiter.feedback('success', 0.1, 0.01)
+    assert limiter.pause == 2.0
+    for run in range(10):
+        limiter.feedback('failed', 0.1, 0.01)
+    assert limiter.pause == MAX_BACKPRESSURE_PAUSE
+    # Pause starts with answer, then chunks are spaced by pause
+    limiter.pause = 1.0
+    limiter.feedback('success', 0.1, 0.01)
+    assert limiter.reserve(1, 1) == pytest.approx(0.5, abs=0.01)
+    assert limiter.reserve(1, 1) == pytest.approx(1.0, abs=0.01)
+
+def test_backpressure_disabled():
+    """
+    No threshold means no backpressure
+    """
+    limiter = RateLimiter()
+    limiter.feedback('failed', 10, 10)
+    assert limiter.pause == 0
+
+def test_shared():
+    """
+    Limiters are shared by Zabbix Server
+    """
+    assert RateLimiter.shared('zabbix.domain.tld', 10051) is \
+        RateLimiter.shared('zabbix.domain.tld', 10051)
+    assert RateLimiter.shared('zabbix.domain.tld', 10051) is not \
+        RateLimiter.shared('proxy.domain.tld', 10051)
+
+def test_rate_limiter_disabled_by_default():
+    """
+    No limiter is used without configuration
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    assert zbx_datacontainer._rate_limiter() is None
+    zbx_datacontainer._config.rate_limit_items = 100
+    assert zbx_datacontainer._rate_limiter() is RateLimiter.shared(
+        zbx_datacontainer.server_active, zbx_datacontainer.server_port
+    )
+
+def test_send_with_rate_limit_and_backpressure():
+    """
+    Chunks are rate limited & slowed down by a slow trapper
+    """
+    with FakeTrapper(latency=0.05) as trapper:
+        zbx_datacontainer = protobix.DataContainer()
+        zbx_datacontainer.server_port = trapper.port
+        zbx_datacontainer._config.rate_limit_items = 10000
+        zbx_datacontainer._config.backpressure_threshold = 0.01
+        zbx_datacontainer.data_type = 'items'
+        zbx_datacontainer.add({
+            'myhostname': dict(('my.item.key%d' % index, index) for index in range(750))
+        })
+        zbx_datacontainer.send()
+        assert len(trapper.received) == 750
+    limiter = zbx_datacontainer._rate_limiter()
+    assert limiter.pause >= 0.1
+    # Second & third chunks wait for backpressure
+    snapshot = zbx_datacontainer.metrics.snapshot()
+    assert snapshot['throttle_seconds_count'] == 2
+    assert snapshot['throttle_seconds_sum'] >= 0.14
+    limiter.configure(0, 0, None)
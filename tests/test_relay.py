@@ -0,0 +1,147 @@
+"""
+Tests for protobix.relay
+"""
+import pytest
+import mock
+import socket
+import threading
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix.faketrapper import FakeTrapper
+from protobix import framing
+from protobix.relay import Relay, _parse_args, RELAY_SOCKET
+
+def relay_config(trapper):
+    zbx_config = protobix.ZabbixAgentConfig()
+    zbx_config.server_port = trapper.port
+    return zbx_config
+
+def probe_container(socket_path):
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer._config.relay_socket = socket_path
+    return zbx_datacontainer
+
+def test_relay_coalesces_probes(tmpdir):
+    """
+    Items of many probes are forwarded in full chunks
+    """
+    socket_path = str(tmpdir.join('relay.sock'))
+    with FakeTrapper() as trapper:
+        with Relay(socket_path, relay_config(trapper), flush_interval=5) as relay:
+            def probe(index):
+                zbx_datacontainer = probe_container(socket_path)
+                zbx_datacontainer.data_type = 'items'
+                zbx_datacontainer.add({
+                    'host%d' % index: dict(('my.item.key%d' % key, key) for key in range(10))
+                })
+                assert zbx_datacontainer.send()[2] == 10
+            threads = [threading.Thread(target=probe, args=(index,)) for index in range(50)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert len(trapper.received) == 500
+        assert trapper.requests == 2
+    assert relay.metrics.snapshot()['items_sent'] == 500
+    assert not os.path.exists(socket_path)
+
+def test_relay_flush_interval(tmpdir):
+    """
+    Items are forwarded after flush_interval even if chunk isn't full
+    """
+    socket_path = str(tmpdir.join('relay.sock'))
+    with FakeTrapper() as trapper:
+        with Relay(socket_path, relay_config(trapper), flush_interval=0.05):
+            zbx_datacontainer = probe_container(socket_path)
+            zbx_datacontainer.data_type = 'lld'
+            zbx_datacontainer.add_item('myhostname', 'my.lld.key', [{'{#NAME}': 'a'}])
+            zbx_datacontainer.send()
+            for attempt in range(100):
+                if trapper.received:
+                    break
+                threading.Event().wait(0.01)
+            assert len(trapper.received) == 1
+    assert trapper.received[0]['value'] == '{"data": [{"{#NAME}": "a"}]}'
+
+def test_relay_queue_full(tmpdir):
+    """
+    Items beyond max_queue are refused
+    """
+    socket_path = str(tmpdir.join('relay.sock'))
+    with FakeTrapper() as trapper:
+        with Relay(socket_path, relay_config(trapper), flush_interval=5, max_queue=5):
+            zbx_datacontainer = probe_container(socket_path)
+            zbx_datacontainer.data_type = 'items'
+            zbx_datacontainer.add({'myhostname': {'my.item.key1': 1, 'my.item.key2': 2}})
+            assert zbx_datacontainer.send()[2:5] == (2, 0, 2)
+            zbx_datacontainer.data_type = 'items'
+            zbx_datacontainer.add({
+                'myhostname': dict(('my.item.key%d' % key, key) for key in range(4))
+            })
+            assert zbx_datacontainer.send()[2:5] == (0, 4, 4)
+        assert len(trapper.received) == 2
+
+def test_relay_forward_error(tmpdir):
+    """
+    Unexpected errors drop the batch but don't stop forwarding
+    """
+    socket_path = str(tmpdir.join('relay.sock'))
+    with FakeTrapper() as trapper:
+        with Relay(socket_path, relay_config(trapper), flush_interval=0.05) as relay:
+            with mock.patch.object(relay._container, 'send') as mock_send:
+                mock_send.side_effect = NotImplementedError('PSK is not supported')
+                relay._forward([{'host': 'myhostname', 'key': 'my.item.key1', 'value': 1}])
+            relay._forward(['invalid item'])
+            relay._forward([{'host': 'myhostname', 'key': 'my.item.key2', 'value': 2}])
+            assert relay._threads[1].is_alive()
+    assert [item['key'] for item in trapper.received] == ['my.item.key2']
+
+def test_relay_socket_mode(tmpdir):
+    """
+    Only relay's user may send items by default
+    """
+    socket_path = str(tmpdir.join('relay.sock'))
+    with Relay(socket_path, protobix.ZabbixAgentConfig()):
+        assert os.stat(socket_path).st_mode & 0o777 == 0o600
+    with Relay(socket_path, protobix.ZabbixAgentConfig(), socket_mode=0o660):
+        assert os.stat(socket_path).st_mode & 0o777 == 0o660
+
+def test_relay_request_too_big(tmpdir):
+    """
+    Requests over RELAY_MAX_REQUEST_SIZE are refused once header is read
+    """
+    socket_path = str(tmpdir.join('relay.sock'))
+    with mock.patch('protobix.relay.RELAY_MAX_REQUEST_SIZE', 100):
+        with Relay(socket_path, protobix.ZabbixAgentConfig()):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(socket_path)
+            sock.sendall(framing.pack(b'x' * 200)[:50])
+            assert sock.recv(4096) == b''
+            sock.close()
+
+def test_relay_unsupported_request(tmpdir):
+    """
+    Only sender data requests are relayed
+    """
+    relay = Relay(str(tmpdir.join('relay.sock')), protobix.ZabbixAgentConfig())
+    assert relay._answer(b'{"request": "active checks", "host": "myhostname"}') == \
+        {'response': 'failed', 'info': 'unsupported request'}
+    assert relay._answer(b'invalid') is None
+
+def test_parse_args():
+    """
+    Default relay options
+    """
+    options = _parse_args([])
+    assert options.socket == RELAY_SOCKET
+    assert options.config_file is None
+    assert options.socket_mode == 0o600
+    options = _parse_args(['-s', '/tmp/relay.sock', '--flush-interval', '0.5', '-vv',
+                           '--socket-mode', '0660'])
+    assert options.socket == '/tmp/relay.sock'
+    assert options.socket_mode == 0o660
+    assert options.flush_interval == 0.5
+    assert options.verbose == 2
@@ -0,0 +1,67 @@
+"""
+Tests for protobix.response
+"""
+import pytest
+try: import simplejson as json
+except ImportError: import json
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix.response import parse_response
+
+response_info_params = (
+    # Zabbix Sender protocol <= 2.0
+    'Processed 1 Failed 2 Total 3 Seconds spent 0.123456',
+    # Zabbix Sender protocol >= 2.2
+    'processed: 1; failed: 2; total: 3; seconds spent: 0.123456',
+)
+@pytest.mark.parametrize('info', response_info_params)
+def test_parse_response_info(info):
+    """
+    Counters are read from info string
+    """
+    response = parse_response(json.dumps({'response': 'success', 'info': info}))
+    assert isinstance(response, protobix.SenderResponse)
+    assert response.as_tuple() == ('success', 1, 2, 3, 0.123456)
+    assert response.errors == []
+
+def test_parse_response_structured():
+    """
+    Structured counters are preferred over info string
+    """
+    response = parse_response(json.dumps({
+        'response': 'success',
+        'info': 'processed: 9; failed: 9; total: 9; seconds spent: 9.000000',
+        'processed': 1, 'failed': 2, 'total': 3, 'seconds spent': 0.5
+    }))
+    assert response.as_tuple() == ('success', 1, 2, 3, 0.5)
+
+def test_parse_response_item_errors():
+    """
+    Per item results give failed items index & error
+    """
+    response = parse_response(json.dumps({
+        'response': 'success',
+        'data': [{}, {'error': 'Unknown item'}, {}, {'error': 'Invalid value'}]
+    }))
+    assert response.as_tuple() == ('success', 2, 2, 4, 0.0)
+    assert response.errors == [(1, 'Unknown item'), (3, 'Invalid value')]
+
+response_invalid_params = (
+    ('not json', 'Invalid JSON in Zabbix answer'),
+    ('[]', 'Invalid JSON in Zabbix answer'),
+    ('{"response": "failed", "info": "cannot parse"}',
+     'Unable to parse Zabbix answer: cannot parse'),
+    ('{"response": "success"}', 'Unable to parse Zabbix answer: None'),
+)
+@pytest.mark.parametrize(('body', 'message'), response_invalid_params)
+def test_parse_response_invalid(body, message):
+    """
+    Invalid answers raise ZabbixResponseError
+    """
+    with pytest.raises(protobix.ZabbixResponseError) as err:
+        parse_response(body)
+    assert str(err.value) == message
+    assert isinstance(err.value, protobix.ZabbixProtocolError)
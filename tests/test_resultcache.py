@@ -0,0 +1,75 @@
+"""
+Tests for protobix.resultcache
+"""
+import pytest
+import mock
+import threading
+import time
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix.resultcache import ResultCache, default_directory
+
+def test_ttl(tmpdir):
+    """
+    Results are reused until ttl
+    """
+    cache = ResultCache(str(tmpdir), 'protobix-test', 60)
+    collect = mock.Mock(return_value={'myhostname': {'my.item.key': 1}})
+    assert cache.get('items', collect) == {'myhostname': {'my.item.key': 1}}
+    assert cache.get('items', collect) == {'myhostname': {'my.item.key': 1}}
+    assert collect.call_count == 1
+    with mock.patch('time.time', return_value=time.time() + 60):
+        cache.get('items', collect)
+    assert collect.call_count == 2
+
+def test_none_not_cached(tmpdir):
+    """
+    None results are collected each time
+    """
+    cache = ResultCache(str(tmpdir), 'protobix-test', 60)
+    collect = mock.Mock(return_value=None)
+    assert cache.get('raw', collect) is None
+    assert cache.get('raw', collect) is None
+    assert collect.call_count == 2
+    assert not os.path.exists(cache.path('raw'))
+
+def test_invalid_file(tmpdir):
+    """
+    Invalid results file is collected again
+    """
+    cache = ResultCache(str(tmpdir), 'protobix-test', 60)
+    tmpdir.join('protobix-test-items.json').write('not json')
+    assert cache.get('items', lambda: [1]) == [1]
+
+def test_single_flight(tmpdir):
+    """
+    Concurrent calls wait for the one collecting
+    """
+    calls = []
+    def collect():
+        calls.append(1)
+        time.sleep(0.2)
+        return {'myhostname': {'my.item.key': len(calls)}}
+    results = []
+    def run():
+        cache = ResultCache(str(tmpdir), 'protobix-test', 60)
+        results.append(cache.get('items', collect))
+    threads = [threading.Thread(target=run) for index in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [{'myhostname': {'my.item.key': 1}}] * 5
+
+def test_default_directory():
+    """
+    /dev/shm is used when available
+    """
+    with mock.patch('os.path.isdir', return_value=True):
+        assert default_directory() == '/dev/shm'
+    with mock.patch('os.path.isdir', return_value=False):
+        assert default_directory() != '/dev/shm'
@@ -0,0 +1,126 @@
+"""
+Tests for protobix.routing
+"""
+import pytest
+import mock
+import socket
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix.faketrapper import FakeTrapper
+from protobix.routing import parse_destination
+
+def _config():
+    # os.devnull avoids reading local zabbix_agentd.conf
+    return protobix.ZabbixAgentConfig(config_file=os.devnull)
+
+def test_parse_destination():
+    """
+    Port defaults to 10051
+    """
+    assert parse_destination('proxy1') == ('proxy1', 10051)
+    assert parse_destination('proxy1:10052') == ('proxy1', 10052)
+
+def test_rules():
+    """
+    First matching rule wins, unmatched hosts go to default
+    """
+    routing = protobix.RoutingTable(default='server')
+    routing.add_rule('proxy.paris', prefix='par-')
+    routing.add_rule('proxy.db', regex=r'.*-db\d+$')
+    routing.add_rule('proxy.other', prefix='par-db')
+    assert routing.route('par-db1') == 'proxy.paris'
+    assert routing.route('lon-db1') == 'proxy.db'
+    assert routing.route('lon-web1') == 'server'
+    assert protobix.RoutingTable().route('lon-web1') is None
+
+def test_invalid_rule():
+    """
+    Rules require either prefix or regex
+    """
+    routing = protobix.RoutingTable()
+    with pytest.raises(ValueError) as err:
+        routing.add_rule('proxy1')
+    assert str(err.value) == 'Rule requires either prefix or regex'
+    with pytest.raises(ValueError):
+        routing.add_rule('proxy1', prefix='a', regex='b')
+
+def test_consistent_hashing():
+    """
+    Hosts are spread over proxies, removing a proxy only moves its hosts
+    """
+    proxies = ['proxy1', 'proxy2', 'proxy3', 'proxy4']
+    routing = protobix.RoutingTable(proxies=proxies)
+    hosts = ['host%d' % index for index in range(1000)]
+    routes = dict((host, routing.route(host)) for host in hosts)
+    for proxy in proxies:
+        assert 150 < list(routes.values()).count(proxy) < 350
+    routing.add_rule('server', prefix='host1')
+    assert routing.route('host1') == 'server'
+    routing = protobix.RoutingTable(proxies=proxies)
+    routing.remove_proxy('proxy4')
+    assert routing.proxies == proxies[:3]
+    for host in hosts:
+        if routes[host] == 'proxy4':
+            assert routing.route(host) != 'proxy4'
+        else:
+            assert routing.route(host) == routes[host]
+
+def test_routed_send():
+    """
+    Items are grouped & sent to their host's destination
+    """
+    with FakeTrapper() as trapper1, FakeTrapper() as trapper2:
+        routing = protobix.RoutingTable(default='127.0.0.1:%d' % trapper2.port)
+        routing.add_rule('127.0.0.1:%d' % trapper1.port, prefix='paris')
+        sender = protobix.RoutedSender(routing, _config())
+        sender.data_type = 'items'
+        sender.add({
+            'paris1': {'my.item.key': 1},
+            'paris2': {'my.item.key': 2},
+            'london1': {'my.item.key': 3},
+        })
+        sender.add_item('london2', 'my.item.key', 4)
+        results = sender.send()
+        assert sorted(results) == sorted([
+            '127.0.0.1:%d' % trapper1.port, '127.0.0.1:%d' % trapper2.port
+        ])
+        assert sorted(item['host'] for item in trapper1.received) == ['paris1', 'paris2']
+        assert sorted(item['host'] for item in trapper2.received) == ['london1', 'london2']
+        assert sender.data_type is None
+        # Containers are kept for next sends
+        sender.data_type = 'items'
+        sender.add_item('paris1', 'my.item.key', 5)
+        assert list(sender.send()) == ['127.0.0.1:%d' % trapper1.port]
+        assert len(sender.containers) == 2
+    assert sender.errors == {}
+
+def test_routed_send_error():
+    """
+    A failing destination doesn't prevent sending to others
+    """
+    with FakeTrapper() as trapper:
+        routing = protobix.RoutingTable()
+        routing.add_rule('127.0.0.1:%d' % trapper.port, prefix='paris')
+        routing.add_rule('127.0.0.1:1025', prefix='london')
+        sender = protobix.RoutedSender(routing, _config(), workers=1)
+        sender.data_type = 'items'
+        sender.add({'paris1': {'my.item.key': 1}, 'london1': {'my.item.key': 2}})
+        with pytest.raises(socket.error):
+            sender.send()
+        assert list(sender.errors) == ['127.0.0.1:1025']
+        assert [item['host'] for item in trapper.received] == ['paris1']
+
+def test_default_destination():
+    """
+    Hosts without destination use sender's configuration
+    """
+    config = _config()
+    sender = protobix.RoutedSender(protobix.RoutingTable(), config)
+    sender.add_item('myhostname', 'my.item.key', 1, data_type='items')
+    assert sender.containers[None]._config is config
+    with mock.patch('protobix.DataContainer.send') as mock_send:
+        mock_send.return_value = (1, 0, 1, 0, 1, 0.1)
+        assert sender.send() == {None: (1, 0, 1, 0, 1, 0.1)}
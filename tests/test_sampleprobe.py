@@ -1,19 +1,21 @@
 """
 Test Protobix sampleprobe
 """
-import configobj
 import pytest
 import mock
 import unittest
 import socket
 
 import resource
+import signal
+import threading
 import time
 import sys
 import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 import protobix
+from protobix.faketrapper import FakeTrapper
 import logging
 import argparse
 
@@ -123,6 +125,50 @@ class ProtobixTLSTestProbe(ProtobixTestProbe):
 class ProtobixTestProbe2(protobix.SampleProbe):
     __version__="1.0.2"
 
+class ProtobixTestMultiHostProbe(protobix.SampleProbe):
+    __version__="1.0.2"
+    hosts = ['protobix.host1', 'protobix.host2', 'protobix.host3']
+    delay = 0
+
+    def _list_hosts(self):
+        return self.hosts
+
+    def _get_metrics_for(self, host):
+        time.sleep(self.delay)
+        if host == 'protobix.failing':
+            raise Exception('Something went wrong')
+        if host == 'protobix.slow':
+            time.sleep(5)
+        return {
+            "my.protobix.item.int": 0,
+            "my.protobix.item.string": "item string"
+        }
+
+class ProtobixTestPoolProbe(ProtobixTestMultiHostProbe):
+    """
+    Counts hosts collected at once, protobix.late outlives host timeout
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def _get_metrics_for(self, host):
+        if host == 'protobix.late':
+            time.sleep(2)
+            return {}
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            if host == 'protobix.invalid':
+                return ['not', 'a', 'dict']
+            return super(ProtobixTestPoolProbe, self)._get_metrics_for(host)
+        finally:
+            with self.lock:
+                self.running -= 1
+
 """
 Check default configuration of the sample probe
 """
@@ -228,6 +274,61 @@ def test_command_line_option_tls_cert_file():
     pbx_config = pbx_test_probe._init_config()
     assert pbx_config.tls_cert_file == '/tmp/test_file.crt'
 
+"""
+Check --discard-unchanged & --value-cache-file arguments.
+"""
+def test_command_line_option_discard_unchanged():
+    pbx_test_probe = ProtobixTestProbe()
+    pbx_test_probe.options = pbx_test_probe._parse_args([
+        '--discard-unchanged', '3600', '--value-cache-file', '/tmp/values.json'
+    ])
+    pbx_config = pbx_test_probe._init_config()
+    assert pbx_config.discard_unchanged == 3600
+    assert pbx_config.value_cache_file == '/tmp/values.json'
+
+"""
+Check --lld-refresh & --lld-cache-file arguments.
+"""
+def test_command_line_option_lld_refresh():
+    pbx_test_probe = ProtobixTestProbe()
+    pbx_test_probe.options = pbx_test_probe._parse_args([
+        '--lld-refresh', '86400', '--lld-cache-file', '/tmp/lld.json'
+    ])
+    pbx_config = pbx_test_probe._init_config()
+    assert pbx_config.lld_refresh == 86400
+    assert pbx_config.lld_cache_file == '/tmp/lld.json'
+
+"""
+Check --item-filter-ttl argument.
+"""
+def test_command_line_option_item_filter_ttl():
+    pbx_test_probe = ProtobixTestProbe()
+    pbx_test_probe.options = pbx_test_probe._parse_args([
+        '--item-filter-ttl', '600', '--item-filter-file', '/tmp/rejected.json'
+    ])
+    pbx_config = pbx_test_probe._init_config()
+    assert pbx_config.item_filter_ttl == 600
+    assert pbx_config.item_filter_file == '/tmp/rejected.json'
+
+"""
+Check --relay-socket argument.
+"""
+def test_command_line_option_relay_socket():
+    pbx_test_probe = ProtobixTestProbe()
+    pbx_test_probe.options = pbx_test_probe._parse_args(['--relay-socket', '/tmp/relay.sock'])
+    pbx_config = pbx_test_probe._init_config()
+    assert pbx_config.relay_socket == '/tmp/relay.sock'
+
+"""
+Check --diagnose argument.
+"""
+def test_command_line_option_diagnose():
+    pbx_test_probe = ProtobixTestProbe()
+    pbx_test_probe.options = pbx_test_probe._parse_args([])
+    assert pbx_test_probe._init_config().diagnose is False
+    pbx_test_probe.options = pbx_test_probe._parse_args(['--diagnose'])
+    assert pbx_test_probe._init_config().diagnose is True
+
 """
 Check --tls-key-file argument.
 """
@@ -442,6 +543,92 @@ def test_everything_runs_fine():
         result = pbx_test_probe.run([])
         assert result == 0
 
+"""
+Check that per host collection adds every host's items into DataContainer
+"""
+def test_collect_metrics_per_host():
+    pbx_test_probe = ProtobixTestMultiHostProbe()
+    with mock.patch('protobix.DataContainer.send') as mock_datacontainer_send:
+        with mock.patch('protobix.DataContainer.add') as mock_datacontainer_add:
+            result = pbx_test_probe.run([])
+            assert result == 0
+            hosts = set()
+            for call in mock_datacontainer_add.call_args_list:
+                hosts.update(call[0][0].keys())
+            assert hosts == set(pbx_test_probe.hosts)
+
+"""
+Check that per host collection runs concurrently
+"""
+def test_collect_metrics_concurrently():
+    pbx_test_probe = ProtobixTestMultiHostProbe()
+    pbx_test_probe.hosts = ['protobix.host%d' % i for i in range(8)]
+    pbx_test_probe.delay = 0.5
+    with mock.patch('protobix.DataContainer.send') as mock_datacontainer_send:
+        start = time.time()
+        result = pbx_test_probe.run(['--workers', '8'])
+        assert result == 0
+        assert time.time() - start < 2
+
+"""
+Check that failing & timed out hosts are skipped
+"""
+def test_collect_metrics_failing_and_slow_hosts():
+    pbx_test_probe = ProtobixTestMultiHostProbe()
+    pbx_test_probe.hosts = ['protobix.host1', 'protobix.failing', 'protobix.slow']
+    with mock.patch('protobix.DataContainer.send') as mock_datacontainer_send:
+        with mock.patch('protobix.DataContainer.add') as mock_datacontainer_add:
+            start = time.time()
+            result = pbx_test_probe.run(['--host-timeout', '1'])
+            assert result == 0
+            assert time.time() - start < 3
+            hosts = set()
+            for call in mock_datacontainer_add.call_args_list:
+                hosts.update(call[0][0].keys())
+            assert hosts == set(['protobix.host1'])
+
+"""
+Check that an invalid host result or a failing add only skips that host
+"""
+def test_collect_metrics_invalid_host():
+    pbx_test_probe = ProtobixTestPoolProbe()
+    pbx_test_probe.options = pbx_test_probe._parse_args([])
+    pbx_test_probe.zbx_config = pbx_test_probe._init_config()
+    pbx_test_probe.logger = mock.Mock()
+    zbx_container = mock.Mock()
+    def add(data):
+        if 'protobix.host2' in data:
+            raise TypeError('Unable to add items')
+    zbx_container.add.side_effect = add
+    pbx_test_probe._collect_metrics(
+        ['protobix.host1', 'protobix.invalid', 'protobix.host2', 'protobix.host3'],
+        zbx_container
+    )
+    hosts = set()
+    for call in zbx_container.add.call_args_list:
+        hosts.update(call[0][0].keys())
+    assert hosts == set(['protobix.host1', 'protobix.host2', 'protobix.host3'])
+    assert pbx_test_probe.logger.error.call_count == 2
+
+"""
+Check that a stuck host is found while other hosts keep answering,
+and that its worker doesn't collect other hosts once it's replaced
+"""
+def test_collect_metrics_timeout_with_results_stream():
+    pbx_test_probe = ProtobixTestPoolProbe()
+    pbx_test_probe.hosts = ['protobix.late'] + ['protobix.host%d' % i for i in range(80)]
+    pbx_test_probe.delay = 0.05
+    pbx_test_probe.options = pbx_test_probe._parse_args(['--workers', '2', '--host-timeout', '1'])
+    pbx_test_probe.zbx_config = pbx_test_probe._init_config()
+    pbx_test_probe.logger = mock.Mock()
+    timed_out = []
+    start = time.time()
+    pbx_test_probe.logger.error.side_effect = lambda message: timed_out.append(time.time() - start)
+    pbx_test_probe._collect_metrics(pbx_test_probe.hosts, mock.Mock())
+    assert len(timed_out) == 1
+    assert timed_out[0] < 1.5
+    assert pbx_test_probe.max_running == 2
+
 if HAVE_DECENT_SSL is True:
 
     """
@@ -613,3 +800,192 @@ if HAVE_DECENT_SSL is True:
             assert processed == 4
             assert failed == 0
             assert total == 4
+
+"""
+Check that --passive-port serves values instead of sending them
+"""
+def test_passive_agent():
+    pbx_test_probe = ProtobixTestProbe()
+    with mock.patch('protobix.DataContainer.send') as mock_datacontainer_send:
+        with mock.patch('protobix.passiveagent.PassiveAgent.serve_forever') as mock_serve_forever:
+            result = pbx_test_probe.run(['--passive-port', '10050'])
+            assert result == 0
+            assert mock_serve_forever.call_count == 1
+        assert mock_datacontainer_send.call_count == 0
+    assert pbx_test_probe.options.passive_refresh == 60
+
+"""
+Check that passive agent collects per host probes too
+"""
+def test_passive_agent_metrics_per_host():
+    pbx_test_probe = ProtobixTestMultiHostProbe()
+    pbx_test_probe.options = pbx_test_probe._parse_args([])
+    pbx_test_probe.zbx_config = pbx_test_probe._init_config()
+    data = pbx_test_probe._get_passive_metrics()
+    assert sorted(data) == pbx_test_probe.hosts
+
+"""
+Check that --detach returns before data is sent
+"""
+def test_detach():
+    with FakeTrapper(latency=1) as trapper:
+        pbx_test_probe = ProtobixTestProbe()
+        start = time.time()
+        result = pbx_test_probe.run([
+            '--detach', '-z', '127.0.0.1', '-p', str(trapper.port)
+        ])
+        assert result == 0
+        # Zabbix answer takes 1s
+        assert time.time() - start < 1
+        for attempt in range(100):
+            if len(trapper.received) == 4:
+                break
+            time.sleep(0.05)
+        assert len(trapper.received) == 4
+    assert pbx_test_probe.options.detach_timeout == 300
+
+"""
+Check that detached process exits even when send fails
+"""
+def test_detach_send_failed():
+    pbx_test_probe = ProtobixTestProbe()
+    with mock.patch('os.fork') as mock_fork, \
+         mock.patch('os.setsid'), mock.patch('os.dup2'), \
+         mock.patch('signal.signal') as mock_signal, \
+         mock.patch('signal.alarm') as mock_alarm, \
+         mock.patch('os._exit') as mock_exit:
+        mock_fork.return_value = 0
+        mock_exit.side_effect = SystemExit
+        with mock.patch('protobix.DataContainer.send') as mock_datacontainer_send:
+            mock_datacontainer_send.side_effect = socket.error
+            with pytest.raises(SystemExit):
+                pbx_test_probe.run(['--detach', '--detach-timeout', '10'])
+    mock_alarm.assert_called_once_with(10)
+    assert mock_exit.call_args_list[-1] == mock.call(4)
+    assert mock_signal.call_args[0][1] == pbx_test_probe._detach_timeout
+
+"""
+Check that detached send timeout is logged before exiting
+"""
+def test_detach_timeout_logged():
+    pbx_test_probe = ProtobixTestProbe()
+    pbx_test_probe.options = pbx_test_probe._parse_args(['--detach', '--detach-timeout', '10'])
+    pbx_test_probe.logger = mock.Mock()
+    with mock.patch('os._exit') as mock_exit:
+        pbx_test_probe._detach_timeout(signal.SIGALRM, None)
+    mock_exit.assert_called_once_with(4)
+    assert 'timed out after 10s' in pbx_test_probe.logger.critical.call_args[0][0]
+
+"""
+Check that --detach doesn't fork with --dryrun
+"""
+def test_detach_dryrun():
+    pbx_test_probe = ProtobixTestProbe()
+    with mock.patch('os.fork') as mock_fork:
+        assert pbx_test_probe.run(['--detach', '--dryrun']) == 0
+    assert mock_fork.call_count == 0
+
+"""
+Check that --profile records steps & send phases
+"""
+def test_profile():
+    pbx_test_probe = ProtobixTestProbe()
+    with mock.patch('protobix.DataContainer.send') as mock_datacontainer_send:
+        result = pbx_test_probe.run([])
+        assert result == 0
+        assert pbx_test_probe.run_profile is None
+        result = pbx_test_probe.run([], profile=True)
+        assert result == 0
+    assert list(pbx_test_probe.run_profile.steps) == ['init', 'get_data', 'add', 'send']
+
+"""
+Check that --profile-dir writes reports & --profile-items sends timings
+"""
+def test_profile_items(tmpdir):
+    with FakeTrapper() as trapper:
+        pbx_test_probe = ProtobixTestProbe()
+        result = pbx_test_probe.run([
+            '--profile-dir', str(tmpdir), '--profile-items',
+            '-z', '127.0.0.1', '-p', str(trapper.port)
+        ])
+        assert result == 0
+        keys = [item['key'] for item in trapper.received]
+    assert len(tmpdir.listdir()) >= 2
+    assert 'protobix.profile.step[send,wall]' in keys
+    assert 'protobix.profile.phase[sendall,wall]' in keys
+    profile_items = [item for item in trapper.received if item['key'].startswith('protobix.profile')]
+    assert set(item['host'] for item in profile_items) == set([pbx_test_probe.hostname])
+
+"""
+Check that profiling errors don't change probe's exit code
+"""
+def test_profile_items_send_error():
+    pbx_test_probe = ProtobixTestProbe()
+    with mock.patch('protobix.DataContainer.send') as mock_datacontainer_send:
+        mock_datacontainer_send.side_effect = [None, ValueError]
+        result = pbx_test_probe.run(['--profile-items'])
+    assert result == 0
+    assert mock_datacontainer_send.call_count == 2
+
+class ProtobixTestRawProbe(protobix.SampleProbe):
+    __version__="1.0.2"
+    raw_calls = 0
+
+    def _get_raw_data(self):
+        ProtobixTestRawProbe.raw_calls += 1
+        return {'protobix.host1': {'fs': ['/', '/boot']}}
+
+    def _get_metrics_from(self, raw_data):
+        return dict(
+            (host, dict(('vfs.fs.size[%s]' % fs, 1) for fs in raw_data[host]['fs']))
+            for host in raw_data
+        )
+
+    def _get_discovery_from(self, raw_data):
+        return dict(
+            (host, {'vfs.fs.discovery': [{'{#FSNAME}': fs} for fs in raw_data[host]['fs']]})
+            for host in raw_data
+        )
+
+"""
+Check that --result-cache shares collected data between runs
+"""
+def test_result_cache(tmpdir):
+    pbx_test_probe = ProtobixTestProbe()
+    args = ['--result-cache', '60', '--result-cache-dir', str(tmpdir)]
+    with mock.patch('protobix.DataContainer.send') as mock_datacontainer_send:
+        with mock.patch.object(ProtobixTestProbe, '_get_metrics', autospec=True) as mock_get_metrics:
+            mock_get_metrics.return_value = {'protobix.host1': {'my.protobix.item.int': 0}}
+            assert pbx_test_probe.run(args) == 0
+            assert pbx_test_probe.run(args + ['--dryrun']) == 0
+            assert mock_get_metrics.call_count == 1
+            # Other options give another result
+            assert pbx_test_probe.run(args + ['--workers', '2']) == 0
+            assert mock_get_metrics.call_count == 2
+
+"""
+Check that items & discovery are built from the same raw data
+"""
+def test_result_cache_raw_data(tmpdir):
+    pbx_test_probe = ProtobixTestRawProbe()
+    ProtobixTestRawProbe.raw_calls = 0
+    args = ['--result-cache', '60', '--result-cache-dir', str(tmpdir)]
+    with mock.patch('protobix.DataContainer.send') as mock_datacontainer_send:
+        with mock.patch('protobix.DataContainer.add') as mock_datacontainer_add:
+            assert pbx_test_probe.run(args + ['--update-items']) == 0
+            assert pbx_test_probe.run(args + ['--discovery']) == 0
+    assert ProtobixTestRawProbe.raw_calls == 1
+    items, lld = [call[0][0] for call in mock_datacontainer_add.call_args_list]
+    assert sorted(items['protobix.host1']) == ['vfs.fs.size[/]', 'vfs.fs.size[/boot]']
+    assert len(lld['protobix.host1']['vfs.fs.discovery']) == 2
+
+"""
+Check that result cache is disabled by default
+"""
+def test_result_cache_disabled(tmpdir):
+    pbx_test_probe = ProtobixTestRawProbe()
+    ProtobixTestRawProbe.raw_calls = 0
+    with mock.patch('protobix.DataContainer.send') as mock_datacontainer_send:
+        assert pbx_test_probe.run([]) == 0
+        assert pbx_test_probe.run([]) == 0
+    assert ProtobixTestRawProbe.raw_calls == 2
@@ -1,7 +1,6 @@
 """
 Tests for protobix.SenderProtocol
 """
-import configobj
 import pytest
 import mock
 import unittest
@@ -9,6 +8,7 @@ import time
 try: import simplejson as json
 except ImportError: import json
 import socket
+import logging
 
 import sys
 import os
@@ -169,6 +169,41 @@ def test_send_to_zabbix(mock_socket):
 
     zbx_senderprotocol.socket.sendall.assert_called_with(packet)
 
+@mock.patch('socket.socket', return_value=mock.MagicMock(name='socket', spec=socket.socket))
+def test_send_to_zabbix_logging_not_enabled(mock_socket):
+    """
+    Payload must not be formatted for logging when debug is disabled
+    """
+    logger = logging.getLogger('test_send_to_zabbix_logging_not_enabled')
+    logger.setLevel(logging.INFO)
+    zbx_senderprotocol = protobix.SenderProtocol(logger=logger)
+    zbx_senderprotocol.socket = mock_socket
+    with mock.patch.object(logger, 'debug') as mock_debug:
+        zbx_senderprotocol._send_to_zabbix([{'host': 'myhostname', 'key': 'my.item.key', 'value': 1}])
+        for call in mock_debug.call_args_list:
+            assert not call[0][0].startswith('About to send')
+
+@mock.patch('socket.socket', return_value=mock.MagicMock(name='socket', spec=socket.socket))
+def test_send_to_zabbix_logging_payload_truncated(mock_socket):
+    """
+    Payload written in debug log must be truncated
+    """
+    logger = logging.getLogger('test_send_to_zabbix_logging_payload_truncated')
+    logger.setLevel(logging.DEBUG)
+    zbx_senderprotocol = protobix.SenderProtocol(logger=logger)
+    zbx_senderprotocol.socket = mock_socket
+    items = [
+        {'host': 'myhostname', 'key': 'my.item.key', 'value': 'x' * 1000}
+        for i in range(10)
+    ]
+    with mock.patch.object(logger, 'handle') as mock_handle:
+        zbx_senderprotocol._send_to_zabbix(items)
+        messages = [call[0][0].getMessage() for call in mock_handle.call_args_list]
+    payload_messages = [message for message in messages if message.startswith('About to send')]
+    assert len(payload_messages) == 1
+    assert len(payload_messages[0]) < protobix.senderprotocol.ZBX_DBG_PAYLOAD_SIZE + 100
+    assert payload_messages[0].endswith('...')
+
 zabbix_answer_params= (
     # Zabbix Sender protocol <= 2.0
     'Processed 1 Failed 2 Total 3 Seconds spent 0.123456',
@@ -202,7 +237,7 @@ def test_handle_response_with_invalid_content(zabbix_answer):
     """
     payload='{"response":"success","info":"'+zabbix_answer+'"}'
     zbx_datacontainer = protobix.DataContainer()
-    with pytest.raises(IndexError):
+    with pytest.raises(protobix.ZabbixResponseError):
         zbx_datacontainer._handle_response(payload)
 
 @mock.patch('socket.socket', return_value=mock.MagicMock(name='socket', spec=socket.socket))
@@ -230,23 +265,66 @@ def test_read_from_zabbix_invalid_content(mock_socket):
     Test sending data to Zabbix Server
     """
     answer_payload = '{"info": "invalid content", "response": "success"}'
-    answer_packet = b('ZBXD\1') + struct.pack('<Q', 93) + b(answer_payload)
+    answer_packet = b('ZBXD\1') + struct.pack('<Q', 50) + b(answer_payload)
     mock_socket.recv.return_value = answer_packet
 
     zbx_senderprotocol = protobix.SenderProtocol()
     zbx_senderprotocol.data_type='item'
     zbx_senderprotocol.socket = mock_socket
-    with pytest.raises(IndexError):
+    with pytest.raises(protobix.ZabbixResponseError):
         zbx_senderprotocol._read_from_zabbix()
 
+@mock.patch('socket.socket', return_value=mock.MagicMock(name='socket', spec=socket.socket))
+def test_read_from_zabbix_partial_reads(mock_socket):
+    """
+    Answer can be received in several small chunks
+    """
+    answer_payload = '{"info": "processed: 0; failed: 1; total: 1; seconds spent: 0.000441", "response": "success"}'
+    answer_packet = b('ZBXD\1') + struct.pack('<Q', 93) + b(answer_payload)
+    mock_socket.recv.side_effect = [
+        answer_packet[offset:offset + 7] for offset in range(0, len(answer_packet), 7)
+    ]
+
+    zbx_senderprotocol = protobix.SenderProtocol()
+    zbx_senderprotocol.socket = mock_socket
+    srv_response, processed, failed, total, time = zbx_senderprotocol._read_from_zabbix()
+    assert srv_response == 'success'
+    assert failed == 1
+    assert zbx_senderprotocol.last_response.total == 1
+
+read_from_zabbix_invalid_params = (
+    # Connection closed during header
+    ([b('ZBXD'), b('')], 'Connection closed after 4 bytes of Zabbix answer'),
+    # Connection closed during body
+    ([b('ZBXD\1') + struct.pack('<Q', 93) + b('{}'), b('')],
+     'Connection closed after 15 bytes of Zabbix answer'),
+    # Invalid header mark
+    ([b('HTTP/1.1 400 Bad Request')], 'Invalid Zabbix header'),
+    # Extra data after answer
+    ([b('ZBXD\1') + struct.pack('<Q', 2) + b('{}garbage')],
+     'Unexpected data after Zabbix answer'),
+)
+@pytest.mark.parametrize(('chunks', 'message'), read_from_zabbix_invalid_params)
+@mock.patch('socket.socket', return_value=mock.MagicMock(name='socket', spec=socket.socket))
+def test_read_from_zabbix_invalid_framing(mock_socket, chunks, message):
+    """
+    Framing errors raise ZabbixProtocolError, even with python -O
+    """
+    mock_socket.recv.side_effect = chunks
+    zbx_senderprotocol = protobix.SenderProtocol()
+    zbx_senderprotocol.socket = mock_socket
+    with pytest.raises(protobix.ZabbixProtocolError) as err:
+        zbx_senderprotocol._read_from_zabbix()
+    assert str(err.value) == message
+
 if HAVE_DECENT_SSL is True:
 
-    @mock.patch('configobj.ConfigObj')
-    def test_need_backend_init_tls(mock_configobj):
+    @mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+    def test_need_backend_init_tls(mock_read_config_file):
         """
         Test TLS context initialization
         """
-        mock_configobj.side_effect = [
+        mock_read_config_file.side_effect = [
             {
                 'TLSConnect': 'cert',
                 'TLSCAFile': 'tests/tls_ca/rogue-protobix-ca.cert.pem',
@@ -258,12 +336,12 @@ if HAVE_DECENT_SSL is True:
         tls_socket = zbx_senderprotocol._socket()
         assert isinstance(tls_socket, ssl.SSLSocket)
 
-    @mock.patch('configobj.ConfigObj')
-    def test_need_backend_init_tls_cert_verify_fails(mock_configobj):
+    @mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+    def test_need_backend_init_tls_cert_verify_fails(mock_read_config_file):
         """
         Test TLS context initialization
         """
-        mock_configobj.side_effect = [
+        mock_read_config_file.side_effect = [
             {
                 'TLSConnect': 'cert',
                 'TLSCAFile': 'tests/tls_ca/protobix-ca.cert.pem',
@@ -275,12 +353,12 @@ if HAVE_DECENT_SSL is True:
         with pytest.raises(ssl.SSLError):
             zbx_senderprotocol._socket()
 
-    @mock.patch('configobj.ConfigObj')
-    def test_init_tls_non_matching_cert_key(mock_configobj):
+    @mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+    def test_init_tls_non_matching_cert_key(mock_read_config_file):
         """
         Test TLS context initialization
         """
-        mock_configobj.side_effect = [
+        mock_read_config_file.side_effect = [
             {
                 'TLSConnect': 'cert',
                 'TLSCAFile': 'tests/tls_ca/protobix-ca.cert.pem',
@@ -292,12 +370,12 @@ if HAVE_DECENT_SSL is True:
         with pytest.raises(ssl.SSLError) as err:
             tls_context = zbx_senderprotocol._init_tls()
 
-    @mock.patch('configobj.ConfigObj')
-    def test_need_backend_socket_tls_unencrypted(mock_configobj):
+    @mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+    def test_need_backend_socket_tls_unencrypted(mock_read_config_file):
         """
         Test socket with no TLS
         """
-        mock_configobj.side_effect = [
+        mock_read_config_file.side_effect = [
             {
                 'TLSConnect': 'unencrypted',
             }
@@ -306,12 +384,12 @@ if HAVE_DECENT_SSL is True:
         _socket = zbx_senderprotocol._socket()
         assert isinstance(_socket, socket.socket)
 
-    @mock.patch('configobj.ConfigObj')
-    def test_need_backend_socket_tls_cert(mock_configobj):
+    @mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+    def test_need_backend_socket_tls_cert(mock_read_config_file):
         """
         Test socket with TLS
         """
-        mock_configobj.side_effect = [
+        mock_read_config_file.side_effect = [
             {
                 'TLSConnect': 'cert',
                 'TLSCAFile': 'tests/tls_ca/rogue-protobix-ca.cert.pem',
@@ -322,3 +400,13 @@ if HAVE_DECENT_SSL is True:
         zbx_senderprotocol = protobix.SenderProtocol()
         _socket = zbx_senderprotocol._socket()
         assert isinstance(_socket, ssl.SSLSocket)
+
+def test_backward_compatible_constants():
+    """
+    Constants moved or made lazy are still importable from senderprotocol
+    """
+    import ssl
+    from protobix.senderprotocol import ZBX_HDR, ZBX_RESP_REGEX, ZBX_TLS_PROTOCOL
+    assert ZBX_HDR == "ZBXD\1"
+    assert ZBX_RESP_REGEX == protobix.response.ZBX_RESP_REGEX
+    assert ZBX_TLS_PROTOCOL == ssl.PROTOCOL_TLSv1_2
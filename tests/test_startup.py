@@ -0,0 +1,59 @@
+"""
+Test protobix startup cost
+Absolute import times depend on the host, so only modules loaded are checked
+"""
+import pytest
+import subprocess
+
+import sys
+import os
+
+PACKAGE_DIR = os.path.join(os.path.dirname(__file__), '..')
+# Dry run of a probe, which doesn't start passive agent
+PROBE_RUN = """
+import protobix
+class Probe(protobix.SampleProbe):
+    def _get_metrics(self):
+        return {'myhostname': {'my.item.key': 1}}
+Probe().run(['--dryrun'])
+"""
+
+def import_time(code='import protobix'):
+    """
+    Run code in a fresh interpreter with -X importtime
+    Returns a dict of cumulative import time per module in microseconds
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=PACKAGE_DIR,
+        stderr=subprocess.STDOUT
+    ).decode()
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # import time: self [us] | cumulative | imported package
+        self_time, cumulative, module = line.split(':', 1)[1].split('|')
+        modules[module.strip()] = int(cumulative)
+    return modules
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime requires Python 3.7')
+def test_import_does_not_load_heavy_modules():
+    """
+    configobj, ssl & argparse must only be imported when needed
+    """
+    modules = import_time()
+    assert 'protobix' in modules
+    for module in ['configobj', 'ssl', 'argparse', 'logging.handlers']:
+        assert module not in modules
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime requires Python 3.7')
+def test_probe_run_does_not_load_passive_agent():
+    """
+    Passive agent & its asyncio, ssl & subprocess imports are only
+    loaded when passive agent is enabled
+    """
+    modules = import_time(PROBE_RUN)
+    assert 'protobix.sampleprobe' in modules
+    for module in ['protobix.passiveagent', 'asyncio', 'ssl', 'socketserver', 'subprocess']:
+        assert module not in modules
@@ -0,0 +1,85 @@
+"""
+Tests for protobix.SenderTracer
+"""
+import pytest
+import mock
+import socket
+import struct
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+
+if sys.version_info < (3,):
+    def b(x):
+        return x
+else:
+    import codecs
+    def b(x):
+        return codecs.utf_8_encode(x)[0]
+
+class RecordingTracer(protobix.SenderTracer):
+
+    def __init__(self):
+        self.calls = []
+
+    def before(self, phase, **info):
+        self.calls.append(('before', phase, info))
+
+    def after(self, phase, duration, **info):
+        assert duration >= 0
+        self.calls.append(('after', phase, info))
+
+def test_invalid_tracer():
+    """
+    tracer must be a SenderTracer instance
+    """
+    zbx_datacontainer = protobix.DataContainer()
+    assert zbx_datacontainer.tracer is None
+    with pytest.raises(ValueError) as err:
+        zbx_datacontainer.tracer = 'invalid'
+    assert str(err.value) == 'tracer requires a SenderTracer instance'
+    zbx_datacontainer.tracer = protobix.SenderTracer()
+    zbx_datacontainer.tracer = None
+    assert zbx_datacontainer.tracer is None
+
+@mock.patch('socket.socket', return_value=mock.MagicMock(name='socket', spec=socket.socket))
+def test_send_phases(mock_socket):
+    """
+    Tracer is called around each phase of the send pipeline
+    """
+    answer_payload = '{"info": "processed: 2; failed: 0; total: 2; seconds spent: 0.000441", "response": "success"}'
+    answer_packet = b('ZBXD\1') + struct.pack('<Q', len(answer_payload)) + b(answer_payload)
+    mock_socket.return_value.recv.return_value = answer_packet
+
+    tracer = RecordingTracer()
+    zbx_datacontainer = protobix.DataContainer()
+    zbx_datacontainer.tracer = tracer
+    zbx_datacontainer.data_type = 'items'
+    zbx_datacontainer.add_item('myhostname', 'my.item.key', 1)
+    zbx_datacontainer.add_item('myhostname', 'my.other.item.key', 2)
+    zbx_datacontainer.send()
+
+    phases = [(call[0], call[1]) for call in tracer.calls]
+    assert phases == [
+        ('before', 'send'),
+        ('before', 'serialize'),
+        ('after', 'serialize'),
+        ('before', 'connect'),
+        ('after', 'connect'),
+        ('before', 'sendall'),
+        ('after', 'sendall'),
+        ('before', 'read_response'),
+        ('after', 'read_response'),
+        ('before', 'handle_response'),
+        ('after', 'handle_response'),
+        ('after', 'send'),
+    ]
+    infos = dict(((call[0], call[1]), call[2]) for call in tracer.calls)
+    assert infos[('before', 'serialize')]['items'] == 2
+    packet = mock_socket.return_value.sendall.call_args[0][0]
+    assert infos[('after', 'sendall')]['bytes'] == len(packet)
+    assert infos[('after', 'read_response')]['bytes'] == len(answer_packet)
+    assert infos[('after', 'handle_response')]['processed'] == 2
+    assert infos[('after', 'send')]['total'] == 2
@@ -0,0 +1,86 @@
+"""
+Tests for protobix.valuecache
+"""
+import pytest
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix.valuecache import ValueCache, sha1_fingerprint
+
+def item(key, value, clock, host='myhostname'):
+    return {'host': host, 'key': key, 'value': value, 'clock': clock}
+
+def test_filter_unchanged():
+    """
+    Unchanged values are discarded until heartbeat
+    """
+    cache = ValueCache(heartbeat=60)
+    items = [item('my.item.key1', 1, 1000), item('my.item.key2', 2, 1000)]
+    assert cache.filter(items) == items
+    cache.update(items)
+    items = [item('my.item.key1', 1, 1030), item('my.item.key2', 3, 1030)]
+    assert cache.filter(items) == [items[1]]
+    cache.update([items[1]])
+    # key1 was last sent at 1000, key2 at 1030
+    items = [item('my.item.key1', 1, 1060), item('my.item.key2', 3, 1060)]
+    assert cache.filter(items) == [items[0]]
+
+def test_filter_other_host():
+    """
+    Cache is keyed on both host & key
+    """
+    cache = ValueCache(heartbeat=60)
+    cache.update([item('my.item.key', 1, 1000)])
+    items = [item('my.item.key', 1, 1000, host='otherhostname')]
+    assert cache.filter(items) == items
+
+def test_lru_eviction():
+    """
+    Least recently sent values are evicted first
+    """
+    cache = ValueCache(heartbeat=60, max_size=2)
+    cache.update([item('my.item.key1', 1, 1000), item('my.item.key2', 2, 1000)])
+    cache.update([item('my.item.key1', 3, 1010), item('my.item.key3', 4, 1010)])
+    assert len(cache) == 2
+    assert cache.changed('myhostname', 'my.item.key2', 2, 1020) is True
+    assert cache.changed('myhostname', 'my.item.key1', 3, 1020) is False
+
+def test_state_file(tmpdir):
+    """
+    Cache survives through state file
+    """
+    state_file = str(tmpdir.join('values.json'))
+    cache = ValueCache(heartbeat=60, state_file=state_file)
+    assert len(cache) == 0
+    cache.update([item('my.item.key1', 'value', 1000)])
+    cache.save()
+    cache = ValueCache(heartbeat=60, state_file=state_file)
+    assert cache.changed('myhostname', 'my.item.key1', 'value', 1010) is False
+    assert os.listdir(str(tmpdir)) == ['values.json']
+
+@pytest.mark.parametrize('content', ('not json', '{}', '[[1, 2]]'))
+def test_state_file_invalid(tmpdir, content):
+    """
+    Invalid state file gives an empty cache
+    """
+    state_file = tmpdir.join('values.json')
+    state_file.write(content)
+    cache = ValueCache(heartbeat=60, state_file=str(state_file))
+    assert len(cache) == 0
+
+def test_fingerprint(tmpdir):
+    """
+    Only values fingerprint are kept
+    """
+    state_file = str(tmpdir.join('lld.json'))
+    cache = ValueCache(heartbeat=3600, state_file=state_file, fingerprint=sha1_fingerprint)
+    payload = '{"data": [{"{#FSNAME}": "/"}]}'
+    cache.update([item('vfs.fs.discovery', payload, 1000)])
+    cache.save()
+    with open(state_file) as state:
+        assert payload not in state.read()
+    cache = ValueCache(heartbeat=3600, state_file=state_file, fingerprint=sha1_fingerprint)
+    assert cache.changed('myhostname', 'vfs.fs.discovery', payload, 1010) is False
+    assert cache.changed('myhostname', 'vfs.fs.discovery', payload.replace('/', '/boot'), 1010) is True
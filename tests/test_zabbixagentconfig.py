@@ -1,7 +1,6 @@
 """
 Tests for protobix.ZabbixAgentConfig
 """
-import configobj
 import pytest
 import mock
 import unittest
@@ -12,12 +11,12 @@ import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 import protobix
 
-@mock.patch('configobj.ConfigObj')
-def test_config_file_default(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_config_file_default(mock_read_config_file):
     """
     Default Zabbix Agent configuration from Zabbix
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogFile': '/tmp/zabbix_agentd.log',
             'Server': '127.0.0.1',
@@ -47,13 +46,13 @@ def test_config_file_default(mock_configobj):
     assert zbx_config.tls_psk_identity is None
     assert zbx_config.tls_psk_file is None
 
-@mock.patch('configobj.ConfigObj')
-def test_config_file_not_found(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_config_file_not_found(mock_read_config_file):
     """
     Not found zabbix_agentd.conf
     hostname should fallback to socket.getfqdn
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {}
     ]
     with mock.patch('socket.getfqdn', return_value='myhostname'):
@@ -79,12 +78,12 @@ def test_config_file_not_found(mock_configobj):
         assert zbx_config.tls_psk_identity is None
         assert zbx_config.tls_psk_file is None
 
-@mock.patch('configobj.ConfigObj')
-def test_server_active_custom(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_server_active_custom(mock_read_config_file):
     """
     Custom serverActive & serverPort
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'ServerActive': 'myzabbixserver:10052,10.0.0.2:10051',
         }
@@ -95,13 +94,13 @@ def test_server_active_custom(mock_configobj):
     assert zbx_config.server_active == 'myzabbixserver'
     assert zbx_config.server_port == 10052
 
-@mock.patch('configobj.ConfigObj')
-def test_server_port_invalid_lower_than_1024(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_server_port_invalid_lower_than_1024(mock_read_config_file):
     """
     Invalid serverPort.
     Should raise an ValueError with proper message
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'ServerActive': '127.0.0.1:1000',
             'LogFile': '/tmp/zabbix_agentd.log',
@@ -113,13 +112,13 @@ def test_server_port_invalid_lower_than_1024(mock_configobj):
         )
     assert str(err.value) == 'ServerPort must be between 1024 and 32767'
 
-@mock.patch('configobj.ConfigObj')
-def test_server_port_invalid_greater_than_32767(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_server_port_invalid_greater_than_32767(mock_read_config_file):
     """
     Invalid serverPort.
     Should raise an ValueError with proper message
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'ServerActive': '127.0.0.1:40000',
             'LogFile': '/tmp/zabbix_agentd.log',
@@ -131,13 +130,13 @@ def test_server_port_invalid_greater_than_32767(mock_configobj):
         )
     assert str(err.value) == 'ServerPort must be between 1024 and 32767'
 
-@mock.patch('configobj.ConfigObj')
-def test_log_config_custom(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_log_config_custom(mock_read_config_file):
     """
     LogType set to 'file'
     LogFile set to '/tmp/zabbix_agentd.log'
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogType': 'file',
             'LogFile': '/tmp/test_zabbix_agentd.log',
@@ -149,14 +148,14 @@ def test_log_config_custom(mock_configobj):
     assert zbx_config.log_type == 'file'
     assert zbx_config.log_file == '/tmp/test_zabbix_agentd.log'
 
-@mock.patch('configobj.ConfigObj')
-def test_log_config_fallback_log_file(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_log_config_fallback_log_file(mock_read_config_file):
     """
     LogType set to 'file'
     LogFile unset
     LogFile should default to '/tmp/zabbix_agentd.log'
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogType': 'file'
         }
@@ -167,13 +166,13 @@ def test_log_config_fallback_log_file(mock_configobj):
     assert zbx_config.log_type == 'file'
     assert zbx_config.log_file == '/tmp/zabbix_agentd.log'
 
-@mock.patch('configobj.ConfigObj')
-def test_log_config_use_syslog(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_log_config_use_syslog(mock_read_config_file):
     """
     LogType set to 'system'
     LogFile should be None
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogType': 'system',
             'LogFile': '/tmp/zabbix_agentd.log',
@@ -185,14 +184,14 @@ def test_log_config_use_syslog(mock_configobj):
     assert zbx_config.log_type == 'system'
     assert zbx_config.log_file is None
 
-@mock.patch('configobj.ConfigObj')
-def test_log_config_use_console(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_log_config_use_console(mock_read_config_file):
     """
     LogType set to 'console'
     LogFile set
     LogFile should be None
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogType': 'console',
             'LogFile': '/tmp/zabbix_agentd.log',
@@ -204,14 +203,14 @@ def test_log_config_use_console(mock_configobj):
     assert zbx_config.log_type == 'console'
     assert zbx_config.log_file is None
 
-@mock.patch('configobj.ConfigObj')
-def test_log_config_use_console_fallback_log_file(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_log_config_use_console_fallback_log_file(mock_read_config_file):
     """
     LogType set to 'console'
     LogFile unset
     LogFile should be None
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogType': 'console',
         }
@@ -222,13 +221,13 @@ def test_log_config_use_console_fallback_log_file(mock_configobj):
     assert zbx_config.log_type == 'console'
     assert zbx_config.log_file is None
 
-@mock.patch('configobj.ConfigObj')
-def test_log_config_invalid_log_type(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_log_config_invalid_log_type(mock_read_config_file):
     """
     Invalid LogType
     Should raise an ValueError with proper message
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogType': 'invalid',
         }
@@ -237,15 +236,15 @@ def test_log_config_invalid_log_type(mock_configobj):
         protobix.ZabbixAgentConfig('zabbix_config_with_invalid_logType')
     assert str(err.value) == 'LogType must be one of [file,system,console]'
 
-@mock.patch('configobj.ConfigObj')
-def test_log_config_zabbix_24_compatibility(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_log_config_zabbix_24_compatibility(mock_read_config_file):
     """
     Missing LogType & LogFile set to '-'
     LogType should fallbackback to system
     LogFile should fallback to '/dev/log'
     This is for Zabbix 2.4.x retro compatibility
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogFile': '-',
         }
@@ -256,13 +255,13 @@ def test_log_config_zabbix_24_compatibility(mock_configobj):
     assert zbx_config.log_type == 'system'
     assert zbx_config.log_file is None
 
-@mock.patch('configobj.ConfigObj')
-def test_hostname_custom(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_hostname_custom(mock_read_config_file):
     """
     Custom hostname.
     Should *NOT* fallback to socket.getfqdn
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogFile': '/tmp/zabbix_agentd.log',
             'Hostname': 'myhostname'
@@ -274,13 +273,13 @@ def test_hostname_custom(mock_configobj):
         )
         assert zbx_config.hostname == 'myhostname'
 
-@mock.patch('configobj.ConfigObj')
-def test_timeout_custom(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_timeout_custom(mock_read_config_file):
     """
     Custom Timeout.
     Should not fallbackback to 3
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogFile': '/tmp/zabbix_agentd.log',
             'Timeout': 5,
@@ -291,13 +290,13 @@ def test_timeout_custom(mock_configobj):
     )
     assert zbx_config.timeout == 5
 
-@mock.patch('configobj.ConfigObj')
-def test_timeout_invalid_lower_than_0(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_timeout_invalid_lower_than_0(mock_read_config_file):
     """
     Invalid Timeout.
     Should raise an ValueError with proper message
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogFile': '/tmp/zabbix_agentd.log',
             'Timeout': -2,
@@ -307,13 +306,13 @@ def test_timeout_invalid_lower_than_0(mock_configobj):
         protobix.ZabbixAgentConfig('zabbix_config_with_invalid_timeout')
     assert str(err.value) == 'Timeout must be between 1 and 30'
 
-@mock.patch('configobj.ConfigObj')
-def test_timeout_invalid_greater_than_30(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_timeout_invalid_greater_than_30(mock_read_config_file):
     """
     Invalid Timeout.
     Should raise an ValueError with proper message
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogFile': '/tmp/zabbix_agentd.log',
             'Timeout': 50,
@@ -323,13 +322,13 @@ def test_timeout_invalid_greater_than_30(mock_configobj):
         protobix.ZabbixAgentConfig('zabbix_config_with_invalid_timeout')
     assert str(err.value) == 'Timeout must be between 1 and 30'
 
-@mock.patch('configobj.ConfigObj')
-def test_debug_level_custom(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_debug_level_custom(mock_read_config_file):
     """
     Custom DebugLevel.
     Should not fallbackback to 3
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogFile': '/tmp/zabbix_agentd.log',
             'DebugLevel': 4
@@ -340,13 +339,13 @@ def test_debug_level_custom(mock_configobj):
     )
     assert zbx_config.debug_level == 4
 
-@mock.patch('configobj.ConfigObj')
-def test_debug_level_invalid_lower_than_0(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_debug_level_invalid_lower_than_0(mock_read_config_file):
     """
     Invalid DebugLevel.
     Should raise an ValueError with proper message
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogFile': '/tmp/zabbix_agentd.log',
             'DebugLevel': -1
@@ -356,13 +355,13 @@ def test_debug_level_invalid_lower_than_0(mock_configobj):
         protobix.ZabbixAgentConfig('zabbix_config_with_invalid_debugLevel')
     assert str(err.value) == 'DebugLevel must be between 0 and 5, -1 provided'
 
-@mock.patch('configobj.ConfigObj')
-def test_debug_level_invalid_greater_than_5(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_debug_level_invalid_greater_than_5(mock_read_config_file):
     """
     Invalid DebugLevel.
     Should raise an ValueError with proper message
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'LogFile': '/tmp/zabbix_agentd.log',
             'DebugLevel': 10
@@ -372,12 +371,12 @@ def test_debug_level_invalid_greater_than_5(mock_configobj):
         protobix.ZabbixAgentConfig('zabbix_config_with_invalid_debugLevel')
     assert str(err.value) == 'DebugLevel must be between 0 and 5, 10 provided'
 
-@mock.patch('configobj.ConfigObj')
-def test_tls_default_config(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_tls_default_config(mock_read_config_file):
     """
     Default TLS configuration
     """
-    mock_configobj.side_effect = [{}]
+    mock_read_config_file.side_effect = [{}]
     zbx_config = protobix.ZabbixAgentConfig('TLS_default_configuration')
     assert zbx_config.tls_connect == 'unencrypted'
     assert zbx_config.tls_ca_file is None
@@ -387,13 +386,13 @@ def test_tls_default_config(mock_configobj):
     assert zbx_config.tls_server_cert_issuer is None
     assert zbx_config.tls_server_cert_subject is None
 
-@mock.patch('configobj.ConfigObj')
-def test_tls_connect_unencrypted_other_custom(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_tls_connect_unencrypted_other_custom(mock_read_config_file):
     """
     TLSConnect: 'unencrypted'
     All other TLS parameters should default to None
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'TLSConnect': 'unencrypted',
             'TLSCAFile': '/tmp/tls_ca_file.crt',
@@ -413,15 +412,15 @@ def test_tls_connect_unencrypted_other_custom(mock_configobj):
     assert zbx_config.tls_server_cert_issuer is None
     assert zbx_config.tls_server_cert_subject is None
 
-@mock.patch('configobj.ConfigObj')
-def test_tls_connect_cert_tls_cert_key_missing(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_tls_connect_cert_tls_cert_key_missing(mock_read_config_file):
     """
     TLSConnect: 'cert'
     TLSCertFile unset
     TLSKeyFile unset
     Should raise a ValueError with appropriate message
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'TLSConnect': 'cert'
         }
@@ -430,14 +429,14 @@ def test_tls_connect_cert_tls_cert_key_missing(mock_configobj):
         protobix.ZabbixAgentConfig('TLSConnect_cert_without_TLSCertFile_TLSKeyFile_TLSCAFile')
     assert str(err.value) == 'TLSConnect is cert. TLSCertFile, TLSKeyFile and TLSCAFile are mandatory'
 
-@mock.patch('configobj.ConfigObj')
-def test_tls_connect_cert_tls_cert_key_custom(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_tls_connect_cert_tls_cert_key_custom(mock_read_config_file):
     """
     TLSConnect: 'cert'
     TLSCertFile set
     TLSKeyFile set
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'TLSConnect': 'cert',
             'TLSCertFile': '/tmp/tls_cert_file.pem',
@@ -452,13 +451,13 @@ def test_tls_connect_cert_tls_cert_key_custom(mock_configobj):
     assert zbx_config.tls_ca_file == '/tmp/tls_ca_file.pem'
 
 
-@mock.patch('configobj.ConfigObj')
-def test_tls_connect_cert_other_custom(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_tls_connect_cert_other_custom(mock_read_config_file):
     """
     TLSConnect: 'cert'
     Other TLS params custom
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'TLSConnect': 'cert',
             'TLSCAFile': '/tmp/tls_ca_file.crt',
@@ -478,13 +477,13 @@ def test_tls_connect_cert_other_custom(mock_configobj):
     assert zbx_config.tls_server_cert_issuer == '/tmp/tls_server__cert_issuer.crt'
     assert zbx_config.tls_server_cert_subject == '/tmp/tls_server_cert_subject.crt'
 
-@mock.patch('configobj.ConfigObj')
-def test_tls_connect_invalid(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_tls_connect_invalid(mock_read_config_file):
     """
     invalid TLSConnect
     Should raise a ValueError with appropriate message
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'TLSConnect': 'invalid',
         }
@@ -493,13 +492,13 @@ def test_tls_connect_invalid(mock_configobj):
         protobix.ZabbixAgentConfig('TLSConnect_invalid')
     assert str(err.value) == 'TLSConnect must be one of [unencrypted,psk,cert]'
 
-@mock.patch('configobj.ConfigObj')
-def test_tls_connect_psk_tls_msk_identity_file_missing(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_tls_connect_psk_tls_msk_identity_file_missing(mock_read_config_file):
     """
     TLSConnect: 'psk'
     Should raise a NotImplementedError with appropriate message
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'TLSConnect': 'psk'
         }
@@ -508,13 +507,13 @@ def test_tls_connect_psk_tls_msk_identity_file_missing(mock_configobj):
         protobix.ZabbixAgentConfig('TLSConnect_psk')
     assert str(err.value) == 'TLSConnect is psk. TLSPSKIdentity and TLSPSKFile are mandatory'
 
-@mock.patch('configobj.ConfigObj')
-def test_tls_connect_psk(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_tls_connect_psk(mock_read_config_file):
     """
     TLSConnect: 'psk'
     Should raise a NotImplementedError with appropriate message
     """
-    mock_configobj.side_effect = [
+    mock_read_config_file.side_effect = [
         {
             'TLSConnect': 'psk',
             'TLSPSKIdentity': 'TLS PSK Zabbix Identity',
@@ -525,12 +524,12 @@ def test_tls_connect_psk(mock_configobj):
     assert zbx_config.tls_psk_identity == 'TLS PSK Zabbix Identity'
     assert zbx_config.tls_psk_file == '/tmp/psk.file'
 
-@mock.patch('configobj.ConfigObj')
-def test_data_type(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_data_type(mock_read_config_file):
     """
     Test data_type. Default is None
     """
-    mock_configobj.side_effect = [{}]
+    mock_read_config_file.side_effect = [{}]
     zbx_config = protobix.ZabbixAgentConfig('default_configuration')
     assert zbx_config.data_type is None
     zbx_config.data_type = 'items'
@@ -538,12 +537,12 @@ def test_data_type(mock_configobj):
     zbx_config.data_type = 'lld'
     assert zbx_config.data_type == 'lld'
 
-@mock.patch('configobj.ConfigObj')
-def test_data_type_invalid(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_data_type_invalid(mock_read_config_file):
     """
     Test data_type with invalid value
     """
-    mock_configobj.side_effect = [{}]
+    mock_read_config_file.side_effect = [{}]
     zbx_config = protobix.ZabbixAgentConfig('default_configuration')
     assert zbx_config.data_type is None
     with pytest.raises(ValueError) as err:
@@ -551,26 +550,246 @@ def test_data_type_invalid(mock_configobj):
     assert str(err.value) == 'data_type requires either "items" or "lld"'
     assert zbx_config.data_type is None
 
-@mock.patch('configobj.ConfigObj')
-def test_dryrun(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_dryrun(mock_read_config_file):
     """
     Test dryrun. Default is False
     """
-    mock_configobj.side_effect = [{}]
+    mock_read_config_file.side_effect = [{}]
     zbx_config = protobix.ZabbixAgentConfig('default_configuration')
     assert zbx_config.dryrun is False
     zbx_config.dryrun = True
     assert zbx_config.dryrun is True
 
-@mock.patch('configobj.ConfigObj')
-def test_dryrun_invalid(mock_configobj):
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_dryrun_invalid(mock_read_config_file):
     """
     Test dryrun with invalid value
     """
-    mock_configobj.side_effect = [{}]
+    mock_read_config_file.side_effect = [{}]
     zbx_config = protobix.ZabbixAgentConfig('default_configuration')
     assert zbx_config.dryrun is False
     with pytest.raises(ValueError) as err:
         zbx_config.dryrun = 'invalid'
     assert str(err.value) == 'dryrun parameter requires boolean'
     assert zbx_config.dryrun is False
+
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_diagnose(mock_read_config_file):
+    """
+    Test diagnose. Default is False
+    """
+    mock_read_config_file.side_effect = [{}]
+    zbx_config = protobix.ZabbixAgentConfig('default_configuration')
+    assert zbx_config.diagnose is False
+    zbx_config.diagnose = True
+    assert zbx_config.diagnose is True
+    with pytest.raises(ValueError) as err:
+        zbx_config.diagnose = 'invalid'
+    assert str(err.value) == 'diagnose parameter requires boolean'
+
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_item_filter_ttl(mock_read_config_file):
+    """
+    Test item_filter_ttl. Default is None, disabled
+    """
+    mock_read_config_file.side_effect = [{}]
+    zbx_config = protobix.ZabbixAgentConfig('default_configuration')
+    assert zbx_config.item_filter_ttl is None
+    zbx_config.item_filter_ttl = 600
+    assert zbx_config.item_filter_ttl == 600
+    for value in (0, 1.5, True):
+        with pytest.raises(ValueError) as err:
+            zbx_config.item_filter_ttl = value
+        assert str(err.value) == 'item_filter_ttl must be a number of seconds greater than 0'
+    zbx_config.item_filter_ttl = None
+    assert zbx_config.item_filter_ttl is None
+    assert zbx_config.item_filter_file is None
+    zbx_config.item_filter_file = '/tmp/rejected.json'
+    assert zbx_config.item_filter_file == '/tmp/rejected.json'
+
+rate_limit_params = (
+    ('rate_limit_items', 'rate_limit_items must be a positive number of items per second'),
+    ('rate_limit_bytes', 'rate_limit_bytes must be a positive number of bytes per second'),
+)
+@pytest.mark.parametrize(('option', 'message'), rate_limit_params)
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_rate_limit(mock_read_config_file, option, message):
+    """
+    Test rate limits. Default is 0, unlimited
+    """
+    mock_read_config_file.side_effect = [{}]
+    zbx_config = protobix.ZabbixAgentConfig('default_configuration')
+    assert getattr(zbx_config, option) == 0
+    setattr(zbx_config, option, 100.5)
+    assert getattr(zbx_config, option) == 100.5
+    for value in (-1, 'invalid', True):
+        with pytest.raises(ValueError) as err:
+            setattr(zbx_config, option, value)
+        assert str(err.value) == message
+    assert getattr(zbx_config, option) == 100.5
+
+@mock.patch('protobix.ZabbixAgentConfig._read_config_file')
+def test_backpressure_threshold(mock_read_config_file):
+    """
+    Test backpressure_threshold. Default is None, disabled
+    """
+    mock_read_config_file.side_effect = [{}]
+    zbx_config = protobix.ZabbixAgentConfig('default_configuration')
+    assert zbx_config.backpressure_threshold is None
+    zbx_config.backpressure_threshold = 0.5
+    assert zbx_config.backpressure_threshold == 0.5
+    with pytest.raises(ValueError) as err:
+        zbx_config.backpressure_threshold = 0
+    assert str(err.value) == 'backpressure_threshold must be a number of seconds greater than 0'
+    zbx_config.backpressure_threshold = None
+    assert zbx_config.backpressure_threshold is None
+
+def test_parse_config_file(tmpdir):
+    """
+    Only options used by protobix are extracted from zabbix_agentd.conf
+    """
+    config_file = tmpdir.join('zabbix_agentd.conf')
+    config_file.write(
+        '# This is a comment\n'
+        'ServerActive=zabbix.domain.tld:10052\n'
+        '\n'
+        'Hostname = myhostname\n'
+        'Timeout=5\n'
+        'UserParameter=my.key,echo "a=b" # not a comment\n'
+        'UserParameter=my.other.key,echo 1\n'
+    )
+    zbx_config = protobix.ZabbixAgentConfig(str(config_file))
+    assert zbx_config._parse_config_file(str(config_file)) == {
+        'ServerActive': 'zabbix.domain.tld:10052',
+        'Hostname': 'myhostname',
+        'Timeout': '5'
+    }
+    assert zbx_config.server_active == 'zabbix.domain.tld'
+    assert zbx_config.server_port == 10052
+    assert zbx_config.hostname == 'myhostname'
+    assert zbx_config.timeout == 5
+
+def test_config_file_cache(tmpdir):
+    """
+    Configuration file is only parsed again when it changes
+    """
+    config_file = tmpdir.join('zabbix_agentd.conf')
+    config_file.write('Hostname=myhostname\n')
+    with mock.patch.object(
+        protobix.ZabbixAgentConfig, '_parse_config_file',
+        wraps=protobix.ZabbixAgentConfig()._parse_config_file
+    ) as mock_parse:
+        zbx_config = protobix.ZabbixAgentConfig(str(config_file))
+        assert zbx_config.hostname == 'myhostname'
+        zbx_config = protobix.ZabbixAgentConfig(str(config_file))
+        assert zbx_config.hostname == 'myhostname'
+        assert mock_parse.call_count == 1
+        config_file.write('Hostname=myotherhostname\n')
+        zbx_config = protobix.ZabbixAgentConfig(str(config_file))
+        assert zbx_config.hostname == 'myotherhostname'
+        assert mock_parse.call_count == 2
+
+def test_include_file_directory_and_pattern(tmpdir):
+    """
+    Include directive can be a file, a directory or a wildcard pattern
+    Included files override values from including file
+    """
+    include_dir = tmpdir.mkdir('zabbix_agentd.d')
+    include_dir.join('server.conf').write('ServerActive=proxy.domain.tld\n')
+    include_dir.join('timeout.conf').write('Timeout=10\n')
+    include_dir.join('debug.txt').write('DebugLevel=4\n')
+    pattern_dir = tmpdir.mkdir('zabbix_agentd.conf.d')
+    pattern_dir.join('hostname.conf').write('Hostname=myhostname\n')
+    pattern_dir.join('hostname.conf.disabled').write('Hostname=nothere\n')
+    tmpdir.join('debug.conf').write('DebugLevel=4\n')
+    config_file = tmpdir.join('zabbix_agentd.conf')
+    config_file.write(
+        'ServerActive=zabbix.domain.tld\n'
+        'Timeout=5\n'
+        'Include=%s\n'
+        'Include=%s/*.conf\n'
+        'Include=%s\n' % (
+            str(include_dir),
+            str(pattern_dir),
+            str(tmpdir.join('debug.conf'))
+        )
+    )
+    zbx_config = protobix.ZabbixAgentConfig(str(config_file))
+    assert zbx_config.server_active == 'proxy.domain.tld'
+    assert zbx_config.timeout == 10
+    assert zbx_config.hostname == 'myhostname'
+    assert zbx_config.debug_level == 4
+
+def test_include_too_deep(tmpdir):
+    """
+    Recursive Include directive must be detected
+    """
+    config_file = tmpdir.join('zabbix_agentd.conf')
+    config_file.write('Include=%s\n' % str(config_file))
+    with pytest.raises(ValueError) as err:
+        protobix.ZabbixAgentConfig(str(config_file))
+    assert str(err.value) == 'Include nesting is too deep in %s' % str(config_file)
+
+def test_reload(tmpdir):
+    """
+    reload only parses changed files & calls callbacks on change
+    """
+    include_file = tmpdir.join('server.conf')
+    include_file.write('ServerActive=zabbix.domain.tld\n')
+    config_file = tmpdir.join('zabbix_agentd.conf')
+    config_file.write('Hostname=myhostname\nInclude=%s\n' % str(include_file))
+    zbx_config = protobix.ZabbixAgentConfig(str(config_file))
+    zbx_config.dryrun = True
+    zbx_config.rate_limit_items = 1000
+    callback = mock.MagicMock()
+    zbx_config.add_reload_callback(callback)
+    assert zbx_config.server_active == 'zabbix.domain.tld'
+
+    with mock.patch.object(
+        protobix.ZabbixAgentConfig, '_parse_config_file',
+        wraps=zbx_config._parse_config_file
+    ) as mock_parse:
+        assert zbx_config.reload() is False
+        assert mock_parse.call_count == 0
+        assert callback.call_count == 0
+
+        include_file.write('ServerActive=proxy.domain.tld:10052\n')
+        assert zbx_config.reload() is True
+        mock_parse.assert_called_once_with(str(include_file))
+        callback.assert_called_once_with(zbx_config)
+    assert zbx_config.server_active == 'proxy.domain.tld'
+    assert zbx_config.server_port == 10052
+    assert zbx_config.hostname == 'myhostname'
+    assert zbx_config.dryrun is True
+    assert zbx_config.rate_limit_items == 1000
+
+def test_reload_missing_keeps_previous_config(tmpdir):
+    """
+    Deleted or unreadable configuration file on reload keeps current one
+    """
+    config_file = tmpdir.join('zabbix_agentd.conf')
+    config_file.write('ServerActive=zabbix.domain.tld\n')
+    zbx_config = protobix.ZabbixAgentConfig(str(config_file))
+    config_file.remove()
+    assert zbx_config.reload() is False
+    assert zbx_config.server_active == 'zabbix.domain.tld'
+    config_file.write('ServerActive=proxy.domain.tld\n')
+    with mock.patch.object(protobix.ZabbixAgentConfig, '_parse_config_file') as mock_parse:
+        mock_parse.side_effect = IOError('Permission denied')
+        assert zbx_config.reload() is False
+    assert zbx_config.server_active == 'zabbix.domain.tld'
+    assert zbx_config.reload() is True
+    assert zbx_config.server_active == 'proxy.domain.tld'
+
+def test_reload_invalid_keeps_previous_config(tmpdir):
+    """
+    Invalid configuration on reload must not replace current one
+    """
+    config_file = tmpdir.join('zabbix_agentd.conf')
+    config_file.write('ServerActive=zabbix.domain.tld\n')
+    zbx_config = protobix.ZabbixAgentConfig(str(config_file))
+    config_file.write('ServerActive=proxy.domain.tld\nLogType=invalid\n')
+    with pytest.raises(ValueError):
+        zbx_config.reload()
+    assert zbx_config.server_active == 'zabbix.domain.tld'
@@ -0,0 +1,120 @@
+"""
+Tests for protobix.zygote
+"""
+import pytest
+import mock
+import socket
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import protobix
+from protobix.zygote import Zygote, call, call_main, check_args, ZYGOTE_UNAVAILABLE
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(socket.socket, 'recvmsg'), reason='Zygote requires Python 3'
+)
+
+class ZygoteTestProbe(protobix.SampleProbe):
+    __version__ = "1.0.2"
+    init_calls = 0
+
+    def _init_probe(self):
+        ZygoteTestProbe.init_calls += 1
+        sys.stdout.write('init\n')
+
+    def _get_metrics(self):
+        if self.options.host_timeout == 1:
+            raise Exception('Backend is down')
+        sys.stdout.write('get metrics\n')
+        return {'myhostname': {'my.item.key': 1}}
+
+def zygote_call(socket_path, args):
+    """
+    Call zygote with a pipe as stdout, returns exit code & output
+    """
+    read_fd, write_fd = os.pipe()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        code = call(args, socket_path, fds=(devnull, write_fd, devnull))
+    finally:
+        os.close(write_fd)
+        os.close(devnull)
+    with os.fdopen(read_fd) as output:
+        return code, output.read()
+
+def test_zygote(tmpdir):
+    """
+    Probe is initialized once, forked probes write to client's stdout
+    """
+    socket_path = str(tmpdir.join('zygote.sock'))
+    ZygoteTestProbe.init_calls = 0
+    with Zygote(ZygoteTestProbe(), socket_path, ['--dryrun']) as zygote:
+        for run in range(3):
+            assert zygote_call(socket_path, ['--dryrun']) == (0, 'get metrics\n')
+        assert zygote_call(socket_path, ['--dryrun', '--host-timeout', '1']) == (2, '')
+    assert ZygoteTestProbe.init_calls == 1
+    assert not os.path.exists(socket_path)
+
+def test_zygote_invalid_request(tmpdir):
+    """
+    Requests without file descriptors are refused
+    """
+    socket_path = str(tmpdir.join('zygote.sock'))
+    with Zygote(ZygoteTestProbe(), socket_path, ['--dryrun']):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+        sock.sendall(b'\0\0\0\x02[]')
+        assert sock.recv(4) == b''
+        sock.close()
+        # Zygote still serves other requests
+        assert zygote_call(socket_path, ['--dryrun'])[0] == 0
+
+def test_zygote_socket_mode(tmpdir):
+    """
+    Only zygote's user may connect
+    """
+    socket_path = str(tmpdir.join('zygote.sock'))
+    with Zygote(ZygoteTestProbe(), socket_path, ['--dryrun']):
+        assert os.stat(socket_path).st_mode & 0o777 == 0o600
+
+def test_zygote_other_user(tmpdir):
+    """
+    Peers of another user are refused
+    """
+    socket_path = str(tmpdir.join('zygote.sock'))
+    with Zygote(ZygoteTestProbe(), socket_path, ['--dryrun']):
+        with mock.patch('protobix.zygote._peer_uid') as mock_peer_uid:
+            mock_peer_uid.return_value = os.getuid() + 1
+            with pytest.raises(socket.error):
+                zygote_call(socket_path, ['--dryrun'])
+        assert zygote_call(socket_path, ['--dryrun'])[0] == 0
+
+def test_zygote_forbidden_option(tmpdir):
+    """
+    Options reading or writing files are refused
+    """
+    socket_path = str(tmpdir.join('zygote.sock'))
+    with Zygote(ZygoteTestProbe(), socket_path, ['--dryrun']):
+        with pytest.raises(socket.error):
+            zygote_call(socket_path, ['--dryrun', '--value-cache-file', '/tmp/file'])
+
+def test_check_args():
+    """
+    Only allowed options pass, abbreviated or combined ones don't
+    """
+    check_args(['--update-items', '-vvvv', '--host-timeout', '5', '--workers=2', '-d'])
+    check_args(['--lld-refresh', '-1'])
+    for args in (['--config', 'file'], ['-c', 'file'], ['-cfile'], ['--conf=file'],
+                 ['-dc', 'file'], ['--profile-dir', '/tmp']):
+        with pytest.raises(ValueError):
+            check_args(args)
+    check_args(['--my-option'], ['--my-option'])
+
+def test_call_main_unavailable(tmpdir):
+    """
+    Client exits with an error when zygote isn't running
+    """
+    socket_path = str(tmpdir.join('zygote.sock'))
+    with mock.patch('sys.stderr') as mock_stderr:
+        assert call_main(['--socket', socket_path, '--update-items']) == ZYGOTE_UNAVAILABLE
+    assert socket_path in mock_stderr.write.call_args[0][0]